@@ -30,6 +30,7 @@ def read(*rnames):
 
 
 TESTS_REQUIRE = [
+    'zope.lifecycleevent',
     'zope.size',
     'zope.testing',
     'zope.testrunner',
@@ -93,6 +94,12 @@ setup(name='zope.viewlet',
           'zope.security',
           'zope.traversing',
       ],
+      entry_points={
+          'console_scripts': [
+              'zope-viewlet-audit = zope.viewlet.audit:main',
+              'zope-viewlet-replay = zope.viewlet.replay:main',
+          ],
+      },
       include_package_data=True,
       zip_safe=False,
       )
@@ -0,0 +1,175 @@
+##############################################################################
+#
+# Copyright (c) 2026 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Static audit of viewlet and viewlet manager registrations.
+
+Run ``zope-viewlet-audit site.zcml`` to load a site's configuration and
+report, for every viewlet manager and every layer and view it can be
+used with, how many viewlets the manager will look up and instantiate on
+each request, how their ``render`` permissions are distributed and how
+many templates they use. Managers with more viewlets than the threshold
+are flagged.
+"""
+__docformat__ = 'restructuredtext'
+
+import argparse
+import collections
+import json
+import sys
+
+import zope.component
+from zope.interface import implementedBy
+from zope.interface.interfaces import ISpecification
+from zope.security.checker import CheckerPublic
+from zope.security.checker import getCheckerForInstancesOf
+
+from zope.viewlet import interfaces
+
+
+#: The report for one viewlet manager registration used with one layer and
+#: view. *permissions* maps the ``render`` permissions to the number of
+#: viewlets protected by them, *templates* is the number of distinct
+#: templates (including the manager's).
+ManagerReport = collections.namedtuple(
+    'ManagerReport',
+    'name provides for_ layer view viewlets permissions templates expensive')
+
+
+def _spec(obj):
+    if obj is None or ISpecification.providedBy(obj):
+        return obj
+    return implementedBy(obj)
+
+
+def _name(obj):
+    if obj is None:
+        return '*'
+    identifier = getattr(obj, '__identifier__', None)
+    if identifier is not None:
+        return identifier
+    # Views registered for classes are required by the specification
+    # implemented by the class.
+    obj = getattr(obj, 'inherit', None) or obj
+    return '{}.{}'.format(obj.__module__, obj.__qualname__)
+
+
+def _permission(factory):
+    checker = getCheckerForInstancesOf(factory)
+    if checker is None:
+        return None
+    permission = checker.permission_id('render')
+    if permission is CheckerPublic:
+        return 'zope.Public'
+    return permission
+
+
+def _template(factory):
+    for attr in ('index', 'template'):
+        template = getattr(factory, attr, None)
+        filename = getattr(template, 'filename', None)
+        if filename is not None:
+            return filename
+    return None
+
+
+def audit(registry=None, threshold=20):
+    """
+    Return a list of `ManagerReport` for all viewlet managers registered
+    in *registry* (by default the global site manager).
+
+    A report is made for the layer and view a manager is registered for,
+    and for every more specific layer and view some of its viewlets are
+    registered for. Reports with more than *threshold* viewlets are
+    flagged as expensive.
+    """
+    if registry is None:
+        registry = zope.component.getGlobalSiteManager()
+
+    managers = []
+    combinations = collections.defaultdict(set)
+    for reg in registry.registeredAdapters():
+        if len(reg.required) == 3 and reg.provided.isOrExtends(
+                interfaces.IViewletManager):
+            managers.append(reg)
+        elif len(reg.required) == 4 and reg.provided.isOrExtends(
+                interfaces.IViewlet):
+            combinations[reg.required[3]].add(reg.required[1:3])
+
+    reports = []
+    for reg in managers:
+        for_, layer, view = (_spec(spec) for spec in reg.required)
+        seen = {(layer, view)}
+        for required, pairs in combinations.items():
+            if reg.provided.isOrExtends(required):
+                seen.update(
+                    (otherLayer, otherView)
+                    for otherLayer, otherView in pairs
+                    if otherLayer.isOrExtends(layer)
+                    and _spec(otherView).isOrExtends(view))
+        for comboLayer, comboView in sorted(
+                seen, key=lambda pair: (_name(pair[0]), _name(pair[1]))):
+            factories = [
+                factory for _unused, factory in registry.adapters.lookupAll(
+                    (for_, comboLayer, _spec(comboView), reg.provided),
+                    interfaces.IViewlet)]
+            permissions = collections.Counter(
+                _permission(factory) for factory in factories)
+            templates = {_template(factory) for factory in factories}
+            templates.add(_template(reg.factory))
+            templates.discard(None)
+            reports.append(ManagerReport(
+                reg.name, _name(reg.provided), _name(reg.required[0]),
+                _name(comboLayer), _name(comboView), len(factories),
+                dict(permissions), len(templates),
+                len(factories) > threshold))
+    return reports
+
+
+def formatReport(report):
+    """Return a line of text describing a `ManagerReport`."""
+    permissions = ', '.join(
+        '%s: %d' % (permission, count) for permission, count in sorted(
+            report.permissions.items(), key=lambda item: str(item[0])))
+    return '{}{} ({}) for {} on {} / {}: {} viewlets, {} templates; {}'.format(
+        '!! ' if report.expensive else '', report.name, report.provides,
+        report.for_, report.layer, report.view, report.viewlets,
+        report.templates, permissions or 'no permissions')
+
+
+def main(argv=None):
+    """Entry point of the ``zope-viewlet-audit`` script."""
+    parser = argparse.ArgumentParser(
+        prog='zope-viewlet-audit',
+        description='Report the viewlets each viewlet manager registered '
+                    'by a ZCML file instantiates per request.')
+    parser.add_argument('zcml', help='the site configuration to load')
+    parser.add_argument(
+        '-t', '--threshold', type=int, default=20,
+        help='flag managers with more viewlets than this (default: 20)')
+    parser.add_argument(
+        '--json', action='store_true', help='write the report as JSON')
+    args = parser.parse_args(argv)
+
+    from zope.configuration import xmlconfig
+    xmlconfig.file(args.zcml)
+
+    reports = audit(threshold=args.threshold)
+    if args.json:
+        json.dump([report._asdict() for report in reports], sys.stdout,
+                  indent=2, default=str)
+        sys.stdout.write('\n')
+    else:
+        for report in reports:
+            print(formatReport(report))
+    # Signal expensive managers to scripts.
+    return 1 if any(report.expensive for report in reports) else 0
@@ -0,0 +1,973 @@
+##############################################################################
+#
+# Copyright (c) 2026 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Storages for rendered viewlet output.
+
+A viewlet manager with a `~.ViewletManagerBase.cacheStorage` stores the
+output of viewlets providing
+:class:`zope.viewlet.interfaces.ICacheableViewlet` in one of these
+storages.
+
+While a cacheable viewlet is updated and rendered, it can declare which
+objects and catalog indexes its output depends on by calling `dependsOn`
+and `dependsOnIndex`. The output is then removed from its storage when
+one of those objects is modified, added or removed (see
+`invalidateModified` and `invalidateMoved`), or when `invalidateIndex`
+is called for one of the indexes.
+
+Rendered markup is repetitive, so a `CompressedCacheStorage` holding
+more outputs in the same memory is often worth the time compressing and
+decompressing them takes. Its statistics report both.
+"""
+__docformat__ = 'restructuredtext'
+
+import collections
+import hashlib
+import mmap
+import multiprocessing
+import os
+import struct
+import tempfile
+import threading
+import time
+import weakref
+import zlib
+
+import zope.interface
+
+from zope.viewlet import interfaces
+
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+
+_recorders = threading.local()
+
+
+def dependsOn(*objects):
+    """
+    Declare that the output of the viewlet currently being updated or
+    rendered depends on *objects*.
+
+    Does nothing if the output is not going to be cached.
+    """
+    for recorder in getattr(_recorders, 'stack', ()):
+        recorder.objects.update(_objectKey(obj) for obj in objects)
+
+
+def dependsOnIndex(*names):
+    """
+    Declare that the output of the viewlet currently being updated or
+    rendered depends on the catalog indexes called *names*.
+
+    Does nothing if the output is not going to be cached.
+    """
+    for recorder in getattr(_recorders, 'stack', ()):
+        recorder.indexes.update(names)
+
+
+class _ObjectRef:
+    # Identifies an object while it is alive. Unlike its id, which can be
+    # reused by another object once it was garbage collected, a reference
+    # to a collected object equals no other key.
+
+    __slots__ = ('_id', '_ref')
+
+    def __init__(self, obj):
+        self._ref = weakref.ref(obj)
+        self._id = id(obj)
+
+    def __hash__(self):
+        return hash(self._id)
+
+    def __eq__(self, other):
+        if not isinstance(other, _ObjectRef):
+            return NotImplemented
+        obj = self._ref()
+        return obj is not None and obj is other._ref()
+
+
+def _objectKey(obj):
+    # Different connections load different instances of the same
+    # persistent object, so those are identified by their oid.
+    oid = getattr(obj, '_p_oid', None)
+    if oid is not None:
+        return ('oid', oid)
+    try:
+        return ('ref', _ObjectRef(obj))
+    except TypeError:
+        # Values like strings cannot be referenced weakly; they are kept
+        # alive while output depending on them is registered.
+        hash(obj)
+        return ('value', obj)
+
+
+class DependencyRecorder:
+    """
+    Collects the dependencies declared while it is used as a context
+    manager.
+
+    Recorders can be nested: the dependencies of the output of an inner
+    viewlet (for example one in a nested viewlet manager) are also
+    dependencies of the outer one.
+    """
+
+    def __init__(self):
+        self.objects = set()
+        self.indexes = set()
+
+    def __enter__(self):
+        stack = getattr(_recorders, 'stack', None)
+        if stack is None:
+            stack = _recorders.stack = []
+        stack.append(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        _recorders.stack.remove(self)
+
+
+class DependencyIndex:
+    """
+    Maps objects and catalog indexes to the cache entries depending on
+    them.
+
+    Entries are forgotten once they have been invalidated, or when their
+    storage evicted them and told the index so (see `forget`). As not all
+    storages know which entries they evict, at most *maxEntries* entries
+    are remembered: to make room for new entries, those registered least
+    recently are invalidated in their storages and forgotten. Storages
+    are only referenced weakly.
+    """
+
+    def __init__(self, maxEntries=100000):
+        self.maxEntries = maxEntries
+        self._lock = threading.Lock()
+        self.clear()
+
+    def register(self, storage, key, recorder):
+        """
+        Register that the entry for *key* in *storage* depends on what
+        was collected by *recorder*, and nothing else.
+        """
+        entry = (weakref.ref(storage), key)
+        dropped = []
+        with self._lock:
+            self._forget(entry)
+            if not recorder.objects and not recorder.indexes:
+                return
+            self._entries[entry] = (frozenset(recorder.objects),
+                                    frozenset(recorder.indexes))
+            for dependency in recorder.objects:
+                self._objects.setdefault(dependency, set()).add(entry)
+            for name in recorder.indexes:
+                self._indexes.setdefault(name, set()).add(entry)
+            while len(self._entries) > self.maxEntries:
+                oldest = next(iter(self._entries))
+                self._forget(oldest)
+                dropped.append(oldest)
+        self._invalidate(dropped)
+
+    def forget(self, storage, key):
+        """
+        Forget the entry for *key* in *storage*, which is no longer
+        stored, without invalidating it.
+        """
+        with self._lock:
+            if self._entries:
+                self._forget((weakref.ref(storage), key))
+
+    def _forget(self, entry):
+        dependencies = self._entries.pop(entry, None)
+        if dependencies is None:
+            return
+        for mapping, names in zip((self._objects, self._indexes),
+                                  dependencies):
+            for name in names:
+                entries = mapping.get(name)
+                if entries is not None:
+                    entries.discard(entry)
+                    if not entries:
+                        del mapping[name]
+
+    def _pop(self, entries):
+        entries = list(entries or ())
+        for entry in entries:
+            self._forget(entry)
+        return entries
+
+    def _invalidate(self, entries):
+        count = 0
+        for storageRef, key in entries:
+            storage = storageRef()
+            if storage is not None:
+                storage.invalidate(key)
+                count += 1
+        return count
+
+    def invalidateObject(self, obj):
+        """
+        Invalidate all entries depending on *obj*. Return how many
+        entries were invalidated.
+        """
+        with self._lock:
+            entries = self._pop(self._objects.get(_objectKey(obj)))
+        return self._invalidate(entries)
+
+    def invalidateIndex(self, name=None):
+        """
+        Invalidate all entries depending on the index called *name*, or on
+        any index if *name* is ``None``. Return how many entries were
+        invalidated.
+        """
+        with self._lock:
+            if name is None:
+                entries = self._pop(set().union(*self._indexes.values()))
+            else:
+                entries = self._pop(self._indexes.get(name))
+        return self._invalidate(entries)
+
+    def clear(self):
+        """Forget all dependencies."""
+        with self._lock:
+            self._entries = collections.OrderedDict()
+            self._objects = {}
+            self._indexes = {}
+
+
+#: The `DependencyIndex` used by the viewlet managers.
+dependencies = DependencyIndex()
+
+#: Invalidate the entries depending on the catalog index called *name*,
+#: or on any index if *name* is ``None``.
+invalidateIndex = dependencies.invalidateIndex
+
+#: Whether `invalidateModified` invalidates the output depending on any
+#: catalog index for events that do not describe the modified attributes.
+invalidateIndexesOnModified = True
+
+
+def invalidateModified(event):
+    """
+    Invalidate the output depending on a modified object.
+
+    This is a subscriber for
+    :class:`zope.lifecycleevent.interfaces.IObjectModifiedEvent`. Catalog
+    indexes are assumed to be named after the attributes they index: if
+    the event describes the modified attributes, the output depending on
+    indexes with those names is invalidated.
+
+    Events not describing the modified attributes can affect any index,
+    so they invalidate the output depending on any index, unless
+    `invalidateIndexesOnModified` is false. Applications that always
+    describe their modifications, or call `invalidateIndex` themselves
+    when they reindex objects, can set it to false to keep that output.
+    """
+    dependencies.invalidateObject(event.object)
+    names = set()
+    for description in getattr(event, 'descriptions', ()):
+        names.update(getattr(description, 'attributes', ()))
+    if not names and invalidateIndexesOnModified:
+        dependencies.invalidateIndex()
+    for name in names:
+        dependencies.invalidateIndex(name)
+
+
+def invalidateMoved(event):
+    """
+    Invalidate the output depending on an object that was added, removed
+    or moved, on its old and new parents, and on any catalog index.
+
+    This is a subscriber for
+    :class:`zope.lifecycleevent.interfaces.IObjectMovedEvent`.
+    """
+    for obj in (event.object, event.oldParent, event.newParent):
+        if obj is not None:
+            dependencies.invalidateObject(obj)
+    dependencies.invalidateIndex()
+
+
+_templateVersions = {}
+
+
+def templateVersion(class_):
+    """
+    Return a version of the template of the viewlet class *class_* (its
+    ``index`` or ``template``), which changes whenever the contents of
+    the template file change, or ``''`` if it has no template file.
+
+    Viewlet managers make the version part of the keys output is cached
+    under, so that output rendered with an old template is not used
+    after a deployment, even from a `FileCacheStorage`. Templates are
+    only read once per class and process.
+    """
+    version = _templateVersions.get(class_)
+    if version is None:
+        version = ''
+        for attr in ('index', 'template'):
+            filename = getattr(getattr(class_, attr, None), 'filename', None)
+            if filename is None:
+                continue
+            try:
+                with open(filename, 'rb') as template:
+                    version = hashlib.blake2b(
+                        template.read(), digest_size=8).hexdigest()
+            except OSError:
+                pass
+            break
+        _templateVersions[class_] = version
+    return version
+
+
+try:
+    from zope.testing.cleanup import addCleanUp
+except ImportError:  # pragma: no cover
+    pass
+else:
+    addCleanUp(dependencies.clear)
+    addCleanUp(_templateVersions.clear)
+    del addCleanUp
+
+
+def _sizeof(value):
+    if isinstance(value, bytes):
+        return len(value)
+    return len(value.encode('utf-8'))
+
+
+def _digest(key):
+    return hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+
+
+class CacheStorageBase:
+    """Counters shared by all storages."""
+
+    #: The byte budget of the storage.
+    maxBytes = None
+
+    hits = misses = evictions = 0
+
+    def _forgetEvicted(self, keys):
+        # Let the dependency index forget the evicted entries for *keys*.
+        for key in keys:
+            dependencies.forget(self, key)
+
+    def _statistics(self, entries, size):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': entries,
+            'size': size,
+            'maxBytes': self.maxBytes,
+        }
+
+
+@zope.interface.implementer(interfaces.IViewletCacheStorage)
+class LRUCacheStorage(CacheStorageBase):
+    """An in-process storage evicting the least recently used values.
+
+    The storage is safe to use from several threads.
+    """
+
+    def __init__(self, maxBytes=16 * 1024 * 1024):
+        self.maxBytes = maxBytes
+        self._data = collections.OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                value, _size = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        size = _sizeof(value)
+        if size > self.maxBytes:
+            # The value stored before must not be served instead.
+            with self._lock:
+                self._remove(key)
+            return
+        evicted = []
+        with self._lock:
+            self._remove(key)
+            while self._size + size > self.maxBytes:
+                oldest, (_value, oldSize) = self._data.popitem(last=False)
+                self._size -= oldSize
+                self.evictions += 1
+                evicted.append(oldest)
+            self._data[key] = (value, size)
+            self._size += size
+        self._forgetEvicted(evicted)
+
+    def _remove(self, key):
+        entry = self._data.pop(key, None)
+        if entry is not None:
+            self._size -= entry[1]
+
+    def invalidate(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._size = 0
+
+    def statistics(self):
+        with self._lock:
+            return self._statistics(len(self._data), self._size)
+
+
+# The length of the substrings by which samples are compared.
+_GRAM = 8
+
+
+def trainDictionary(samples, size=32 * 1024):
+    """
+    Return a preset dictionary for `zlib` of at most *size* bytes, made of
+    the byte strings *samples* that share the most with the others.
+
+    Samples mostly repeating those already chosen are skipped, so that
+    the dictionary covers outputs of all kinds. The samples sharing the
+    most come last, as zlib encodes references to the end of the
+    dictionary most compactly.
+    """
+    grams = {}
+    counts = collections.Counter()
+    for sample in set(samples):
+        grams[sample] = {sample[i:i + _GRAM]
+                         for i in range(max(len(sample) - _GRAM + 1, 1))}
+        counts.update(grams[sample])
+    scores = {
+        sample: sum(counts[gram] - 1 for gram in sampleGrams) / len(sample)
+        for sample, sampleGrams in grams.items() if sample}
+    chosen = []
+    covered = set()
+    total = 0
+    for sample in sorted(scores, key=lambda sample: (-scores[sample],
+                                                     sample)):
+        if not scores[sample] or total + len(sample) > size:
+            continue
+        if len(grams[sample] - covered) * 2 < len(grams[sample]):
+            continue
+        chosen.append(sample)
+        covered.update(grams[sample])
+        total += len(sample)
+    return b''.join(reversed(chosen))
+
+
+class FragmentCompressor:
+    """Compresses outputs with `zlib` at the compression *level*.
+
+    If *dictionarySize* is not 0, a preset dictionary of that many bytes
+    (at most 32 KiB, the window of zlib) is trained (see
+    `trainDictionary`) on the first *trainingBytes* of outputs, and the
+    outputs compressed after that are compressed with it. Preset
+    dictionaries help most for small outputs, which share little with
+    themselves but much with each other.
+
+    Compressed outputs are pairs of the index of the dictionary they were
+    compressed with and the compressed bytes.
+    """
+
+    def __init__(self, level=6, dictionarySize=0, trainingBytes=256 * 1024):
+        self.level = level
+        self.dictionarySize = min(dictionarySize, 32 * 1024)
+        self.trainingBytes = trainingBytes
+        # The dictionaries are only ever added to, index 0 is none.
+        self._dictionaries = [None]
+        self._samples = []
+        self._sampled = 0
+        self._lock = threading.Lock()
+
+    @property
+    def trained(self):
+        """Whether a preset dictionary is used."""
+        return len(self._dictionaries) > 1
+
+    def compress(self, data):
+        """Return the compressed bytes *data*."""
+        index = len(self._dictionaries) - 1
+        zdict = self._dictionaries[index]
+        if zdict is None:
+            compressor = zlib.compressobj(self.level)
+            if self.dictionarySize:
+                self._addSample(data)
+        else:
+            compressor = zlib.compressobj(self.level, zdict=zdict)
+        return index, compressor.compress(data) + compressor.flush()
+
+    def decompress(self, compressed):
+        """Return the bytes compressed into *compressed*."""
+        index, data = compressed
+        zdict = self._dictionaries[index]
+        if zdict is None:
+            return zlib.decompress(data)
+        decompressor = zlib.decompressobj(zdict=zdict)
+        return decompressor.decompress(data) + decompressor.flush()
+
+    def _addSample(self, data):
+        with self._lock:
+            if self.trained:
+                return
+            self._samples.append(data)
+            self._sampled += len(data)
+            if self._sampled >= self.trainingBytes:
+                self._dictionaries.append(
+                    trainDictionary(self._samples, self.dictionarySize))
+                self._samples = []
+
+
+@zope.interface.implementer(interfaces.IViewletCacheStorage)
+class CompressedCacheStorage(LRUCacheStorage):
+    """An in-process storage keeping values compressed by *compressor*.
+
+    Like `LRUCacheStorage`, it evicts the least recently used values, but
+    the byte budget is spent on the compressed values, and identical
+    values (found by their hash) are only stored once. The *compressor*
+    defaults to a `FragmentCompressor` without preset dictionary.
+
+    Besides the counters of all storages, `statistics` reports the
+    ``rawSize`` of the values before compression and deduplication, the
+    ``savedBytes`` that saves, the number of distinct ``fragments``, how
+    many values were ``deduplicated``, and the ``compressSeconds`` and
+    ``decompressSeconds`` spent, to weigh memory against processing time.
+    """
+
+    def __init__(self, maxBytes=16 * 1024 * 1024, compressor=None):
+        super().__init__(maxBytes)
+        if compressor is None:
+            compressor = FragmentCompressor()
+        self.compressor = compressor
+        # Maps the digests of the values to lists of their compressed
+        # value and the number of keys they are stored under.
+        self._fragments = {}
+        self._rawSize = 0
+        self.deduplicated = 0
+        self.compressSeconds = self.decompressSeconds = 0.0
+
+    def get(self, key):
+        with self._lock:
+            try:
+                digest, _size = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            compressed = self._fragments[digest][0]
+        start = time.perf_counter()
+        value = self.compressor.decompress(compressed).decode('utf-8')
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self.decompressSeconds += elapsed
+        return value
+
+    def set(self, key, value):
+        data = value.encode('utf-8')
+        if len(data) > self.maxBytes:
+            # The value stored before must not be served instead.
+            with self._lock:
+                self._remove(key)
+            return
+        digest = hashlib.blake2b(data, digest_size=16).digest()
+        compressed = None
+        elapsed = 0.0
+        if digest not in self._fragments:
+            start = time.perf_counter()
+            compressed = self.compressor.compress(data)
+            elapsed = time.perf_counter() - start
+        evicted = []
+        with self._lock:
+            self.compressSeconds += elapsed
+            fragment = self._fragments.get(digest)
+            if fragment is None:
+                if compressed is None:
+                    # Evicted meanwhile.
+                    compressed = self.compressor.compress(data)
+                size = len(compressed[1])
+                if size > self.maxBytes:
+                    self._remove(key)
+                    return
+                while self._size + size > self.maxBytes:
+                    oldest, entry = self._data.popitem(last=False)
+                    self._release(entry)
+                    self.evictions += 1
+                    evicted.append(oldest)
+                fragment = self._fragments[digest] = [compressed, 0]
+                self._size += size
+            elif self._data.get(key, (None,))[0] != digest:
+                self.deduplicated += 1
+            # Reference the fragment before releasing the old value, which
+            # may be the same.
+            fragment[1] += 1
+            self._remove(key)
+            self._data[key] = (digest, len(data))
+            self._rawSize += len(data)
+        self._forgetEvicted(evicted)
+
+    def _remove(self, key):
+        entry = self._data.pop(key, None)
+        if entry is not None:
+            self._release(entry)
+
+    def _release(self, entry):
+        digest, size = entry
+        self._rawSize -= size
+        fragment = self._fragments[digest]
+        fragment[1] -= 1
+        if not fragment[1]:
+            del self._fragments[digest]
+            self._size -= len(fragment[0][1])
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._fragments.clear()
+            self._size = self._rawSize = 0
+
+    def statistics(self):
+        with self._lock:
+            result = self._statistics(len(self._data), self._size)
+            result.update(
+                rawSize=self._rawSize,
+                savedBytes=self._rawSize - self._size,
+                fragments=len(self._fragments),
+                deduplicated=self.deduplicated,
+                compressSeconds=self.compressSeconds,
+                decompressSeconds=self.decompressSeconds,
+            )
+            return result
+
+
+@zope.interface.implementer(interfaces.IViewletCacheStorage)
+class SharedMemoryCacheStorage(CacheStorageBase):
+    """A storage in an anonymous shared memory map.
+
+    The map is shared with all processes forked *after* the storage was
+    created, so preforking servers should create it before forking their
+    workers. The memory is split into *slotSize* sized slots; a value is
+    stored in the slot its key hashes to, replacing (evicting) whatever
+    was stored there. Values that do not fit into a slot are not stored.
+
+    The counters live in the shared memory as well, so `statistics`
+    reports them for all processes together.
+
+    Each slot starts with the digest of the key, the length and a checksum
+    of the value, which are written after the value. A value left
+    incomplete by a process killed while storing it is thus not returned.
+    """
+
+    _header = struct.Struct('<8sQQQ')
+    _slotHeader = struct.Struct('<16sII')
+    _magic = b'ZVCACHE2'
+
+    def __init__(self, maxBytes=16 * 1024 * 1024, slotSize=4096):
+        self.maxBytes = maxBytes
+        self.slotSize = slotSize
+        self.slots = max(1, (maxBytes - self._header.size) // slotSize)
+        self._lock = multiprocessing.Lock()
+        self._map = self._open(self._header.size + self.slots * slotSize)
+
+    def _open(self, size):
+        map_ = mmap.mmap(-1, size)
+        self._header.pack_into(map_, 0, self._magic, 0, 0, 0)
+        return map_
+
+    def _offset(self, digest):
+        index = int.from_bytes(digest[:8], 'little') % self.slots
+        return self._header.size + index * self.slotSize
+
+    def _count(self, field):
+        # Fields are numbered as in the header, after the magic.
+        offset = 8 + 8 * field
+        value, = struct.unpack_from('<Q', self._map, offset)
+        struct.pack_into('<Q', self._map, offset, value + 1)
+
+    def get(self, key):
+        digest = _digest(key)
+        offset = self._offset(digest)
+        with self._lock:
+            value = self._read(offset, digest)
+            self._count(1 if value is None else 0)
+        return value
+
+    def _read(self, offset, digest):
+        """
+        Return the value stored for *digest* in the slot at *offset*, or
+        ``None`` if there is none or it is incomplete.
+        """
+        stored, length, checksum = self._slotHeader.unpack_from(
+            self._map, offset)
+        if stored != digest or \
+                length > self.slotSize - self._slotHeader.size:
+            return None
+        start = offset + self._slotHeader.size
+        data = self._map[start:start + length]
+        if zlib.crc32(data) != checksum:
+            return None
+        try:
+            return data.decode('utf-8')
+        except UnicodeDecodeError:  # pragma: no cover
+            # Only if the checksums of different data collide.
+            return None
+
+    def set(self, key, value):
+        data = value.encode('utf-8')
+        if len(data) > self.slotSize - self._slotHeader.size:
+            self.invalidate(key)
+            return
+        digest = _digest(key)
+        offset = self._offset(digest)
+        with self._lock:
+            stored = self._slotHeader.unpack_from(self._map, offset)[0]
+            if stored not in (digest, bytes(16)):
+                self._count(2)
+            # The header last, so that it only matches complete values.
+            start = offset + self._slotHeader.size
+            self._map[start:start + len(data)] = data
+            self._slotHeader.pack_into(
+                self._map, offset, digest, len(data), zlib.crc32(data))
+
+    def invalidate(self, key):
+        digest = _digest(key)
+        offset = self._offset(digest)
+        with self._lock:
+            stored = self._slotHeader.unpack_from(self._map, offset)[0]
+            if stored == digest:
+                self._slotHeader.pack_into(
+                    self._map, offset, bytes(16), 0, 0)
+
+    def clear(self):
+        with self._lock:
+            for index in range(self.slots):
+                self._slotHeader.pack_into(
+                    self._map, self._header.size + index * self.slotSize,
+                    bytes(16), 0, 0)
+
+    def statistics(self):
+        entries = size = 0
+        with self._lock:
+            _magic, hits, misses, evictions = self._header.unpack_from(
+                self._map, 0)[:4]
+            for index in range(self.slots):
+                stored, length, _checksum = self._slotHeader.unpack_from(
+                    self._map, self._header.size + index * self.slotSize)
+                if stored != bytes(16):
+                    entries += 1
+                    size += length
+        return {
+            'hits': hits,
+            'misses': misses,
+            'evictions': evictions,
+            'entries': entries,
+            'size': size,
+            'maxBytes': self.maxBytes,
+        }
+
+
+class _FileLock:
+    """Excludes other threads and, where possible, other processes."""
+
+    def __init__(self, fd):
+        self._fd = fd
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        self._lock.acquire()
+        if fcntl is not None:
+            # POSIX record locks belong to processes, so unlike flock()
+            # they also exclude forked children sharing the descriptor.
+            fcntl.lockf(self._fd, fcntl.LOCK_EX)
+
+    def __exit__(self, *exc_info):
+        if fcntl is not None:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN)
+        self._lock.release()
+
+
+class FileCacheStorage(SharedMemoryCacheStorage):
+    """A `SharedMemoryCacheStorage` in a memory mapped file at *path*.
+
+    The stored output survives restarts of the processes using it, so
+    restarted workers start with a warm cache, and it is shared by all
+    processes opening the same file, whether they were forked from one
+    another or not. Access is serialized with ``lockf`` where the
+    :mod:`fcntl` module is available.
+
+    If the file was not written by a storage with the same *maxBytes* and
+    *slotSize*, it is replaced by an empty one. Processes still using the
+    old file (such as the workers of a previous deployment) keep using it
+    undisturbed. A lock file next to it, at *path* with ``.lock``
+    appended, makes sure that only one process replaces it.
+    """
+
+    _header = struct.Struct('<8sQQQQQ')
+    _magic = b'ZVFILE02'
+
+    def __init__(self, path, maxBytes=64 * 1024 * 1024, slotSize=4096):
+        self.path = path
+        super().__init__(maxBytes, slotSize)
+
+    def _open(self, size):
+        lockFd = os.open(self.path + '.lock', os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            with _FileLock(lockFd):
+                fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+                map_ = self._mapValid(fd, size)
+                if map_ is None:
+                    os.close(fd)
+                    fd = self._create(size)
+                    map_ = mmap.mmap(fd, size)
+        finally:
+            os.close(lockFd)
+        self._fd = fd
+        self._lock = _FileLock(fd)
+        return map_
+
+    def _mapValid(self, fd, size):
+        """Return a map of the file *fd* if it has the right layout."""
+        if os.fstat(fd).st_size != size:
+            return None
+        map_ = mmap.mmap(fd, size)
+        header = self._header.unpack_from(map_, 0)
+        if header[0] == self._magic and \
+                header[4:] == (self.slotSize, self.slots):
+            return map_
+        map_.close()
+        return None
+
+    def _create(self, size):
+        """Replace the file by an empty one and return its descriptor."""
+        # Other processes may have mapped the old file. Changing its size
+        # would make them crash accessing the memory beyond its new end,
+        # so it is replaced instead.
+        fd, temporary = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(self.path)), suffix='.tmp')
+        try:
+            os.ftruncate(fd, size)
+            with mmap.mmap(fd, size) as map_:
+                self._header.pack_into(
+                    map_, 0, self._magic, 0, 0, 0, self.slotSize,
+                    self.slots)
+            os.replace(temporary, self.path)
+        except BaseException:
+            os.close(fd)
+            os.unlink(temporary)
+            raise
+        return fd
+
+    def flush(self):
+        """Write the stored output to the file."""
+        self._map.flush()
+
+    def close(self):
+        """Write the stored output to the file and close it."""
+        self._map.flush()
+        self._map.close()
+        os.close(self._fd)
+
+
+@zope.interface.implementer(interfaces.IViewletCacheStorage)
+class KeyValueCacheStorage(CacheStorageBase):
+    """A storage in an external key-value store.
+
+    *client* is expected to have the ``get(key)``, ``set(key, value)``,
+    ``delete(key)`` and ``flush_all()`` methods of the common memcached
+    clients, taking string keys and bytes values. If it also has a
+    ``stats()`` method returning a dictionary, the ``evictions``,
+    ``entries`` and ``size`` reported by it are used in `statistics`.
+
+    As external stores usually restrict the length and characters of
+    keys, the stored keys are hashes prefixed with *prefix*. The byte
+    budget of the store is configured on the store itself; *maxBytes*
+    is the size of the largest value that is sent to it.
+    """
+
+    def __init__(self, client, prefix='zope.viewlet:',
+                 maxBytes=1024 * 1024):
+        self.client = client
+        self.prefix = prefix
+        self.maxBytes = maxBytes
+
+    def _key(self, key):
+        return self.prefix + _digest(key).hex()
+
+    def get(self, key):
+        data = self.client.get(self._key(key))
+        if data is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return data.decode('utf-8')
+
+    def set(self, key, value):
+        data = value.encode('utf-8')
+        if len(data) > self.maxBytes:
+            self.invalidate(key)
+            return
+        self.client.set(self._key(key), data)
+
+    def invalidate(self, key):
+        self.client.delete(self._key(key))
+
+    def clear(self):
+        self.client.flush_all()
+
+    def statistics(self):
+        stats = {}
+        if hasattr(self.client, 'stats'):
+            stats = self.client.stats()
+        result = self._statistics(
+            stats.get('entries', 0), stats.get('size', 0))
+        result['evictions'] = stats.get('evictions', 0)
+        return result
+
+
+class MemoryKeyValueClient:
+    """An in-process stand-in for an external key-value store client.
+
+    It has the API expected by `KeyValueCacheStorage` and, like a real
+    store, only accepts bytes values and evicts the least recently used
+    values once *maxBytes* are stored.
+    """
+
+    def __init__(self, maxBytes=64 * 1024 * 1024):
+        self._storage = LRUCacheStorage(maxBytes)
+
+    def get(self, key):
+        return self._storage.get(key)
+
+    def set(self, key, value):
+        if not isinstance(value, bytes):
+            raise TypeError('Values must be bytes, not %r' % type(value))
+        self._storage.set(key, value)
+
+    def delete(self, key):
+        self._storage.invalidate(key)
+
+    def flush_all(self):
+        self._storage.clear()
+
+    def stats(self):
+        return self._storage.statistics()
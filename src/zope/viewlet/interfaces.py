@@ -18,6 +18,8 @@ __docformat__ = 'restructuredtext'
 import zope.interface
 from zope.contentprovider.interfaces import IContentProvider
 from zope.i18nmessageid import MessageFactory
+from zope.interface.interfaces import IObjectEvent
+from zope.interface.interfaces import ObjectEvent
 
 
 _ = MessageFactory('zope')
@@ -57,3 +59,167 @@ class IViewletManager(IContentProvider,
 
       (5) Render itself containing the HTML content of the viewlets.
     """
+
+
+class ICacheableViewlet(IViewlet):
+    """A viewlet whose output can be cached by its viewlet manager.
+
+    The viewlet manager only consults the cache if it has been given a
+    :class:`cache storage <IViewletCacheStorage>`.
+    """
+
+    def cacheKey():
+        """Return a string identifying the output of the viewlet.
+
+        This is called *before* ``update()``, so it must be cheap. When the
+        manager finds an entry for the key, neither ``update()`` nor
+        ``render()`` are called. Return ``None`` if the output should not
+        be cached.
+        """
+
+
+class IValidatedViewlet(IViewlet):
+    """A viewlet reporting what its output depends on before rendering.
+
+    Viewlet managers combine these into a validator for their output (see
+    :mod:`zope.viewlet.validators`), which allows answering conditional
+    requests without updating and rendering any viewlet. Viewlets may
+    implement either method or both.
+    """
+
+    def validationToken():
+        """Return a string that changes whenever the output changes.
+
+        This is called *before* ``update()``, so it must be cheap. Return
+        ``None`` if the output cannot be validated.
+        """
+
+    def lastModified():
+        """Return when the output last changed.
+
+        Either a timezone aware `datetime.datetime` or seconds since the
+        epoch. This is called *before* ``update()``, so it must be cheap.
+        Return ``None`` if the time is not known.
+        """
+
+
+class IUpdateDependentViewlet(IViewlet):
+    """A viewlet using the state of other viewlets of its manager.
+
+    Viewlet managers update the viewlets named in `updateDependencies`
+    before this viewlet, and may update viewlets that do not depend on
+    each other in parallel.
+    """
+
+    updateDependencies = zope.interface.Attribute(
+        """The names of the viewlets to update before this one
+
+        Either a sequence of names or a string of whitespace separated
+        names, which allows setting it with the ``viewlet`` directive.
+        """)
+
+
+class IPrioritizedViewlet(IViewlet):
+    """A viewlet with a render priority.
+
+    A :class:`zope.viewlet.manager.PriorityViewletManager` updates and
+    renders the viewlets with a high `priority` first, regardless of their
+    weight, and returns their output as soon as possible.
+    """
+
+    priority = zope.interface.Attribute(
+        """The render priority of the viewlet, an integer
+
+        Strings of digits are accepted too, which allows setting it with
+        the ``viewlet`` directive.
+        """)
+
+
+class IPrerenderedViewlet(IViewlet):
+    """A viewlet whose output can be rendered in another process.
+
+    Its output must only depend on its `prerenderInputs`, which allows
+    viewlet managers with a :class:`zope.viewlet.prerender.Prerenderer` to
+    have it rendered from them by `renderInputs` in other processes.
+
+    Prerendered viewlets may also have a ``prerenderStaleKey()`` method
+    returning a string identifying what the output shows, such as the
+    path of the object a menu is for. Only then may the output rendered
+    for older inputs with the same key be shown while the output for new
+    inputs is rendered.
+    """
+
+    prerender = zope.interface.Attribute(
+        """Whether the viewlet is prerendered
+
+        Set by the ``viewlet`` directive from its ``prerender`` attribute.
+        """)
+
+    def prerenderInputs():
+        """Return picklable data describing everything the output uses."""
+
+    def renderInputs(inputs):
+        """Return the output for *inputs*.
+
+        A class or static method of a class that other processes can
+        import; it is called without the viewlet, its request and context.
+        """
+
+
+class IViewletCacheStorage(zope.interface.Interface):
+    """A storage for rendered viewlet output.
+
+    Keys and values are text. Storages have a byte budget; values are
+    evicted when it is exceeded.
+    """
+
+    maxBytes = zope.interface.Attribute(
+        """The maximum number of bytes the stored values may occupy.""")
+
+    def get(key):
+        """Return the value stored for *key*, or ``None``."""
+
+    def set(key, value):
+        """Store *value* for *key*, evicting other entries if necessary.
+
+        Values larger than the byte budget are not stored.
+        """
+
+    def invalidate(key):
+        """Remove the value for *key*, if any."""
+
+    def clear():
+        """Remove all values."""
+
+    def statistics():
+        """Return a dictionary describing the storage.
+
+        It contains at least the ``hits``, ``misses`` and ``evictions``
+        counters, the number of ``entries``, their ``size`` in bytes and
+        the ``maxBytes`` budget.
+        """
+
+
+class IBeforeUpdateViewletsEvent(IObjectEvent):
+    """The viewlets of a viewlet manager (the ``object``) will be updated.
+
+    Fired by viewlet managers with ``batchUpdateEvents`` set instead of a
+    :class:`zope.contentprovider.interfaces.IBeforeUpdateEvent` for each
+    viewlet.
+    """
+
+    viewlets = zope.interface.Attribute(
+        """The viewlets that will be updated, in order""")
+
+    request = zope.interface.Attribute(
+        """The request in which the viewlets are updated""")
+
+
+@zope.interface.implementer(IBeforeUpdateViewletsEvent)
+class BeforeUpdateViewletsEvent(ObjectEvent):
+    """Default implementation of `IBeforeUpdateViewletsEvent`."""
+
+    def __init__(self, manager, viewlets, request=None):
+        super().__init__(manager)
+        self.viewlets = viewlets
+        self.request = request
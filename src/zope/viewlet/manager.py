@@ -12,18 +12,278 @@
 #
 ##############################################################################
 """Content Provider Manager implementation
+
+Viewlet managers are created per request and must only be used by one
+thread at a time (apart from the workers of an
+`~ViewletManagerBase.updateExecutor`). The caches they share between
+requests are safe to use from any number of threads, also without the
+global interpreter lock, and reading them never waits for other threads:
+
+- `subscriberCache` and `lookupCache` keep their data per adapter
+  registry in a mapping that is replaced, never changed, when a
+  registry is added or changes (copy on write);
+- the render plans of templates and the versions of templates and
+  resources are computed without locking, as computing them twice
+  yields the same result;
+- :class:`~zope.viewlet.stats.ViewletStatistics` and the statistics of
+  :mod:`zope.viewlet.memo` count in per-thread shards, which are only
+  merged when read.
 """
 __docformat__ = 'restructuredtext'
 
+import concurrent.futures
+import functools
+import sys
+import threading
+import time
+
 import zope.component
 import zope.event
 import zope.interface
 import zope.security
+import zope.security.management
 from zope.browserpage import ViewPageTemplateFile
+from zope.component.hooks import getSite
+from zope.component.hooks import setSite
 from zope.contentprovider.interfaces import BeforeUpdateEvent
 from zope.location.interfaces import ILocation
 
+from zope.viewlet import cache
 from zope.viewlet import interfaces
+from zope.viewlet import memory
+from zope.viewlet import plan
+from zope.viewlet import precompute
+from zope.viewlet import recording
+from zope.viewlet import validators
+
+
+def canRender(viewlet):
+    """
+    Return whether the ``render`` method of *viewlet* can be accessed.
+
+    Classes generated by the ``viewlet`` directive with a public
+    ``render`` are marked with a true ``__public_render__`` attribute;
+    for those we do not need to consult
+    `zope.security.checker.canAccess`. The marker is only honoured on
+    the class itself, not on subclasses, which may be protected
+    differently.
+    """
+    if type(viewlet).__dict__.get('__public_render__', False):
+        return True
+    return zope.security.canAccess(viewlet, 'render')
+
+
+class RegistryCache:
+    """
+    Base class of caches of what is registered in the adapter registry of
+    the current site, which is forgotten whenever that registry changes.
+
+    The data of each registry is kept in a mapping that is replaced as a
+    whole when a registry is added or changes, so that readers never see
+    it changing.
+    """
+
+    #: If there are more registries than this, the data of the others is
+    #: forgotten when another one is added.
+    maxRegistries = 100
+
+    def __init__(self):
+        self.clear()
+
+    def _newData(self):
+        raise NotImplementedError
+
+    def _data(self, adapters=None):
+        """Return the data of the registry *adapters* (or the current one)."""
+        if adapters is None:
+            adapters = zope.component.getSiteManager().adapters
+        states = self._states
+        state = states.get(id(adapters))
+        if state is None or state[0] is not adapters or \
+                state[1] != adapters._generation:
+            state = (adapters, adapters._generation, self._newData())
+            states = dict(states) if len(states) < self.maxRegistries else {}
+            states[id(adapters)] = state
+            self._states = states
+        return state[2]
+
+    def clear(self):
+        self._states = {}
+
+
+class SubscriberCache(RegistryCache):
+    """
+    Remembers whether notifying events reaches any subscriber.
+
+    Only handlers registered with the component registry (and dispatched
+    by `zope.component.event`) can be known; if there are other
+    `zope.event.subscribers`, all events are assumed to have subscribers.
+    What is remembered is forgotten whenever the adapter registry of the
+    current site changes.
+    """
+
+    _newData = dict
+
+    def hasSubscribers(self, obj, eventClass):
+        """
+        Return whether notifying an event of *eventClass* with *obj* as
+        its ``object`` would reach any subscriber.
+        """
+        subscribers = zope.event.subscribers
+        if not subscribers:
+            return False
+        event = sys.modules.get('zope.component.event')
+        if len(subscribers) > 1 or subscribers[0] is not getattr(
+                event, 'dispatch', None):
+            return True
+        adapters = zope.component.getSiteManager().adapters
+        data = self._data(adapters)
+        key = (zope.interface.providedBy(obj), eventClass)
+        found = data.get(key)
+        if found is None:
+            eventSpec = zope.interface.implementedBy(eventClass)
+            handlers = adapters.subscriptions([eventSpec], None)
+            found = any(handler is not event.objectEventNotify
+                        for handler in handlers)
+            if not found and handlers:
+                # Only objectEventNotify, which dispatches again for the
+                # object and the event.
+                found = bool(adapters.subscriptions([key[0], eventSpec],
+                                                    None))
+            data[key] = found
+        return found
+
+
+subscriberCache = SubscriberCache()
+
+# Maps viewlet manager classes to the render plans of their templates.
+_renderPlans = {}
+
+
+class LookupCache(RegistryCache):
+    """
+    Remembers for which names and interfaces no viewlet is registered.
+
+    What is remembered is forgotten whenever the adapter registry of the
+    current site changes.
+    """
+
+    #: No more misses than this are remembered per registry generation.
+    maxEntries = 10000
+
+    _newData = set
+
+    def isMissing(self, specs, name):
+        """
+        Return whether it is known that no viewlet called *name* is
+        registered for the interfaces *specs* provided by the context,
+        request, view and manager.
+        """
+        return (specs, name) in self._data()
+
+    def check(self, specs, name):
+        """
+        Remember if no viewlet called *name* is registered for *specs*.
+
+        Called when looking a viewlet up returned nothing, which may also
+        be because its factory returned ``None``.
+        """
+        adapters = zope.component.getSiteManager().adapters
+        misses = self._data(adapters)
+        if len(misses) < self.maxEntries and adapters.lookup(
+                specs, interfaces.IViewlet, name) is None:
+            misses.add((specs, name))
+
+
+lookupCache = LookupCache()
+
+# Stand for viewlets that were not found and that may not be rendered in
+# the lookups remembered by viewlet managers.
+_NOT_FOUND = object()
+_UNAUTHORIZED = object()
+
+
+def updateWaves(viewlets, names):
+    """
+    Split *viewlets* into waves that can be updated in parallel.
+
+    *names* maps the ids of the viewlets to their names. Each viewlet is
+    put into a later wave than the viewlets named in its
+    ``updateDependencies`` (see
+    :class:`~zope.viewlet.interfaces.IUpdateDependentViewlet`); names of
+    viewlets not among *viewlets* are ignored. Within a wave, the
+    viewlets keep their order.
+
+    :raise ValueError: If the dependencies are cyclic.
+    """
+    byName = {names.get(id(viewlet)): viewlet for viewlet in viewlets}
+    dependencies = {}
+    for viewlet in viewlets:
+        declared = getattr(viewlet, 'updateDependencies', ())
+        if declared:
+            if isinstance(declared, str):
+                declared = declared.split()
+            dependencies[id(viewlet)] = {
+                id(byName[name]) for name in declared if name in byName}
+    if not dependencies:
+        return [viewlets] if viewlets else []
+
+    waves = []
+    done = set()
+    remaining = viewlets
+    while remaining:
+        wave = [viewlet for viewlet in remaining
+                if dependencies.get(id(viewlet), done) <= done]
+        if not wave:
+            raise ValueError(
+                'Cyclic update dependencies between the viewlets %s' %
+                ', '.join(sorted(str(names.get(id(viewlet)))
+                                 for viewlet in remaining)))
+        waves.append(wave)
+        done.update(id(viewlet) for viewlet in wave)
+        remaining = [viewlet for viewlet in remaining
+                     if id(viewlet) not in done]
+    return waves
+
+
+@zope.interface.implementer(zope.security.interfaces.IParticipation)
+class _Participation:
+    """
+    Takes the part of a participation of an interaction in the
+    interaction of another thread, as participations only belong to one.
+    """
+
+    interaction = None
+
+    def __init__(self, participation):
+        self.principal = participation.principal
+
+
+def inThreadContext(function):
+    """
+    Return a function calling *function* with the current site and in a
+    security interaction with the principals of the interaction of the
+    calling thread, for running it in another thread.
+    """
+    site = getSite()
+    interaction = zope.security.management.queryInteraction()
+
+    def run(*args):
+        previous = getSite()
+        setSite(site)
+        shared = interaction is not None and \
+            zope.security.management.queryInteraction() is None
+        if shared:
+            zope.security.management.newInteraction(*[
+                _Participation(participation)
+                for participation in interaction.participations])
+        try:
+            return function(*args)
+        finally:
+            if shared:
+                zope.security.management.endInteraction()
+            setSite(previous)
+    return run
 
 
 @zope.interface.implementer(interfaces.IViewletManager)
@@ -42,6 +302,73 @@ class ViewletManagerBase:
     #: Populated by `update`.
     viewlets = None
 
+    #: An optional :class:`~zope.viewlet.interfaces.IViewletCacheStorage`
+    #: used to store the output of viewlets providing
+    #: :class:`~zope.viewlet.interfaces.ICacheableViewlet`.
+    cacheStorage = None
+
+    #: If true, `update` and `render` measure the memory allocated by each
+    #: of their phases and viewlets into :attr:`memoryReport`, a
+    #: :class:`zope.viewlet.memory.MemoryReport`. This is expensive and
+    #: meant for finding the viewlets responsible for memory growth. The
+    #: numbers are only valid if one request at a time is profiled.
+    profileMemory = False
+    memoryReport = None
+    _profiler = None
+
+    #: If true, a single
+    #: :class:`~zope.viewlet.interfaces.BeforeUpdateViewletsEvent` is
+    #: fired before the viewlets are updated instead of a
+    #: :class:`~zope.contentprovider.interfaces.BeforeUpdateEvent` for
+    #: each of them.
+    batchUpdateEvents = False
+
+    #: An optional :class:`concurrent.futures.Executor` used to update
+    #: viewlets that do not depend on each other in parallel (see
+    #: `updateWaves`). The site and security interaction are passed on to
+    #: the workers, but the viewlets' ``update()`` must be thread-safe.
+    updateExecutor = None
+
+    #: If true, the :attr:`template` is analysed when it is first used.
+    #: If it merely wraps the viewlets in static markup, it is replaced by
+    #: a :class:`zope.viewlet.plan.RenderPlan` producing the same output
+    #: without running the template.
+    compileTemplate = False
+
+    #: An optional :class:`zope.viewlet.prerender.Prerenderer` providing
+    #: the output of viewlets with a true ``prerender`` attribute (see
+    #: :class:`~zope.viewlet.interfaces.IPrerenderedViewlet`), which are
+    #: then not updated. Only used together with a :attr:`cacheStorage`.
+    prerenderer = None
+
+    #: An optional :class:`zope.viewlet.stats.ViewletStatistics` to which a
+    #: sample of the updates and renderings of the manager are added.
+    statistics = None
+
+    # Whether this update and rendering is measured for `statistics`.
+    _sampled = None
+
+    # Maps names to the results of looking them up with `__getitem__`.
+    _lookups = None
+
+    # Set by `renderRows`: the names and factories of the viewlets
+    # registered for the interfaces of the manager, and the mapping of
+    # viewlet classes to whether they can be rendered shared by the rows.
+    _factories = _renderable = None
+
+    # The viewlet classes that can always be rendered, according to the
+    # precomputed viewlets of `zope.viewlet.precompute`.
+    _public = frozenset()
+
+    # The filtered and sorted viewlets found by `validator`, which
+    # `update` uses instead of looking them up again.
+    _candidates = None
+
+    # Mappings from the ids of the active viewlets to their names, to
+    # their known output and to the cache keys their output has to be
+    # stored under. Populated by `update`.
+    _names = _fragments = _uncached = None
+
     def __init__(self, context, request, view):
         self.__updated = False
         self.__parent__ = view
@@ -54,20 +381,21 @@ class ViewletManagerBase:
         name.
 
         This takes into account security.
+
+        The result is remembered, so looking up the same name again
+        returns the same viewlet (the active one, after `update`) or
+        raises the same error.
         """
-        # Find the viewlet
-        viewlet = zope.component.queryMultiAdapter(
-            (self.context, self.request, self.__parent__, self),
-            interfaces.IViewlet, name=name)
+        viewlet = self._lookup(name)
 
         # If the viewlet was not found, then raise a lookup error
-        if viewlet is None:
+        if viewlet is _NOT_FOUND:
             raise zope.interface.interfaces.ComponentLookupError(
                 'No provider with name `%s` found.' % name)
 
         # If the viewlet cannot be accessed, then raise an
         # unauthorized error
-        if not zope.security.canAccess(viewlet, 'render'):
+        if viewlet is _UNAUTHORIZED:
             raise zope.security.interfaces.Unauthorized(
                 'You are not authorized to access the provider '
                 'called `%s`.' % name)
@@ -75,6 +403,36 @@ class ViewletManagerBase:
         # Return the viewlet.
         return viewlet
 
+    def _lookup(self, name):
+        """
+        Return the viewlet called *name*, `_NOT_FOUND` or `_UNAUTHORIZED`,
+        remembering the result.
+        """
+        lookups = self._lookups
+        if lookups is None:
+            lookups = self._lookups = {}
+        viewlet = lookups.get(name)
+        if viewlet is None:
+            viewlet = self._queryViewlet(name)
+            if viewlet is None:
+                viewlet = _NOT_FOUND
+            elif not canRender(viewlet):
+                viewlet = _UNAUTHORIZED
+            lookups[name] = viewlet
+        return viewlet
+
+    def _queryViewlet(self, name):
+        """Return the viewlet called *name*, or ``None``."""
+        objects = (self.context, self.request, self.__parent__, self)
+        specs = tuple(map(zope.interface.providedBy, objects))
+        if lookupCache.isMissing(specs, name):
+            return None
+        viewlet = zope.component.queryMultiAdapter(
+            objects, interfaces.IViewlet, name=name)
+        if viewlet is None:
+            lookupCache.check(specs, name)
+        return viewlet
+
     def get(self, name, default=None):
         """
         Return a viewlet registered for this object having
@@ -84,11 +442,17 @@ class ViewletManagerBase:
 
         If no such viewlet can be found, returns *default*.
         """
-        try:
-            return self[name]
-        except (zope.interface.interfaces.ComponentLookupError,
-                zope.security.interfaces.Unauthorized):
+        if type(self).__getitem__ is not ViewletManagerBase.__getitem__:
+            # Respect the lookup of subclasses.
+            try:
+                return self[name]
+            except (zope.interface.interfaces.ComponentLookupError,
+                    zope.security.interfaces.Unauthorized):
+                return default
+        viewlet = self._lookup(name)
+        if viewlet is _NOT_FOUND or viewlet is _UNAUTHORIZED:
             return default
+        return viewlet
 
     def __contains__(self, name):
         """See zope.interface.common.mapping.IReadMapping"""
@@ -106,11 +470,28 @@ class ViewletManagerBase:
             viewlet)``.  By default, this method checks with
             `zope.security.checker.canAccess` to see if the
             ``render`` method of a viewlet can be used to
-            determine availability.
+            determine availability (see `canRender`).
         """
         # Only return viewlets accessible to the principal
         return [(name, viewlet) for name, viewlet in viewlets
-                if zope.security.canAccess(viewlet, 'render')]
+                if self._canRender(viewlet)]
+
+    def _canRender(self, viewlet):
+        """
+        Like `canRender`, but shared by the rows of `renderRows` and
+        knowing the precomputed public viewlet classes.
+        """
+        if type(viewlet) in self._public:
+            return True
+        renderable = self._renderable
+        if renderable is None:
+            return canRender(viewlet)
+        class_ = type(viewlet)
+        try:
+            return renderable[class_]
+        except KeyError:
+            result = renderable[class_] = canRender(viewlet)
+            return result
 
     def sort(self, viewlets):
         """Sort the viewlets.
@@ -120,7 +501,7 @@ class ViewletManagerBase:
         # By default, we are not sorting by viewlet name.
         return sorted(viewlets, key=lambda x: x[0])
 
-    def update(self):
+    def update(self, names=None):
         """
         Update the viewlet manager for rendering.
 
@@ -135,34 +516,346 @@ class ViewletManagerBase:
            :class:`~zope.location.interfaces.ILocation` with a name.
         5. Set :attr:`viewlets` to the found set of active viewlets.
         6. Fire :class:`.BeforeUpdateEvent` for each active viewlet before
-           calling ``update()`` on it.
+           calling ``update()`` on it (or one
+           :class:`~.BeforeUpdateViewletsEvent` for all of them if
+           :attr:`batchUpdateEvents` is set), unless nothing subscribes to
+           the event.
+
+        If :data:`zope.viewlet.recording.enabled` is true, a record of the
+        update is logged for :mod:`zope.viewlet.replay`. If
+        :attr:`profileMemory` is true, the memory allocated by the phases of
+        the update is added to a new :attr:`memoryReport`.
+
+        :keyword names: If given, only the viewlets with these names are
+            looked up (like with ``manager[name]``), filtered, sorted and
+            updated. This is useful for refreshing only a part of the
+            manager, for example in response to an AJAX request. Unknown
+            names are ignored.
 
         ..  seealso:: :class:`zope.contentprovider.interfaces.IContentProvider`
         """
         self.__updated = True
+        if recording.enabled:
+            recording.record(self)
 
-        # Find all content providers for the region
-        viewlets = zope.component.getAdapters(
-            (self.context, self.request, self.__parent__, self),
-            interfaces.IViewlet)
+        if not self.profileMemory:
+            self._update(names)
+            return
+        self.memoryReport = memory.MemoryReport(getattr(self, '__name__', ''))
+        with memory.MemoryProfiler(self.memoryReport) as self._profiler:
+            try:
+                self._update(names)
+            finally:
+                self._profiler = None
 
-        viewlets = self.filter(viewlets)
+    def _update(self, names):
+        candidates, self._candidates = self._candidates, None
+        if names is None and candidates is not None and \
+                self._profiler is None:
+            self._activate(candidates)
+            return
+        viewlets = self._filterViewlets(self._findViewlets(names))
         viewlets = self.sort(viewlets)
+        self._activate(viewlets)
+
+    def _isSampled(self):
+        """Return whether to add this manager to the `statistics`."""
+        if self._sampled is None:
+            statistics = self.statistics
+            self._sampled = statistics is not None and statistics.sample()
+        return self._sampled
+
+    def _filterViewlets(self, viewlets):
+        """Call `filter`, adding the availability to the `statistics`."""
+        if not self._isSampled():
+            return self.filter(viewlets)
+        viewlets = list(viewlets)
+        available = self.filter(viewlets)
+        self.statistics.addAvailability(
+            getattr(self, '__name__', ''),
+            [name for name, _viewlet in viewlets],
+            [name for name, _viewlet in available])
+        return available
+
+    def _findViewlets(self, names):
+        """
+        Return the names and instances of the viewlets called *names* (or
+        of all viewlets), before filtering and sorting.
+        """
+        if names is None:
+            factories = self._factories
+            if factories is None and self._profiler is None:
+                precomputed = precompute.lookup(self)
+                if precomputed is not None:
+                    factories = precomputed.factories
+                    self._public = precomputed.public
+            if self._profiler is not None:
+                viewlets = self._profiledAdapters()
+            elif factories is not None:
+                objects = (self.context, self.request, self.__parent__, self)
+                viewlets = [(name, factory(*objects))
+                            for name, factory in factories]
+                viewlets = [(name, viewlet) for name, viewlet in viewlets
+                            if viewlet is not None]
+            else:
+                # Find all content providers for the region
+                viewlets = zope.component.getAdapters(
+                    (self.context, self.request, self.__parent__, self),
+                    interfaces.IViewlet)
+        else:
+            viewlets = [(name, self._queryViewlet(name)) for name in names]
+            viewlets = [(name, viewlet) for name, viewlet in viewlets
+                        if viewlet is not None]
+        return viewlets
+
+    def _activate(self, viewlets):
+        """Make the filtered and sorted *viewlets* active and update them."""
         # Just use the viewlets from now on
         self.viewlets = []
+        self._names = {}
+        if self._lookups is None:
+            self._lookups = {}
         for name, viewlet in viewlets:
             if ILocation.providedBy(viewlet):
                 viewlet.__name__ = name
+            self._names[id(viewlet)] = name
+            self._lookups[name] = viewlet
             self.viewlets.append(viewlet)
         self._updateViewlets()
 
+    def validator(self):
+        """
+        Return the :class:`~zope.viewlet.validators.Validator` combining
+        those of the viewlets that would be rendered (see
+        :class:`~zope.viewlet.interfaces.IValidatedViewlet`), or ``None``
+        if one of them does not report any.
+
+        This finds, filters and sorts the viewlets, but does not update
+        them; a following `update` uses the same viewlets. The version of
+        the template of each viewlet is part of the validator, so that
+        deploying a new template changes it.
+        """
+        if self._candidates is None:
+            viewlets = self._filterViewlets(self._findViewlets(None))
+            self._candidates = self.sort(viewlets)
+        return validators.combine(
+            (self._registrationKey(viewlet, name),
+             validators.viewletValidator(viewlet))
+            for name, viewlet in self._candidates)
+
+    def _profiledAdapters(self):
+        """
+        Like `zope.component.getAdapters`, but measuring the memory used
+        to look up and to instantiate the viewlets separately.
+        """
+        objects = (self.context, self.request, self.__parent__, self)
+        adapters = zope.component.getSiteManager().adapters
+        with self._profiler.measure('lookup'):
+            factories = list(adapters.lookupAll(
+                list(map(zope.interface.providedBy, objects)),
+                interfaces.IViewlet))
+        viewlets = []
+        for name, factory in factories:
+            with self._profiler.measure('instantiate', name):
+                viewlet = factory(*objects)
+            if viewlet is not None:
+                viewlets.append((name, viewlet))
+        return viewlets
+
     def _updateViewlets(self):
-        """Calls update on all viewlets and fires events"""
+        """Calls update on all viewlets and fires events
+
+        Viewlets whose output is found in the :attr:`cacheStorage` are
+        neither updated nor rendered. For the others, the dependencies
+        declared with `zope.viewlet.cache.dependsOn` are recorded. The
+        output of prerendered viewlets is taken from the
+        :attr:`prerenderer`.
+
+        Viewlets are updated after the viewlets named in their
+        ``updateDependencies``, in waves (see `updateWaves`) which are
+        run on the :attr:`updateExecutor` if there is one.
+        """
+        self._fragments = {}
+        self._uncached = {}
+        storage = self.cacheStorage
+        pending = []
+        prerenderer = self.prerenderer if storage is not None else None
         for viewlet in self.viewlets:
+            key = None
+            if prerenderer is not None and getattr(
+                    viewlet, 'prerender', False):
+                output = prerenderer.fragment(
+                    viewlet, self._registrationKey(viewlet), storage)
+                if output is not None:
+                    self._fragments[id(viewlet)] = output
+                    continue
+            if storage is not None:
+                key = self._cacheKey(viewlet)
+                if key is not None:
+                    output = storage.get(key)
+                    if output is not None:
+                        self._fragments[id(viewlet)] = output
+                        continue
+            pending.append((viewlet, key))
+        if self.batchUpdateEvents and pending:
+            self._notifyBatch([viewlet for viewlet, _key in pending])
+
+        keys = {id(viewlet): key for viewlet, key in pending}
+        executor = self.updateExecutor
+        if self._profiler is not None:
+            # Allocations can only be attributed in a single thread.
+            executor = None
+        self._updatePending(
+            [viewlet for viewlet, _key in pending], keys, executor)
+
+    def _updatePending(self, viewlets, keys, executor):
+        """
+        Update the *viewlets* whose output is not known, in waves, on
+        *executor* if it is not ``None``. *keys* maps their ids to the
+        keys their output is to be cached under.
+        """
+        for wave in updateWaves(viewlets, self._names):
+            if executor is None or len(wave) == 1:
+                for viewlet in wave:
+                    self._updateCacheable(viewlet, keys[id(viewlet)])
+                continue
+            run = inThreadContext(self._updateCacheable)
+            futures = [executor.submit(run, viewlet, keys[id(viewlet)])
+                       for viewlet in wave]
+            for future in futures:
+                future.result()
+
+    def _updateCacheable(self, viewlet, key):
+        """
+        Update a single viewlet, recording the dependencies of its output
+        if it is to be cached under *key*.
+        """
+        if key is None:
+            self._updateViewlet(viewlet)
+            return
+        with cache.DependencyRecorder() as recorder:
+            self._updateViewlet(viewlet)
+        self._uncached[id(viewlet)] = (key, recorder)
+
+    def _notifyBatch(self, viewlets):
+        """Fires the event for updating all of *viewlets*"""
+        if not subscriberCache.hasSubscribers(
+                self, interfaces.BeforeUpdateViewletsEvent):
+            return
+        event = interfaces.BeforeUpdateViewletsEvent(
+            self, viewlets, self.request)
+        if self._profiler is None:
+            zope.event.notify(event)
+            return
+        with self._profiler.measure('event'):
+            zope.event.notify(event)
+
+    def _updateViewlet(self, viewlet):
+        """Fires the event for and calls update on a single viewlet
+
+        The event is neither created nor fired if nothing subscribes to it
+        (see `SubscriberCache`) or if :attr:`batchUpdateEvents` is set.
+        """
+        notify = not self.batchUpdateEvents and \
+            subscriberCache.hasSubscribers(viewlet, BeforeUpdateEvent)
+        profiler = self._profiler
+        if profiler is not None:
+            name = self._names.get(id(viewlet))
+            if notify:
+                with profiler.measure('event', name):
+                    zope.event.notify(
+                        BeforeUpdateEvent(viewlet, self.request))
+            with profiler.measure('update', name):
+                viewlet.update()
+            return
+        if notify:
             zope.event.notify(BeforeUpdateEvent(viewlet, self.request))
-            viewlet.update()
+        viewlet.update()
+
+    def _renderViewlet(self, viewlet):
+        """Render a single viewlet"""
+        profiler = self._profiler
+        if profiler is None:
+            if not self._sampled:
+                return viewlet.render()
+            start = time.perf_counter()
+            output = viewlet.render()
+            seconds = time.perf_counter() - start
+            self.statistics.addRendering(
+                getattr(self, '__name__', ''),
+                (self._names or {}).get(id(viewlet)), seconds,
+                len(output.encode('utf-8')) if isinstance(output, str)
+                else 0)
+            return output
+        with profiler.measure('render', self._names.get(id(viewlet))):
+            return viewlet.render()
+
+    def _cacheKey(self, viewlet):
+        """Return the key the output of *viewlet* is cached under.
+
+        The key identifies the registration of the viewlet, the version of
+        its template (see `zope.viewlet.cache.templateVersion`) and the
+        key returned by its ``cacheKey()``.
+        """
+        cacheKey = getattr(viewlet, 'cacheKey', None)
+        if cacheKey is None:
+            return None
+        key = cacheKey()
+        if key is None:
+            return None
+        return '{}/{}'.format(self._registrationKey(viewlet), key)
 
-    def render(self):
+    def _registrationKey(self, viewlet, name=None):
+        """
+        Return a string identifying the registration of *viewlet* (called
+        *name*, if known) and the version of its template.
+        """
+        if name is None:
+            name = (self._names or {}).get(id(viewlet))
+        if name is None:
+            name = getattr(viewlet, '__name__', '')
+        class_ = type(viewlet)
+        return '{}/{}/{}.{}/{}'.format(
+            getattr(self, '__name__', ''), name,
+            class_.__module__, class_.__name__,
+            cache.templateVersion(class_))
+
+    def _renderFragments(self):
+        """
+        Return the active viewlets, with those whose output is known
+        replaced by a `RenderedViewlet`.
+
+        The output of cacheable viewlets that were not found in the
+        :attr:`cacheStorage` is rendered and stored.
+        """
+        viewlets = []
+        for viewlet in self.viewlets:
+            output = self._renderFragment(viewlet)
+            if output is None:
+                viewlets.append(viewlet)
+            else:
+                viewlets.append(RenderedViewlet(viewlet, output))
+        return viewlets
+
+    def _renderFragment(self, viewlet):
+        """
+        Return the known output of *viewlet*, rendering and storing it
+        first if it is cacheable, or ``None`` if it is not cacheable.
+        """
+        output = self._fragments.get(id(viewlet))
+        if output is None:
+            uncached = self._uncached.pop(id(viewlet), None)
+            if uncached is None:
+                return None
+            key, recorder = uncached
+            with recorder:
+                output = self._renderViewlet(viewlet)
+            self._fragments[id(viewlet)] = output
+            self.cacheStorage.set(key, output)
+            cache.dependencies.register(self.cacheStorage, key, recorder)
+        return output
+
+    def render(self, names=None):
         """
         Render the active viewlets.
 
@@ -172,15 +865,196 @@ class ViewletManagerBase:
         .. note:: If a :attr:`template` is provided, it will be called
            even if there are no :attr:`viewlets`.
 
+        :keyword names: If given, only the active viewlets with these
+            names are rendered, in the order of :attr:`viewlets`.
+
         ..  seealso:: :class:`zope.contentprovider.interfaces.IContentProvider`
         """
+        if self.memoryReport is None:
+            return self._render(names)
+        with memory.MemoryProfiler(self.memoryReport) as self._profiler:
+            try:
+                return self._render(names)
+            finally:
+                self._profiler = None
+
+    def _render(self, names):
+        viewlets = self.viewlets
+        if self._fragments or self._uncached:
+            viewlets = self._renderFragments()
+        if names is not None:
+            viewlets = self._selectViewlets(viewlets, names)
+
+        profiler = self._profiler
+        if profiler is not None:
+            # Render the viewlets one by one to attribute their memory,
+            # leaving the template with the rest.
+            viewlets = [
+                viewlet if isinstance(viewlet, RenderedViewlet)
+                else RenderedViewlet(viewlet, self._renderViewlet(viewlet))
+                for viewlet in viewlets]
+            with profiler.measure('render'):
+                return self._renderViewlets(viewlets)
+        if self._isSampled():
+            # Time the viewlets when the template renders them.
+            viewlets = [
+                viewlet if isinstance(viewlet, RenderedViewlet)
+                else MeasuredViewlet(viewlet, self._renderViewlet)
+                for viewlet in viewlets]
+        return self._renderViewlets(viewlets)
+
+    def _renderViewlets(self, viewlets):
         # Now render the view
         if self.template:
-            return self.template(viewlets=self.viewlets)
-        return '\n'.join([viewlet.render() for viewlet in self.viewlets])
+            if self.compileTemplate and 'template' not in self.__dict__:
+                renderPlan = self._renderPlan()
+                if renderPlan is not None:
+                    return self._renderWithPlan(renderPlan, viewlets)
+            return self.template(viewlets=viewlets)
+        return '\n'.join([viewlet.render() for viewlet in viewlets])
 
+    def _renderPlan(self):
+        """
+        Return the render plan for the template of this class, or ``None``
+        if it cannot be compiled.
+        """
+        class_ = type(self)
+        try:
+            return _renderPlans[class_]
+        except KeyError:
+            pass
+        renderPlan = None
+        template = getattr(class_, 'template', None)
+        filename = getattr(template, 'filename', None)
+        if filename is not None:
+            try:
+                with open(filename, encoding='utf-8') as f:
+                    source = f.read()
+            except (OSError, UnicodeDecodeError):
+                pass
+            else:
+                renderPlan = plan.compilePlan(
+                    source, lambda viewlets: self.template(viewlets=viewlets))
+        if renderPlan is not None:
+            # Looked up on the class, templates are bound to None.
+            template = getattr(template, '__func__', template)
+            renderPlan.contentType = getattr(template, 'content_type', None)
+        _renderPlans[class_] = renderPlan
+        return renderPlan
+
+    def _renderWithPlan(self, renderPlan, viewlets):
+        outputs = [viewlet.render() for viewlet in viewlets]
+        if not all(isinstance(output, str) for output in outputs):
+            # The template treats other values specially.
+            return self.template(viewlets=[
+                RenderedViewlet(viewlet, output)
+                for viewlet, output in zip(viewlets, outputs)])
+        # Like the template, set the content type if it is not set.
+        response = getattr(self.request, 'response', None)
+        if renderPlan.contentType and response is not None and \
+                not response.getHeader('Content-Type'):
+            response.setHeader('Content-Type', renderPlan.contentType)
+        return renderPlan.render(outputs)
 
-def ViewletManager(name, interface, template=None, bases=()):
+    @classmethod
+    def renderRows(cls, contexts, request, view, sharedSecurity=False):
+        """
+        Update and render a manager of this class for each of *contexts*,
+        with the same *request* and *view*, and return their outputs in
+        order.
+
+        This is meant for listings rendering the same manager for many
+        rows. The viewlets registered for the interfaces provided by the
+        objects are only looked up once per distinct interface set, not
+        once per row.
+
+        If *sharedSecurity* is true, whether viewlets can be rendered is
+        only checked once per viewlet class for all rows. Only use that if
+        the permissions of the principal do not depend on the context
+        (for example because of local roles).
+        """
+        adapters = zope.component.getSiteManager().adapters
+        requestSpec = zope.interface.providedBy(request)
+        viewSpec = zope.interface.providedBy(view)
+        plans = {}
+        renderable = {} if sharedSecurity else None
+        outputs = []
+        for context in contexts:
+            manager = cls(context, request, view)
+            specs = (zope.interface.providedBy(context), requestSpec,
+                     viewSpec, zope.interface.providedBy(manager))
+            factories = plans.get(specs)
+            if factories is None:
+                factories = plans[specs] = tuple(
+                    adapters.lookupAll(specs, interfaces.IViewlet))
+            manager._factories = factories
+            manager._renderable = renderable
+            manager.update()
+            outputs.append(manager.render())
+        return outputs
+
+    def _selectViewlets(self, viewlets, names):
+        """Return the *viewlets* (in order) whose names are in *names*."""
+        names = set(names)
+        byId = self._names or {}
+        selected = []
+        for viewlet, active in zip(viewlets, self.viewlets):
+            name = byId.get(id(active))
+            if name is None:
+                name = getattr(active, '__name__', None)
+            if name in names:
+                selected.append(viewlet)
+        return selected
+
+
+class RenderedViewlet:
+    """
+    Stands in for a viewlet whose output is already known, for example
+    because it was found in a cache.
+
+    All attributes but `update` and `render` are looked up on the
+    original *viewlet*.
+    """
+
+    def __init__(self, viewlet, output):
+        self.viewlet = viewlet
+        self.output = output
+
+    def __getattr__(self, name):
+        return getattr(self.viewlet, name)
+
+    def update(self):
+        pass
+
+    def render(self, *args, **kw):
+        return self.output
+
+    __call__ = render
+
+
+class MeasuredViewlet(RenderedViewlet):
+    """
+    Stands in for a *viewlet* that is rendered by calling *render* with
+    it, the first time it is rendered, so that its rendering can be
+    measured when the template of the manager asks for it.
+    """
+
+    output = None
+
+    def __init__(self, viewlet, render):
+        self.viewlet = viewlet
+        self._render = render
+
+    def render(self, *args, **kw):
+        if self.output is None:
+            self.output = self._render(self.viewlet)
+        return self.output
+
+    __call__ = render
+
+
+def ViewletManager(name, interface, template=None, bases=(),
+                   compileTemplate=False):
     """
     Create and return a new viewlet manager class that implements
     :class:`zope.viewlet.interfaces.IViewletManager`.
@@ -188,11 +1062,15 @@ def ViewletManager(name, interface, template=None, bases=()):
     :param str name: The name of the generated class.
     :param interface: The additional interface the class will implement.
     :keyword tuple bases: The base classes to extend.
+    :keyword bool compileTemplate: Whether to replace a simple *template*
+        by a render plan (see :attr:`ViewletManagerBase.compileTemplate`).
     """
 
     attrDict = {'__name__': name}
     if template is not None:
         attrDict['template'] = ViewPageTemplateFile(template)
+    if compileTemplate:
+        attrDict['compileTemplate'] = True
 
     if ViewletManagerBase not in bases:
         # Make sure that we do not get a default viewlet manager mixin, if the
@@ -226,7 +1104,7 @@ class WeightOrderedViewletManager(ViewletManagerBase):
         """
         return sorted(viewlets, key=getWeight)
 
-    def render(self):
+    def render(self, names=None):
         """
         Just like :meth:`ViewletManagerBase`, except that if there are no
         active viewlets in :attr:`viewlets`, we will not attempt to render
@@ -235,18 +1113,294 @@ class WeightOrderedViewletManager(ViewletManagerBase):
         # do not render a manager template if no viewlets are avaiable
         if not self.viewlets:
             return ''
-        return ViewletManagerBase.render(self)
+        return ViewletManagerBase.render(self, names)
+
+
+def getPriority(viewlet):
+    """Return the render ``priority`` of *viewlet*, or 0."""
+    try:
+        return int(viewlet.priority)
+    except AttributeError:
+        return 0
+
+
+def _startWaves(run, waves, keys, executor):
+    """
+    Run *run* for the viewlets of *waves* on *executor*, starting each
+    wave when the previous one is done, and return a mapping of the ids
+    of the viewlets to futures of their updates.
+
+    The waves are chained with callbacks, so that no worker waits for
+    others; if an update fails, the later waves are not run and their
+    futures fail too. So do the futures of the updates that *executor*
+    refuses to run (for example because it was shut down) or cancels,
+    and those of the later waves.
+    """
+    futures = {id(viewlet): concurrent.futures.Future()
+               for wave in waves for viewlet in wave}
+    lock = threading.Lock()
+
+    def start(index):
+        if index == len(waves):
+            return
+        wave = waves[index]
+        remaining = [len(wave)]
+        for position, viewlet in enumerate(wave):
+            try:
+                future = executor.submit(run, viewlet, keys[id(viewlet)])
+            except Exception as error:
+                # Raised in the callback of the previous wave, the error
+                # would only be logged, leaving the futures pending.
+                for other in wave[position:]:
+                    futures[id(other)].set_exception(error)
+                fail(index, error)
+                return
+            future.add_done_callback(
+                functools.partial(done, index, remaining, viewlet))
+
+    def fail(index, error):
+        for wave in waves[index + 1:]:
+            for other in wave:
+                futures[id(other)].set_exception(error)
+
+    def done(index, remaining, viewlet, future):
+        if future.cancelled():
+            # future.exception() would raise in the callback.
+            error = concurrent.futures.CancelledError()
+        else:
+            error = future.exception()
+        if error is None:
+            futures[id(viewlet)].set_result(None)
+        else:
+            futures[id(viewlet)].set_exception(error)
+        with lock:
+            remaining[0] -= 1
+            if remaining[0]:
+                return
+        failed = [futures[id(other)].exception() for other in waves[index]]
+        failed = [error for error in failed if error is not None]
+        if not failed:
+            start(index + 1)
+            return
+        fail(index, failed[0])
+
+    start(0)
+    return futures
+
+
+class PriorityViewletManager(WeightOrderedViewletManager):
+    """Weight ordered viewlet managers rendering important viewlets first.
+
+    Viewlets can have a render ``priority`` (see
+    :class:`~zope.viewlet.interfaces.IPrioritizedViewlet`) besides their
+    ``weight``. `update` only updates the viewlets with a priority of at
+    least `flushPriority` (and the viewlets they depend on). The others
+    are updated on the :attr:`~ViewletManagerBase.updateExecutor` in the
+    background, or, without an executor, when they are first needed for
+    rendering.
+
+    `iterRender` renders the important viewlets first and returns the
+    output in chunks, in the order of the weights, as soon as the
+    viewlets of each chunk are rendered. A page can thus send the output
+    of the viewlets at the top of a long page to the client while the
+    others are still being updated.
+    """
+
+    #: Viewlets with at least this priority are updated by `update` and
+    #: rendered first.
+    flushPriority = 1
+
+    # Maps the ids of the viewlets updated after `update` to the futures
+    # of their updates, or ``None`` if they are updated when needed.
+    _deferred = None
+    _deferredWaves = None
+
+    def _updatePending(self, viewlets, keys, executor):
+        names = self._names or {}
+        byName = {names.get(id(viewlet)): viewlet for viewlet in viewlets}
+        important = {id(viewlet) for viewlet in viewlets
+                     if getPriority(viewlet) >= self.flushPriority}
+        # Viewlets important viewlets depend on are important, too.
+        queue = [viewlet for viewlet in viewlets if id(viewlet) in important]
+        while queue:
+            declared = getattr(queue.pop(), 'updateDependencies', ())
+            if isinstance(declared, str):
+                declared = declared.split()
+            for name in declared or ():
+                other = byName.get(name)
+                if other is not None and id(other) not in important:
+                    important.add(id(other))
+                    queue.append(other)
+        super()._updatePending(
+            [viewlet for viewlet in viewlets if id(viewlet) in important],
+            keys, executor)
+
+        others = [viewlet for viewlet in viewlets
+                  if id(viewlet) not in important]
+        self._deferred = self._deferredWaves = None
+        if not others:
+            return
+        waves = updateWaves(others, self._names)
+        if executor is None:
+            self._deferredWaves = (waves, keys)
+        else:
+            self._deferred = _startWaves(
+                inThreadContext(self._updateCacheable), waves, keys, executor)
+
+    def _awaitUpdates(self):
+        """Wait until all viewlets are updated."""
+        if self._deferredWaves is not None:
+            waves, keys = self._deferredWaves
+            self._deferredWaves = None
+            for wave in waves:
+                for viewlet in wave:
+                    self._updateCacheable(viewlet, keys[id(viewlet)])
+        if self._deferred is not None:
+            deferred, self._deferred = self._deferred, None
+            for future in deferred.values():
+                future.result()
+
+    def _awaitUpdate(self, viewlet):
+        """Wait until *viewlet* is updated."""
+        if self._deferredWaves is not None:
+            if any(id(viewlet) == id(other)
+                   for wave in self._deferredWaves[0] for other in wave):
+                self._awaitUpdates()
+        elif self._deferred is not None:
+            future = self._deferred.get(id(viewlet))
+            if future is not None:
+                future.result()
+
+    def _render(self, names):
+        self._awaitUpdates()
+        return super()._render(names)
+
+    def iterRender(self):
+        """
+        Render the active viewlets like `render`, but return an iterator
+        of chunks of the output.
+
+        Without a template, each chunk is the output of a viewlet. With a
+        template, it must be a simple template (see
+        :mod:`zope.viewlet.plan`), whose static parts are added to the
+        chunks; other templates are rendered as a single chunk once all
+        viewlets are updated. The viewlets must render text.
+        """
+        if not self.viewlets:
+            return
+        renderPlan = None
+        if self.template:
+            if self.compileTemplate and 'template' not in self.__dict__:
+                renderPlan = self._renderPlan()
+            if renderPlan is None:
+                yield self.render()
+                return
+            response = getattr(self.request, 'response', None)
+            if renderPlan.contentType and response is not None and \
+                    not response.getHeader('Content-Type'):
+                response.setHeader('Content-Type', renderPlan.contentType)
+        prefix, separator, suffix = ('', '\n', '') if renderPlan is None \
+            else (renderPlan.prefix, renderPlan.separator, renderPlan.suffix)
+
+        outputs = {}
+        for viewlet in self.viewlets:
+            if getPriority(viewlet) >= self.flushPriority:
+                outputs[id(viewlet)] = self._renderOne(viewlet)
+        for index, viewlet in enumerate(self.viewlets):
+            output = outputs.pop(id(viewlet), None)
+            if output is None:
+                self._awaitUpdate(viewlet)
+                output = self._renderOne(viewlet)
+            yield (separator if index else prefix) + output
+        if suffix:
+            yield suffix
+
+    def _renderOne(self, viewlet):
+        output = None
+        if self._fragments or self._uncached:
+            output = self._renderFragment(viewlet)
+        if output is None:
+            output = self._renderViewlet(viewlet)
+        return output
 
 
 def isAvailable(viewlet):
     try:
-        return zope.security.canAccess(viewlet, 'render') and viewlet.available
+        return canRender(viewlet) and viewlet.available
     except AttributeError:
         return True
 
 
+class AvailabilityCache:
+    """
+    Remembers the availability of viewlets for a limited time.
+
+    Used by `ConditionalViewletManager` if its
+    `~ConditionalViewletManager.availabilityTimeout` is set.
+    """
+
+    #: Expired entries are only purged when there are more entries than
+    #: this.
+    maxEntries = 10000
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.clear()
+
+    def get(self, key, timeout, compute):
+        """
+        Return the availability remembered for *key*, or the result of
+        calling *compute*, which is then remembered for *timeout* seconds.
+        """
+        now = time.monotonic()
+        entry = self._data.get(key)
+        if entry is not None and entry[0] > now:
+            return entry[1]
+        available = compute()
+        with self._lock:
+            self._data[key] = (now + timeout, available)
+            if len(self._data) > self.maxEntries:
+                self._data = {key: entry for key, entry in self._data.items()
+                              if entry[0] > now}
+        return available
+
+    def clear(self):
+        with self._lock:
+            self._data = {}
+
+
+availabilityCache = AvailabilityCache()
+
+try:
+    from zope.testing.cleanup import addCleanUp
+except ImportError:  # pragma: no cover
+    pass
+else:
+    addCleanUp(availabilityCache.clear)
+    addCleanUp(subscriberCache.clear)
+    addCleanUp(_renderPlans.clear)
+    addCleanUp(lookupCache.clear)
+    del addCleanUp
+
+
 class ConditionalViewletManager(WeightOrderedViewletManager):
-    """Conditional weight ordered viewlet managers."""
+    """Conditional weight ordered viewlet managers.
+
+    Evaluating the ``available`` attribute of a viewlet can be expensive.
+    Viewlets can therefore provide an ``availabilityKey()`` method
+    returning a hashable key (or ``None``) that captures everything their
+    availability depends on, for example the UID of the context and the
+    principal. The availability is then only evaluated once per viewlet
+    class, key and request (or, if `availabilityTimeout` is set, per
+    viewlet class, key and timeout), even if the viewlet appears in
+    several managers.
+    """
+
+    #: If not ``None``, the number of seconds the availability of
+    #: viewlets with an ``availabilityKey()`` is remembered across
+    #: requests (see `availabilityCache`). By default it is only
+    #: remembered for the current request.
+    availabilityTimeout = None
 
     def filter(self, viewlets):
         """
@@ -256,4 +1410,41 @@ class ConditionalViewletManager(WeightOrderedViewletManager):
 
         """
         return [(name, viewlet) for name, viewlet in viewlets
-                if isAvailable(viewlet)]
+                if self._isAvailable(viewlet)]
+
+    def _isAvailable(self, viewlet):
+        # Whether the viewlet can be rendered is checked first, so that
+        # the availability key is only computed for viewlets that can.
+        try:
+            if not self._canRender(viewlet):
+                return False
+        except AttributeError:
+            return True
+        availabilityKey = getattr(viewlet, 'availabilityKey', None)
+        key = availabilityKey() if availabilityKey is not None else None
+        if key is None:
+            try:
+                return viewlet.available
+            except AttributeError:
+                return True
+        # Viewlets of other classes may return the same key.
+        key = (type(viewlet), key)
+
+        def compute():
+            try:
+                return bool(viewlet.available)
+            except AttributeError:
+                return True
+
+        if self.availabilityTimeout is not None:
+            return availabilityCache.get(
+                key, self.availabilityTimeout, compute)
+        annotations = getattr(self.request, 'annotations', None)
+        if annotations is None:
+            return compute()
+        memo = annotations.setdefault('zope.viewlet.availability', {})
+        try:
+            return memo[key]
+        except KeyError:
+            available = memo[key] = compute()
+            return available
@@ -0,0 +1,200 @@
+##############################################################################
+#
+# Copyright (c) 2026 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Values shared by the viewlets of a request.
+
+Viewlets often need the same expensive values, like the groups of the
+current user or the results of a catalog query. A `MemoKey` names such a
+value and declares its type; the first viewlet asking the `RequestMemo`
+of the request (``self.requestMemo`` of a
+:class:`~zope.viewlet.viewlet.ViewletBase`) for it computes it, all others
+get the same value::
+
+  GROUPS = MemoKey('groups', frozenset)
+
+  class GroupsViewlet(ViewletBase):
+
+      def update(self):
+          self.groups = self.requestMemo.get(GROUPS, self.computeGroups)
+
+How often values are computed and shared is counted per memo and, for
+all requests of the process, in `statistics`.
+"""
+__docformat__ = 'restructuredtext'
+
+import threading
+
+from zope.viewlet.stats import ThreadShards
+
+
+class MemoKey:
+    """
+    The key of a value shared in a `RequestMemo`.
+
+    Keys are compared by identity, so keys of different packages never
+    clash even if they have the same *name*, which is only used for
+    reporting. Values must be instances of *type*.
+    """
+
+    def __init__(self, name, type=object):
+        self.name = name
+        self.type = type
+
+    def __repr__(self):
+        return '<{} {!r} of {}>'.format(
+            self.__class__.__name__, self.name, self.type.__name__)
+
+
+class _Counts(dict):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+
+
+class MemoStatistics:
+    """
+    Counts the hits and misses of memos per key name.
+
+    Each thread counts on its own, so counting never waits for other
+    threads.
+    """
+
+    def __init__(self):
+        self._shards = ThreadShards(_Counts)
+
+    def count(self, key, hits=0, misses=0):
+        """Add *hits* and *misses* of *key*."""
+        shard = self._shards.get()
+        with shard.lock:
+            counts = shard.get(key.name)
+            if counts is None:
+                counts = shard[key.name] = [0, 0]
+            counts[0] += hits
+            counts[1] += misses
+
+    def _merged(self):
+        merged = {}
+        for shard in self._shards.all():
+            with shard.lock:
+                for name, (hits, misses) in shard.items():
+                    counts = merged.setdefault(name, [0, 0])
+                    counts[0] += hits
+                    counts[1] += misses
+        return merged
+
+    def hitRate(self, name=None):
+        """
+        Return the share of lookups of the key called *name* (or of all
+        keys) that were hits, or ``None`` if there were none.
+        """
+        merged = self._merged()
+        if name is None:
+            counts = merged.values()
+        else:
+            counts = [merged.get(name, (0, 0))]
+        hits = sum(hits for hits, _misses in counts)
+        total = hits + sum(misses for _hits, misses in counts)
+        return hits / total if total else None
+
+    def asDict(self):
+        """Return a mapping of key names to their hits and misses."""
+        return {name: {'hits': hits, 'misses': misses}
+                for name, (hits, misses) in self._merged().items()}
+
+    def clear(self):
+        self._shards.clear()
+
+
+#: The statistics of all memos of the process.
+statistics = MemoStatistics()
+
+
+class RequestMemo:
+    """Values shared by the viewlets of one request.
+
+    Safe to use from viewlets updated in parallel; a value computed by
+    two threads at once is only stored (and returned) once.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = {}
+        self.statistics = MemoStatistics()
+
+    def get(self, key, compute, *args):
+        """
+        Return the value of *key*, calling ``compute(*args)`` for it if it
+        is not known yet.
+
+        :raise TypeError: If the computed value is not of the type of
+            *key*.
+        """
+        try:
+            value = self._values[key]
+        except KeyError:
+            pass
+        else:
+            self._count(key, hits=1)
+            return value
+        value = compute(*args)
+        if not isinstance(value, key.type):
+            raise TypeError('{!r} computed a {}'.format(
+                key, type(value).__name__))
+        with self._lock:
+            value = self._values.setdefault(key, value)
+        self._count(key, misses=1)
+        return value
+
+    def set(self, key, value):
+        """Set the value of *key*."""
+        if not isinstance(value, key.type):
+            raise TypeError('{!r} set to a {}'.format(
+                key, type(value).__name__))
+        with self._lock:
+            self._values[key] = value
+
+    def __contains__(self, key):
+        return key in self._values
+
+    def _count(self, key, hits=0, misses=0):
+        self.statistics.count(key, hits, misses)
+        statistics.count(key, hits, misses)
+
+
+_ANNOTATION = 'zope.viewlet.memo'
+_lock = threading.Lock()
+
+
+def memoFor(request):
+    """
+    Return the `RequestMemo` of *request*, which is kept in its
+    ``annotations``. Requests without annotations get a new memo each
+    time.
+    """
+    annotations = getattr(request, 'annotations', None)
+    if annotations is None:
+        return RequestMemo()
+    memo = annotations.get(_ANNOTATION)
+    if memo is None:
+        with _lock:
+            memo = annotations.setdefault(_ANNOTATION, RequestMemo())
+    return memo
+
+
+try:
+    from zope.testing.cleanup import addCleanUp
+except ImportError:  # pragma: no cover
+    pass
+else:
+    addCleanUp(statistics.clear)
+    del addCleanUp
@@ -0,0 +1,177 @@
+##############################################################################
+#
+# Copyright (c) 2026 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Attributing memory allocations to viewlets.
+
+Viewlet managers with a true
+`~zope.viewlet.manager.ViewletManagerBase.profileMemory` use
+:mod:`tracemalloc` to measure the memory allocated by each phase of
+updating and rendering them, and by each viewlet in these phases, in a
+`MemoryReport`.
+
+:mod:`tracemalloc` traces the allocations of all threads of the process,
+so while several requests are profiled at the same time, or other
+threads allocate memory, the measurements include their allocations and
+the peaks are reset by the other measurements. The numbers are only
+valid when one request at a time is profiled, for example in a single
+threaded process or with `zope.viewlet.replay`.
+"""
+__docformat__ = 'restructuredtext'
+
+import collections
+import threading
+import tracemalloc
+
+
+#: The phases of updating and rendering a viewlet manager, in order.
+PHASES = ('lookup', 'instantiate', 'event', 'update', 'render')
+
+#: The memory used by a phase. *allocated* is the number of bytes by
+#: which the traced memory grew, *peak* the highest number of bytes it
+#: grew by at any time during the phase and *calls* the number of
+#: measurements.
+PhaseMemory = collections.namedtuple(
+    'PhaseMemory', 'allocated peak calls')
+
+
+def _add(statistics, phase, allocated, peak):
+    previous = statistics.get(phase)
+    if previous is not None:
+        allocated += previous.allocated
+        peak = max(peak, previous.peak)
+    statistics[phase] = PhaseMemory(
+        allocated, peak, previous.calls + 1 if previous else 1)
+
+
+class MemoryReport:
+    """
+    The memory used by updating and rendering a viewlet manager.
+
+    `phases` maps the names of the `PHASES` to the `PhaseMemory` of the
+    whole manager, `viewlets` maps the names of the viewlets to mappings
+    of phases to their own `PhaseMemory`. The ``lookup`` phase and the
+    rendering of the manager's template are only attributed to the
+    manager.
+    """
+
+    def __init__(self, name=''):
+        self.name = name
+        self.phases = {}
+        self.viewlets = {}
+
+    def add(self, phase, viewlet, allocated, peak):
+        """Add a measurement of *phase*, for *viewlet* if not ``None``."""
+        _add(self.phases, phase, allocated, peak)
+        if viewlet is not None:
+            _add(self.viewlets.setdefault(viewlet, {}),
+                 phase, allocated, peak)
+
+    def largest(self, count=10):
+        """
+        Return the names and total allocated bytes of the *count* viewlets
+        that allocated most, largest first.
+        """
+        totals = [
+            (name, sum(memory.allocated for memory in phases.values()))
+            for name, phases in self.viewlets.items()]
+        totals.sort(key=lambda item: item[1], reverse=True)
+        return totals[:count]
+
+    def asDict(self):
+        """Return the report as a structure of dictionaries and lists."""
+        return {
+            'name': self.name,
+            'phases': {phase: memory._asdict()
+                       for phase, memory in self.phases.items()},
+            'viewlets': {
+                name: {phase: memory._asdict()
+                       for phase, memory in phases.items()}
+                for name, phases in self.viewlets.items()},
+        }
+
+    def __repr__(self):
+        return '<{} for {!r}: {}>'.format(
+            self.__class__.__name__, self.name, ', '.join(
+                '%s %d bytes' % (phase, self.phases[phase].allocated)
+                for phase in PHASES if phase in self.phases))
+
+
+_lock = threading.Lock()
+# The number of profilers in use, and whether the first of them started
+# tracemalloc (which is not stopped if somebody else started it).
+_profilers = 0
+_started = False
+
+
+def _startTracing():
+    global _profilers, _started
+    with _lock:
+        if not _profilers:
+            _started = not tracemalloc.is_tracing()
+            if _started:
+                tracemalloc.start()
+        _profilers += 1
+
+
+def _stopTracing():
+    global _profilers, _started
+    with _lock:
+        _profilers -= 1
+        if not _profilers and _started:
+            tracemalloc.stop()
+            _started = False
+
+
+class MemoryProfiler:
+    """
+    Measures allocations into a `MemoryReport`.
+
+    Used as a context manager, it starts :mod:`tracemalloc` if it is not
+    already tracing, and stops it again when the last profiler in use
+    exits. Measurements with `measure` must not be nested, as each of
+    them resets the peak of the traced memory.
+    """
+
+    def __init__(self, report):
+        self.report = report
+
+    def __enter__(self):
+        _startTracing()
+        return self
+
+    def __exit__(self, *exc_info):
+        _stopTracing()
+
+    def measure(self, phase, viewlet=None):
+        """
+        Return a context manager measuring the memory allocated by its
+        body as part of *phase* (and of *viewlet*, if given).
+        """
+        return _Measurement(self.report, phase, viewlet)
+
+
+class _Measurement:
+
+    def __init__(self, report, phase, viewlet):
+        self.report = report
+        self.phase = phase
+        self.viewlet = viewlet
+
+    def __enter__(self):
+        self.start = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+
+    def __exit__(self, *exc_info):
+        current, peak = tracemalloc.get_traced_memory()
+        self.report.add(self.phase, self.viewlet,
+                        current - self.start, max(0, peak - self.start))
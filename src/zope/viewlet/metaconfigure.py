@@ -27,9 +27,14 @@ from zope.security import checker
 
 from zope.viewlet import interfaces
 from zope.viewlet import manager
+from zope.viewlet import precompute
 from zope.viewlet import viewlet
 
 
+# Run after the actions of all other directives (whose order is 0).
+PRECOMPUTE_ORDER = 1000000
+
+
 def viewletManagerDirective(
         _context, name, permission,
         for_=Interface, layer=IDefaultBrowserLayer, view=IBrowserView,
@@ -83,7 +88,7 @@ def viewletManagerDirective(
     zcml.interface(_context, view)
 
     # Create a checker for the viewlet manager
-    checker.defineChecker(new_class, checker.Checker(required))
+    _defineChecker(new_class, required)
 
     # register a viewlet manager
     _context.action(
@@ -99,7 +104,7 @@ def viewletDirective(
         for_=Interface, layer=IDefaultBrowserLayer, view=IBrowserView,
         manager=interfaces.IViewletManager, class_=None, template=None,
         attribute='render', allowed_interface=None, allowed_attributes=None,
-        **kwargs):
+        prerender=False, **kwargs):
 
     # Security map dictionary
     required = {}
@@ -111,6 +116,15 @@ def viewletDirective(
     if not (class_ or template):
         raise ConfigurationError("Must specify a class or template")
 
+    # Prerendered viewlets need a class knowing their inputs.
+    if prerender:
+        if not (hasattr(class_, 'prerenderInputs')
+                and hasattr(class_, 'renderInputs')):
+            raise ConfigurationError(
+                "Prerendered viewlets need a class with `prerenderInputs` "
+                "and `renderInputs`")
+        kwargs['prerender'] = True
+
     # Make sure that all the non-default attribute specifications are correct.
     if attribute != 'render':
         if template:
@@ -178,7 +192,7 @@ def viewletDirective(
     zcml.interface(_context, view)
 
     # Create the security checker for the new class
-    checker.defineChecker(new_class, checker.Checker(required))
+    _defineChecker(new_class, required)
 
     # register viewlet
     _context.action(
@@ -189,6 +203,41 @@ def viewletDirective(
               name, _context.info),)
 
 
+def precomputeViewletsDirective(_context):
+    _context.action(
+        discriminator=('precomputeViewlets',),
+        callable=precompute.buildIndex,
+        args=(),
+        order=PRECOMPUTE_ORDER)
+
+
+# Checkers shared by all generated classes protecting the same names with
+# a single permission.
+_sharedCheckers = {}
+
+
+def _defineChecker(class_, required):
+    # Most registrations protect every name with the same permission, so
+    # the generated classes can share a single checker instead of each
+    # getting a fresh one.
+    permissions = set(required.values())
+    if len(permissions) == 1:
+        permission, = permissions
+        key = (frozenset(required), permission)
+        checker_ = _sharedCheckers.get(key)
+        if checker_ is None:
+            checker_ = _sharedCheckers[key] = checker.NamesChecker(
+                required, permission)
+    else:
+        checker_ = checker.Checker(required)
+    checker.defineChecker(class_, checker_)
+
+    # Let the viewlet managers know that they do not need to ask the
+    # security machinery whether instances of this class can be rendered.
+    if required.get('render') is checker.CheckerPublic:
+        class_.__public_render__ = True
+
+
 def _handle_permission(_context, permission):
     if permission == 'zope.Public':
         permission = checker.CheckerPublic
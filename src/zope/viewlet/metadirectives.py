@@ -156,6 +156,25 @@ class IViewletDirective(ITemplatedContentProvider):
         required=False,
         default=interfaces.IViewletManager)
 
+    prerender = zope.schema.Bool(
+        title=_("Prerender the viewlet in other processes."),
+        description=_("The class of a prerendered viewlet must provide "
+                      "``prerenderInputs`` and ``renderInputs`` (see "
+                      "IPrerenderedViewlet). Viewlet managers with a "
+                      "prerenderer then render it in a pool of processes "
+                      "whenever its inputs change."),
+        required=False,
+        default=False)
+
 
 # Arbitrary keys and values are allowed to be passed to the viewlet.
 IViewletDirective.setTaggedValue('keyword_arguments', True)
+
+
+class IPrecomputeViewletsDirective(Interface):
+    """Precompute the viewlets of viewlet managers.
+
+    After all other configuration actions, the viewlets of the registered
+    viewlet managers are precomputed for the registered layers, views and
+    context interfaces (see ``zope.viewlet.precompute``).
+    """
@@ -0,0 +1,158 @@
+##############################################################################
+#
+# Copyright (c) 2026 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Render plans for simple viewlet manager templates.
+
+Most viewlet manager templates only wrap the output of each viewlet in
+some static markup, like::
+
+  <div class="column">
+    <div class="portlet" tal:repeat="viewlet options/viewlets"
+         tal:content="structure viewlet/render" />
+  </div>
+
+Such a template always renders as a static prefix, the output of the
+viewlets joined by a static separator, and a static suffix (or a static
+text if there are no viewlets). `compilePlan` finds these parts, and
+viewlet managers with a true
+`~zope.viewlet.manager.ViewletManagerBase.compileTemplate` use the
+resulting `RenderPlan` instead of calling the template.
+"""
+__docformat__ = 'restructuredtext'
+
+import html.parser
+import re
+import uuid
+
+
+_NAMESPACES = ('tal', 'metal', 'i18n')
+_REPEAT = re.compile(r'^\s*([A-Za-z_]\w*)\s+options/viewlets\s*$')
+_RENDER = re.compile(r'^\s*structure\s+([A-Za-z_]\w*)/render\s*$')
+
+
+class _TALAttributes(html.parser.HTMLParser):
+    """Collects the TAL, METAL and i18n attributes of a template."""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=False)
+        self.attributes = []
+
+    def handle_starttag(self, tag, attrs):
+        prefix = tag.split(':', 1)[0] if ':' in tag else None
+        if prefix in ('metal', 'i18n'):
+            # Unlike TAL elements, these have a meaning of their own.
+            self.attributes.append((tag, None))
+        for name, value in attrs:
+            if ':' in name:
+                namespace, name = name.split(':', 1)
+                if namespace == 'xmlns':
+                    continue
+            elif prefix in _NAMESPACES:
+                # Unprefixed attributes of elements in a TAL namespace.
+                namespace = prefix
+            else:
+                continue
+            if namespace in _NAMESPACES:
+                self.attributes.append(('{}:{}'.format(namespace, name),
+                                        value))
+
+    handle_startendtag = handle_starttag
+
+
+def isSimpleTemplate(source):
+    """
+    Return whether the template *source* does nothing but repeat over
+    ``options/viewlets`` and insert the rendered viewlets as structure.
+    """
+    if '${' in source:
+        return False
+    parser = _TALAttributes()
+    try:
+        parser.feed(source)
+        parser.close()
+    except Exception:
+        return False
+    attributes = dict(parser.attributes)
+    if len(attributes) != 2 or len(parser.attributes) != 2:
+        return False
+    repeat = _REPEAT.match(attributes.get('tal:repeat') or '')
+    render = _RENDER.match(attributes.get('tal:content')
+                           or attributes.get('tal:replace') or '')
+    return bool(repeat and render
+                and repeat.group(1) == render.group(1))
+
+
+class _Marker:
+    """Stands in for a viewlet while compiling."""
+
+    def __init__(self, output):
+        self.output = output
+
+    def render(self):
+        return self.output
+
+
+class RenderPlan:
+    """The static parts of the output of a simple template."""
+
+    #: The content type the template sets on the response.
+    contentType = None
+
+    def __init__(self, empty, prefix, separator, suffix):
+        #: The output if there are no viewlets.
+        self.empty = empty
+        self.prefix = prefix
+        self.separator = separator
+        self.suffix = suffix
+
+    def render(self, outputs):
+        """Return the output of the template for the viewlet *outputs*."""
+        if not outputs:
+            return self.empty
+        return self.prefix + self.separator.join(outputs) + self.suffix
+
+
+def compilePlan(source, render):
+    """
+    Return the `RenderPlan` of the template *source*, or ``None`` if it is
+    not a simple template.
+
+    *render* is called with lists of zero to three stand-ins for viewlets
+    and has to return the output of the template for them. The plan is
+    only returned if it reproduces all these outputs exactly.
+    """
+    if not isSimpleTemplate(source):
+        return None
+    token = uuid.uuid4().hex
+    markers = ['<!--{}:{}-->'.format(token, index) for index in range(3)]
+    try:
+        outputs = [render([_Marker(marker) for marker in markers[:count]])
+                   for count in range(4)]
+    except Exception:
+        return None
+    if not all(isinstance(output, str) for output in outputs):
+        return None
+
+    one, two = outputs[1:3]
+    if one.count(markers[0]) != 1 or two.count(markers[1]) != 1:
+        return None
+    prefix, suffix = one.split(markers[0])
+    start = two.find(markers[0])
+    if start != len(prefix):
+        return None
+    separator = two[start + len(markers[0]):two.index(markers[1])]
+    plan = RenderPlan(outputs[0], prefix, separator, suffix)
+    for count, output in enumerate(outputs):
+        if plan.render(markers[:count]) != output:
+            return None
+    return plan
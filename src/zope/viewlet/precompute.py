@@ -0,0 +1,234 @@
+##############################################################################
+#
+# Copyright (c) 2026 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Viewlets of viewlet managers precomputed at the end of configuration.
+
+Which viewlets a viewlet manager shows mostly depends on the interfaces
+provided by its context, the layers of the request and the view, all of
+which are known once the configuration is loaded. The
+``precomputeViewlets`` directive::
+
+  <browser:precomputeViewlets />
+
+has a `ViewletIndex` built after all other configuration actions ran. For
+each registered viewlet manager class it holds the viewlet registrations
+the manager can show. The first time a manager is looked up for a
+combination of the context interfaces, layers and views these viewlets
+are registered for, the index computes the factories of the viewlets,
+sorted by name and weight, and the viewlet classes whose ``render`` is
+public according to their security checker, and keeps them for that
+combination. `~zope.viewlet.manager.ViewletManagerBase.update` uses them
+instead of looking the viewlets up and asking the security machinery
+about the public ones.
+
+The index is only used while the adapter registry it was built from is
+the one of the current site and unchanged. Combinations for which the
+most specific registration of a viewlet depends on the order of the
+interfaces of the objects are looked up as before.
+"""
+__docformat__ = 'restructuredtext'
+
+import collections
+
+import zope.component
+import zope.interface
+from zope.security.checker import CheckerPublic
+from zope.security.checker import getCheckerForInstancesOf
+
+from zope.viewlet import interfaces
+
+
+#: The precomputed viewlets of a viewlet manager: a tuple of pairs of
+#: names and factories, sorted like the manager sorts its viewlets, and a
+#: frozenset of the factories creating viewlets that can always be
+#: rendered.
+Precomputed = collections.namedtuple('Precomputed', 'factories public')
+
+
+def _dominates(first, second):
+    """
+    Return whether the registration *first* is more specific than
+    *second* for all objects matching both, ``None`` if that depends on
+    the objects.
+    """
+    for a, b in zip(first.required, second.required):
+        if a is b:
+            continue
+        if a.extends(b):
+            return True
+        if b.extends(a):
+            return False
+        return None
+    return None
+
+
+def _winner(registrations):
+    """
+    Return the registration found for objects matching all
+    *registrations*, or ``None`` if that depends on the objects.
+    """
+    for candidate in registrations:
+        if all(other is candidate or _dominates(candidate, other)
+               for other in registrations):
+            return candidate
+    return None
+
+
+def _isPublic(factory):
+    if not isinstance(factory, type) or \
+            getattr(factory, '__Security_checker__', None) is not None:
+        return False
+    checker = getCheckerForInstancesOf(factory)
+    permission_id = getattr(checker, 'permission_id', None)
+    return permission_id is not None and \
+        permission_id('render') is CheckerPublic
+
+
+class _ManagerEntry:
+
+    def __init__(self, class_, viewletRegistrations):
+        from zope.viewlet.manager import WeightOrderedViewletManager
+        spec = zope.interface.implementedBy(class_)
+        self.candidates = [
+            registration for registration in viewletRegistrations
+            if spec.isOrExtends(registration.required[3])]
+        # The interfaces distinguishing the contexts, requests and views
+        # for the candidates.
+        self.interfaces = tuple(
+            frozenset(registration.required[position]
+                      for registration in self.candidates)
+            for position in range(3))
+        self.weighted = issubclass(class_, WeightOrderedViewletManager)
+        # Filled by `lookup`, as most combinations of the interfaces are
+        # never seen.
+        self.results = {}
+
+    def _signature(self, specs):
+        return tuple(
+            frozenset(iface for iface in ifaces if spec.isOrExtends(iface))
+            for spec, ifaces in zip(specs, self.interfaces))
+
+    def _compute(self, signature):
+        from zope.viewlet.manager import getWeight
+        byName = collections.defaultdict(list)
+        for registration in self.candidates:
+            if all(iface in provided for iface, provided in zip(
+                    registration.required, signature)):
+                byName[registration.name].append(registration)
+        factories = []
+        for name, registrations in sorted(byName.items()):
+            registration = _winner(registrations)
+            if registration is None:
+                # Found by the order of the interfaces of the objects.
+                return None
+            factories.append((name, registration.factory))
+        if self.weighted:
+            try:
+                factories.sort(key=getWeight)
+            except (TypeError, ValueError):
+                # Weighted by the instances; the manager sorts them.
+                pass
+        return Precomputed(
+            tuple(factories),
+            frozenset(factory for _name, factory in factories
+                      if _isPublic(factory)))
+
+    def lookup(self, specs):
+        signature = self._signature(specs)
+        try:
+            return self.results[signature]
+        except KeyError:
+            result = self.results[signature] = self._compute(signature)
+            return result
+
+
+class ViewletIndex:
+    """
+    The precomputed viewlets of the viewlet managers registered in the
+    component *registry*. The registrations in the index are never
+    changed; the viewlets of a manager are computed when it is first
+    looked up for a combination of interfaces.
+    """
+
+    def __init__(self, registry):
+        self.adapters = registry.adapters
+        self.generation = self.adapters._generation
+        managers = set()
+        viewlets = []
+        for registration in registry.registeredAdapters():
+            if len(registration.required) == 3 and \
+                    registration.provided.isOrExtends(
+                        interfaces.IViewletManager) and \
+                    isinstance(registration.factory, type):
+                managers.add(registration.factory)
+            elif len(registration.required) == 4 and \
+                    registration.provided.isOrExtends(interfaces.IViewlet):
+                viewlets.append(registration)
+        self._managers = {
+            class_: _ManagerEntry(class_, viewlets) for class_ in managers}
+
+    def lookup(self, manager):
+        """
+        Return the `Precomputed` viewlets of *manager*, or ``None`` if they
+        are not known.
+        """
+        entry = self._managers.get(type(manager))
+        if entry is None:
+            return None
+        adapters = zope.component.getSiteManager().adapters
+        if adapters is not self.adapters or \
+                adapters._generation != self.generation:
+            return None
+        providedBy = zope.interface.providedBy
+        if providedBy(manager) is not zope.interface.implementedBy(
+                type(manager)):
+            return None
+        return entry.lookup((providedBy(manager.context),
+                             providedBy(manager.request),
+                             providedBy(manager.__parent__)))
+
+
+#: The `ViewletIndex` built by `buildIndex`, if any.
+viewletIndex = None
+
+
+def buildIndex():
+    """Build the `viewletIndex` of the registry of the current site."""
+    global viewletIndex
+    viewletIndex = ViewletIndex(zope.component.getSiteManager())
+
+
+def clearIndex():
+    """Forget the `viewletIndex`."""
+    global viewletIndex
+    viewletIndex = None
+
+
+def lookup(manager):
+    """
+    Return the `Precomputed` viewlets of *manager* from the
+    `viewletIndex`, or ``None`` if they are not known.
+    """
+    index = viewletIndex
+    if index is None:
+        return None
+    return index.lookup(manager)
+
+
+try:
+    from zope.testing.cleanup import addCleanUp
+except ImportError:  # pragma: no cover
+    pass
+else:
+    addCleanUp(clearIndex)
+    del addCleanUp
@@ -0,0 +1,187 @@
+##############################################################################
+#
+# Copyright (c) 2026 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Rendering expensive viewlets in other processes.
+
+Viewlets registered with ``prerender="true"`` (see
+:class:`zope.viewlet.interfaces.IPrerenderedViewlet`) describe everything
+their output depends on with picklable *inputs*. A viewlet manager with a
+`Prerenderer` and a ``cacheStorage`` neither updates nor renders them:
+the `Prerenderer` renders their output from the inputs in a pool of
+processes, so the work is not bound by the global interpreter lock of the
+serving process, and stores it in the storage under a digest of the
+inputs. Requests only read the stored output.
+
+If the output cannot be rendered in time, or rendering it fails, the
+viewlet is updated and rendered in the request as usual.
+"""
+__docformat__ = 'restructuredtext'
+
+import collections
+import concurrent.futures
+import functools
+import hashlib
+import logging
+import multiprocessing
+import pickle
+import threading
+
+from zope.configuration.name import resolve
+
+
+logger = logging.getLogger(__name__)
+
+
+def inputsDigest(inputs):
+    """Return a digest of the picklable *inputs*."""
+    data = pickle.dumps(inputs, protocol=4)
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def _importableClass(class_):
+    # The classes generated by the viewlet directive cannot be imported by
+    # other processes, but the class they were generated from can.
+    for base in class_.__mro__:
+        if '<' in base.__qualname__ or not hasattr(base, 'renderInputs'):
+            continue
+        try:
+            if resolve('{}.{}'.format(base.__module__,
+                                      base.__qualname__)) is base:
+                return base
+        except (ImportError, AttributeError):
+            continue
+    raise TypeError('No importable class in the bases of %r' % class_)
+
+
+def _render(dottedName, inputs):
+    # Runs in the worker processes.
+    return resolve(dottedName).renderInputs(inputs)
+
+
+class Prerenderer:
+    """Renders prerendered viewlets in *executor*.
+
+    The executor defaults to a `concurrent.futures.ProcessPoolExecutor`
+    starting its processes with the ``forkserver`` (or, where that is not
+    available, ``spawn``) method, as forking the threads of an application
+    server is unsafe. It is only created when it is first needed. The
+    output of each viewlet for each distinct digest of its inputs is only
+    rendered once, however many requests need it at the same time.
+
+    If *serveStale* is true, requests needing output that is still being
+    rendered get the last output rendered for the same viewlet and the
+    same ``prerenderStaleKey()`` (if the viewlet has that method, and the
+    output is still stored) instead of waiting for it. The stale key
+    identifies what the output shows, for example the object a menu is
+    for, so that other objects never get it; the last outputs of at most
+    *maxStale* stale keys are remembered. Otherwise requests wait up to
+    *timeout* seconds, and then update and render the viewlet
+    themselves.
+    """
+
+    #: The number of stale keys whose last output is remembered.
+    maxStale = 10000
+
+    def __init__(self, executor=None, serveStale=True, timeout=None):
+        self._executor = executor
+        self.serveStale = serveStale
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._latest = collections.OrderedDict()
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    method = 'forkserver'
+                    if method not in multiprocessing.get_all_start_methods():
+                        method = 'spawn'
+                    self._executor = concurrent.futures.ProcessPoolExecutor(
+                        mp_context=multiprocessing.get_context(method))
+        return self._executor
+
+    def fragment(self, viewlet, registration, storage):
+        """
+        Return the output of *viewlet*, whose registration is identified
+        by the string *registration*, from *storage*, having it rendered
+        first if necessary, or ``None`` if it could not be rendered in
+        time.
+        """
+        inputs = viewlet.prerenderInputs()
+        key = '{}/prerender:{}'.format(registration, inputsDigest(inputs))
+        output = storage.get(key)
+        if output is not None:
+            return output
+        staleKey = None
+        method = getattr(viewlet, 'prerenderStaleKey', None)
+        if method is not None:
+            staleKey = (registration, method())
+        future = self.schedule(type(viewlet), inputs, key, staleKey,
+                               storage)
+        if self.serveStale and staleKey is not None:
+            latest = self._latest.get(staleKey)
+            if latest is not None:
+                output = storage.get(latest)
+                if output is not None:
+                    return output
+        try:
+            return future.result(self.timeout)
+        except concurrent.futures.TimeoutError:
+            return None
+        except Exception:
+            logger.warning('Prerendering %s failed', registration,
+                           exc_info=True)
+            return None
+
+    def schedule(self, class_, inputs, key, staleKey, storage):
+        """
+        Have the output of the viewlet class *class_* for *inputs* rendered
+        and stored in *storage* under *key*, unless that is already being
+        done, and return the `concurrent.futures.Future` of the output.
+        The output is remembered as the last one for *staleKey* unless
+        that is ``None``.
+        """
+        executor = self.executor
+        with self._lock:
+            future = self._pending.get(key)
+            if future is not None:
+                return future
+            class_ = _importableClass(class_)
+            dottedName = '{}.{}'.format(class_.__module__, class_.__qualname__)
+            future = executor.submit(_render, dottedName, inputs)
+            self._pending[key] = future
+        future.add_done_callback(
+            functools.partial(self._done, key, staleKey, storage))
+        return future
+
+    def _done(self, key, staleKey, storage, future):
+        # The output is stored before the key stops being pending, so that
+        # requests find the one or the other and never schedule it again.
+        rendered = not future.cancelled() and future.exception() is None
+        if rendered:
+            storage.set(key, future.result())
+        with self._lock:
+            del self._pending[key]
+            if not rendered or staleKey is None:
+                return
+            self._latest.pop(staleKey, None)
+            self._latest[staleKey] = key
+            while len(self._latest) > self.maxStale:
+                self._latest.popitem(last=False)
+
+    def shutdown(self, wait=True):
+        """Shut the executor down."""
+        if self._executor is not None:
+            self._executor.shutdown(wait)
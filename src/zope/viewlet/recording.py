@@ -0,0 +1,54 @@
+##############################################################################
+#
+# Copyright (c) 2026 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Recording viewlet manager updates to replay them.
+
+Recording is off unless `enabled` is set to true. While it is,
+`~.ViewletManagerBase.update` logs a JSON record of the interfaces
+provided by the context, request and view, and of the principal, for
+every viewlet manager it updates, to the `logger` at the ``INFO`` level.
+The ``zope-viewlet-replay`` script of :mod:`zope.viewlet.replay` replays
+such records.
+
+Unlike :mod:`zope.viewlet.replay`, this module is imported by every
+viewlet manager.
+"""
+__docformat__ = 'restructuredtext'
+
+import json
+import logging
+
+from zope.interface import providedBy
+
+
+#: Whether viewlet managers record their updates.
+enabled = False
+
+#: The logger the records are written to.
+logger = logging.getLogger('zope.viewlet.replay')
+
+
+def _identifiers(obj):
+    return [iface.__identifier__ for iface in providedBy(obj).interfaces()]
+
+
+def record(manager):
+    """Log the record for updating *manager*."""
+    principal = getattr(manager.request, 'principal', None)
+    logger.info('%s', json.dumps({
+        'manager': getattr(manager, '__name__', ''),
+        'context': _identifiers(manager.context),
+        'layer': _identifiers(manager.request),
+        'view': _identifiers(manager.__parent__),
+        'principal': getattr(principal, 'id', None),
+    }))
@@ -0,0 +1,291 @@
+##############################################################################
+#
+# Copyright (c) 2026 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Replaying viewlet manager updates.
+
+The ``zope-viewlet-replay`` script reads logs of the updates recorded
+by :mod:`zope.viewlet.recording` and replays the records against the
+configuration of a site, reporting the throughput and the latency (and
+optionally the allocations) per viewlet manager::
+
+  zope-viewlet-replay site.zcml viewlets.log --threads 4 --processes 2
+"""
+__docformat__ = 'restructuredtext'
+
+import argparse
+import collections
+import concurrent.futures
+import json
+import time
+import tracemalloc
+
+import zope.component
+import zope.security.management
+from zope.configuration.name import resolve
+from zope.contentprovider.interfaces import IContentProvider
+from zope.interface import directlyProvides
+from zope.publisher.browser import TestRequest
+
+from zope.viewlet.stats import percentile
+
+
+def readRecords(lines):
+    """
+    Return the records found in *lines* of a log, ignoring anything
+    before the JSON data on each line and lines without records.
+    """
+    records = []
+    for line in lines:
+        start = line.find('{"manager"')
+        if start >= 0:
+            records.append(json.loads(line[start:]))
+    return records
+
+
+class _Provider:
+    """Stands in for the contexts and views of recorded updates."""
+
+    def __init__(self, context=None, request=None):
+        self.context = context
+        self.request = request
+        self.__parent__ = context
+
+
+class _Principal:
+
+    def __init__(self, id):
+        self.id = id
+        self.title = id
+        self.description = ''
+
+
+def prepare(record):
+    """
+    Return a function updating and rendering the viewlet manager of
+    *record*, or ``None`` if some of its interfaces or its manager cannot
+    be found.
+    """
+    try:
+        provided = [[resolve(name) for name in record[key]]
+                    for key in ('context', 'layer', 'view')]
+    except ImportError:
+        return None
+    principal = record['principal']
+
+    def objects():
+        # A request can only take part in one interaction at a time, so
+        # every update gets its own objects.
+        context = _Provider()
+        request = TestRequest()
+        if principal is not None:
+            request.setPrincipal(_Principal(principal))
+        view = _Provider(context, request)
+        for obj, interfaces in zip((context, request, view), provided):
+            directlyProvides(obj, *interfaces)
+        return context, request, view
+
+    manager = zope.component.queryMultiAdapter(
+        objects(), IContentProvider, name=record['manager'])
+    if manager is None:
+        return None
+    factory = type(manager)
+
+    def run():
+        context, request, view = objects()
+        zope.security.management.newInteraction(request)
+        try:
+            manager = factory(context, request, view)
+            manager.__name__ = record['manager']
+            manager.update()
+            return manager.render()
+        finally:
+            zope.security.management.endInteraction()
+    return run
+
+
+def _time(jobs, threads, iterations):
+    latencies = collections.defaultdict(list)
+
+    def run(job):
+        name, function = job
+        start = time.perf_counter()
+        function()
+        return name, time.perf_counter() - start
+
+    with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+        for name, latency in executor.map(run, jobs * iterations):
+            latencies[name].append(latency)
+    return latencies
+
+
+def _allocations(jobs):
+    # Allocations cannot be attributed to managers while other threads
+    # allocate as well, so they are measured in a separate serial pass.
+    sizes = collections.defaultdict(list)
+    counts = collections.defaultdict(list)
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    try:
+        for name, function in jobs:
+            before = tracemalloc.take_snapshot()
+            function()
+            after = tracemalloc.take_snapshot()
+            stats = after.compare_to(before, 'filename')
+            sizes[name].append(sum(stat.size_diff for stat in stats
+                                   if stat.size_diff > 0))
+            counts[name].append(sum(stat.count_diff for stat in stats
+                                    if stat.count_diff > 0))
+    finally:
+        if not tracing:
+            tracemalloc.stop()
+    return sizes, counts
+
+
+_configured = None
+
+
+def _configure(zcml):
+    global _configured
+    # Forked processes inherit the configuration of their parent.
+    if _configured != zcml:
+        from zope.configuration import xmlconfig
+        xmlconfig.file(zcml)
+        _configured = zcml
+
+
+def _replayInProcess(zcml, records, threads, iterations, allocations):
+    if zcml is not None:
+        _configure(zcml)
+    jobs = []
+    skipped = 0
+    for record in records:
+        function = prepare(record)
+        if function is None:
+            skipped += 1
+        else:
+            jobs.append((record['manager'], function))
+    latencies = _time(jobs, threads, iterations)
+    sizes = counts = {}
+    if allocations:
+        sizes, counts = _allocations(jobs)
+    return dict(latencies), dict(sizes), dict(counts), skipped
+
+
+#: The result of replaying the records of one viewlet manager. Latencies
+#: are in seconds; the allocation statistics are ``None`` unless they were
+#: requested.
+ManagerStatistics = collections.namedtuple(
+    'ManagerStatistics',
+    'name count mean p50 p90 p99 allocatedBytes allocatedBlocks')
+
+#: The result of a replay. *throughput* is the number of manager updates
+#: per second of wall time, *skipped* the number of records that could
+#: not be replayed.
+ReplayReport = collections.namedtuple(
+    'ReplayReport', 'updates seconds throughput skipped managers')
+
+
+def replay(records, zcml=None, threads=1, processes=1, iterations=1,
+           allocations=False):
+    """
+    Replay *records* (as returned by `readRecords`) and return a
+    `ReplayReport`.
+
+    If *zcml* is given, that configuration is loaded first (in every
+    process). The records are split among *processes* processes, each of
+    which replays them *iterations* times with *threads* threads. If
+    *allocations* is true, each record is replayed once more without
+    concurrency to measure the memory it allocates.
+    """
+    start = time.perf_counter()
+    if processes <= 1:
+        results = [_replayInProcess(
+            zcml, records, threads, iterations, allocations)]
+    else:
+        chunks = [records[index::processes] for index in range(processes)]
+        with concurrent.futures.ProcessPoolExecutor(processes) as executor:
+            results = list(executor.map(
+                _replayInProcess, [zcml] * processes, chunks,
+                [threads] * processes, [iterations] * processes,
+                [allocations] * processes))
+    seconds = time.perf_counter() - start
+
+    latencies = collections.defaultdict(list)
+    sizes = collections.defaultdict(list)
+    counts = collections.defaultdict(list)
+    skipped = 0
+    for result in results:
+        for merged, values in zip((latencies, sizes, counts), result[:3]):
+            for name, measured in values.items():
+                merged[name].extend(measured)
+        skipped += result[3]
+
+    managers = []
+    for name in sorted(latencies):
+        values = sorted(latencies[name])
+        managers.append(ManagerStatistics(
+            name, len(values), sum(values) / len(values),
+            percentile(values, 50), percentile(values, 90),
+            percentile(values, 99),
+            _mean(sizes.get(name)), _mean(counts.get(name))))
+    updates = sum(len(values) for values in latencies.values())
+    return ReplayReport(
+        updates, seconds, updates / seconds if seconds else 0.0, skipped,
+        managers)
+
+
+def _mean(values):
+    if not values:
+        return None
+    return sum(values) / len(values)
+
+
+def formatReport(report):
+    """Return the lines of text describing a `ReplayReport`."""
+    lines = ['%d updates in %.3f s (%.1f/s), %d records skipped' % (
+        report.updates, report.seconds, report.throughput, report.skipped)]
+    for stats in report.managers:
+        line = '{}: {} updates, mean {:.3f} ms, p50 {:.3f} ms, ' \
+               'p90 {:.3f} ms, p99 {:.3f} ms'.format(
+                   stats.name, stats.count, stats.mean * 1000,
+                   stats.p50 * 1000, stats.p90 * 1000, stats.p99 * 1000)
+        if stats.allocatedBytes is not None:
+            line += ', %d bytes in %d blocks allocated' % (
+                stats.allocatedBytes, stats.allocatedBlocks)
+        lines.append(line)
+    return lines
+
+
+def main(argv=None):
+    """Entry point of the ``zope-viewlet-replay`` script."""
+    parser = argparse.ArgumentParser(
+        prog='zope-viewlet-replay',
+        description='Replay recorded viewlet manager updates.')
+    parser.add_argument('zcml', help='the site configuration to load')
+    parser.add_argument('log', help='the log containing the records')
+    parser.add_argument('--threads', type=int, default=1)
+    parser.add_argument('--processes', type=int, default=1)
+    parser.add_argument('--iterations', type=int, default=1)
+    parser.add_argument(
+        '--allocations', action='store_true',
+        help='also measure the memory allocated per manager')
+    args = parser.parse_args(argv)
+
+    with open(args.log) as log:
+        records = readRecords(log)
+    report = replay(records, args.zcml, args.threads, args.processes,
+                    args.iterations, args.allocations)
+    for line in formatReport(report):
+        print(line)
+    return 0 if report.updates else 1
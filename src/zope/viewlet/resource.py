@@ -0,0 +1,187 @@
+##############################################################################
+#
+# Copyright (c) 2026 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Versioned URLs and inline contents of resources.
+
+The resource viewlets of :mod:`zope.viewlet.viewlet` created with
+``versioned=True`` add a digest of the contents of the resource file to
+its URL, as in ``/@@/resource.js?v=0123456789abcdef``. As the URL changes
+whenever the file does, browsers, proxies and content delivery networks
+may cache such URLs forever.
+
+Resources are published as before: the ``++resource++`` namespace
+ignores the query string, so no further configuration is needed to serve
+versioned URLs. Front-end servers can recognize them by the
+`VERSION_PARAMETER` to set long-lived ``Cache-Control`` headers, such as
+``public, max-age=31536000, immutable``.
+
+The resource viewlets created with an ``inlineThreshold`` instead insert
+the contents of resource files smaller than that many bytes into the
+page, in ``<style>`` and ``<script>`` elements, saving the browser a
+request for small stylesheets and scripts blocking the first paint. The
+contents may be minified, for example by `minifyCSS`; they are read and
+minified once per process. Style sheets referring to other files by
+relative URLs, JavaScript modules and scripts importing relative URLs
+are not inlined, as those URLs would no longer resolve.
+
+Only resources whose file is known can be versioned or inlined: those
+with a ``path`` (or whose ``context`` has one, like the file and image
+resources of :mod:`zope.browserresource`). The URLs of other resources
+are used unchanged.
+"""
+__docformat__ = 'restructuredtext'
+
+import hashlib
+import os
+import re
+
+
+#: The name of the query parameter carrying the version of a resource.
+VERSION_PARAMETER = 'v'
+
+_versions = {}
+_texts = {}
+
+
+def resourceFile(resource):
+    """Return the path of the file of *resource*, or ``None``."""
+    for obj in (resource, getattr(resource, 'context', None)):
+        path = getattr(obj, 'path', None)
+        if isinstance(path, str):
+            return path
+    return None
+
+
+def resourceVersion(resource):
+    """
+    Return a digest of the file of *resource*, or ``None`` if it has no
+    file. Files are only read once per process.
+    """
+    path = resourceFile(resource)
+    if path is None:
+        return None
+    version = _versions.get(path)
+    if version is None:
+        try:
+            with open(path, 'rb') as file:
+                version = hashlib.blake2b(
+                    file.read(), digest_size=8).hexdigest()
+        except OSError:
+            return None
+        _versions[path] = version
+    return version
+
+
+def versionedURL(resource):
+    """Return the URL of *resource* (by calling it) with its version."""
+    url = resource()
+    version = resourceVersion(resource)
+    if version is None:
+        return url
+    return '{}{}{}={}'.format(
+        url, '&' if '?' in url else '?', VERSION_PARAMETER, version)
+
+
+def inlineText(resource, threshold, minify=None, tag='script'):
+    """
+    Return the contents of the file of *resource* to be inserted into the
+    page in a *tag* element, or ``None`` if it has no file or the file
+    has *threshold* bytes or more.
+
+    The contents are decoded as UTF-8 and passed through *minify* (a
+    callable taking and returning text) if given. Contents that would end
+    the *tag* element early are never inlined, nor are style sheets
+    referring to other files by relative URLs (in ``url()`` or
+    ``@import``) and scripts importing relative URLs (with ``import()``),
+    which would be resolved against the URL of the page instead of the
+    one of the resource.
+    """
+    path = resourceFile(resource)
+    if path is None:
+        return None
+    key = (path, threshold, minify, tag)
+    try:
+        return _texts[key]
+    except KeyError:
+        pass
+    text = None
+    try:
+        if os.path.getsize(path) < threshold:
+            with open(path, 'rb') as file:
+                text = file.read().decode('utf-8')
+            if minify is not None:
+                text = minify(text)
+            if '</' + tag in text.lower() or \
+                    tag == 'style' and _hasRelativeURLs(text) or \
+                    tag == 'script' and _RELATIVE_IMPORT.search(text):
+                text = None
+    except (OSError, UnicodeDecodeError):
+        text = None
+    _texts[key] = text
+    return text
+
+
+_CSS_REFERENCE = re.compile(
+    r'''url\(\s*(?:(["'])(.*?)\1|([^)\s]*))|@import\s*(["'])(.*?)\4''',
+    re.IGNORECASE | re.DOTALL)
+
+# URLs with a scheme, absolute paths and fragments resolve the same
+# against any URL of the site.
+_ABSOLUTE_URL = re.compile(r'[a-z][a-z0-9+.-]*:|/|#', re.IGNORECASE)
+
+
+def _hasRelativeURLs(text):
+    for match in _CSS_REFERENCE.finditer(text):
+        url = match.group(2) or match.group(3) or match.group(5)
+        if url and not _ABSOLUTE_URL.match(url.strip()):
+            return True
+    return False
+
+
+_RELATIVE_IMPORT = re.compile(r'''\bimport\s*\(\s*["'`]\.{1,2}/''')
+
+
+_CSS_COMMENT = re.compile(r'/\*.*?\*/', re.DOTALL)
+
+
+def minifyCSS(text):
+    """
+    Return the style sheet *text* without comments, indentation and empty
+    lines. Comment delimiters in strings are not recognized as such.
+    """
+    text = _CSS_COMMENT.sub('', text)
+    return '\n'.join(line.strip() for line in text.splitlines()
+                     if line.strip())
+
+
+class VersionedResource:
+    """
+    Stands in for a *resource* in templates, returning its versioned URL
+    when called.
+    """
+
+    def __init__(self, resource):
+        self.resource = resource
+
+    def __call__(self):
+        return versionedURL(self.resource)
+
+
+try:
+    from zope.testing.cleanup import addCleanUp
+except ImportError:  # pragma: no cover
+    pass
+else:
+    addCleanUp(_versions.clear)
+    addCleanUp(_texts.clear)
+    del addCleanUp
@@ -0,0 +1,292 @@
+##############################################################################
+#
+# Copyright (c) 2026 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Sampled statistics of viewlets over the lifetime of a process.
+
+Viewlet managers whose
+`~zope.viewlet.manager.ViewletManagerBase.statistics` is set to a
+`ViewletStatistics` (usually one shared by all managers) measure a sample
+of their updates and renderings: how often each viewlet was available,
+how long rendering it took and how large its output was. Unlike
+:mod:`zope.viewlet.replay` or :mod:`zope.viewlet.memory`, which look at
+single requests, the statistics aggregate over all requests, to find the
+viewlets worth caching, optimizing or loading lazily.
+
+`ViewletStatistics.report` returns the aggregates, and
+`ViewletStatistics.writeTextFile` writes them in the Prometheus text
+exposition format, for example for the textfile collector of the node
+exporter.
+
+Statistics are counted in per-thread shards (see `ThreadShards`), so
+measuring never waits for other threads.
+"""
+__docformat__ = 'restructuredtext'
+
+import collections
+import os
+import random
+import tempfile
+import threading
+
+
+#: The aggregated statistics of a viewlet called *name* in the viewlet
+#: manager called *manager*. *renders* is the estimated number of
+#: renderings (the number of *samples* divided by the sample rate),
+#: *meanTime* and *p95Time* are in seconds, *meanBytes* is the mean size
+#: of the UTF-8 encoded output and *availability* the share of updates
+#: in which the viewlet was registered and not filtered out. Values that
+#: were not measured are ``None``.
+ViewletReport = collections.namedtuple(
+    'ViewletReport',
+    'manager name renders samples meanTime p95Time meanBytes availability')
+
+
+class ThreadShards:
+    """
+    Per-thread instances of *factory*, which threads can change without
+    waiting for each other, and which are only combined when read.
+
+    The shards of threads that ended are kept, as what they counted
+    still counts.
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._lock = threading.Lock()
+        self.clear()
+
+    def get(self):
+        """Return the shard of the current thread."""
+        local = self._local
+        shard = getattr(local, 'shard', None)
+        if shard is None:
+            shard = local.shard = self._factory()
+            with self._lock:
+                if local is self._local:
+                    self._shards.append(shard)
+        return shard
+
+    def all(self):
+        """Return the shards of all threads."""
+        with self._lock:
+            return list(self._shards)
+
+    def clear(self):
+        """Forget all shards."""
+        with self._lock:
+            self._local = threading.local()
+            self._shards = []
+
+
+class _Shard:
+
+    def __init__(self):
+        # Only contended while the statistics are read.
+        self.lock = threading.Lock()
+        self.aggregates = {}
+        self.random = random.Random()
+
+
+class _Aggregate:
+
+    __slots__ = ('samples', 'time', 'bytes', 'times', 'found', 'available')
+
+    def __init__(self):
+        self.samples = 0
+        self.time = 0.0
+        self.bytes = 0
+        self.times = []
+        self.found = 0
+        self.available = 0
+
+
+class ViewletStatistics:
+    """
+    Aggregates the statistics of a share of *sampleRate* of the updates
+    and renderings of viewlet managers.
+
+    The times of at most *reservoirSize* renderings per viewlet are kept
+    (a uniform random sample of all measured renderings) for computing
+    percentiles.
+    """
+
+    def __init__(self, sampleRate=0.01, reservoirSize=1000):
+        self.sampleRate = sampleRate
+        self.reservoirSize = reservoirSize
+        self._shards = ThreadShards(_Shard)
+
+    def sample(self):
+        """Return whether to measure the next update and rendering."""
+        return self._shards.get().random.random() < self.sampleRate
+
+    @staticmethod
+    def _aggregate(shard, manager, name):
+        key = (manager, name)
+        aggregate = shard.aggregates.get(key)
+        if aggregate is None:
+            aggregate = shard.aggregates[key] = _Aggregate()
+        return aggregate
+
+    def addAvailability(self, manager, found, available):
+        """
+        Add that the viewlets called *found* were registered in the viewlet
+        manager called *manager* and those called *available* of them
+        were not filtered out.
+        """
+        available = set(available)
+        shard = self._shards.get()
+        with shard.lock:
+            for name in found:
+                aggregate = self._aggregate(shard, manager, name)
+                aggregate.found += 1
+                if name in available:
+                    aggregate.available += 1
+
+    def addRendering(self, manager, name, seconds, size):
+        """
+        Add that rendering the viewlet *name* of the viewlet manager
+        *manager* took *seconds* and produced *size* bytes.
+        """
+        shard = self._shards.get()
+        with shard.lock:
+            aggregate = self._aggregate(shard, manager, name)
+            aggregate.samples += 1
+            aggregate.time += seconds
+            aggregate.bytes += size
+            times = aggregate.times
+            if len(times) < self.reservoirSize:
+                times.append(seconds)
+            else:
+                index = shard.random.randrange(aggregate.samples)
+                if index < self.reservoirSize:
+                    times[index] = seconds
+
+    def report(self):
+        """
+        Return a list of the `ViewletReport` of each viewlet, sorted by
+        manager and name.
+        """
+        merged = {}
+        for shard in self._shards.all():
+            with shard.lock:
+                for key, aggregate in shard.aggregates.items():
+                    total = merged.get(key)
+                    if total is None:
+                        total = merged[key] = [0, 0.0, 0, [], 0, 0]
+                    total[0] += aggregate.samples
+                    total[1] += aggregate.time
+                    total[2] += aggregate.bytes
+                    if aggregate.times:
+                        # Each kept time stands for this many samples.
+                        weight = aggregate.samples / len(aggregate.times)
+                        total[3].extend(
+                            (time, weight) for time in aggregate.times)
+                    total[4] += aggregate.found
+                    total[5] += aggregate.available
+        reports = []
+        for (manager, name), (samples, time, size, times, found,
+                              available) in sorted(
+                merged.items(), key=lambda item: tuple(map(str, item[0]))):
+            reports.append(ViewletReport(
+                manager, name,
+                samples / self.sampleRate if self.sampleRate else 0,
+                samples,
+                time / samples if samples else None,
+                _weightedPercentile(times, 95),
+                size / samples if samples else None,
+                available / found if found else None))
+        return reports
+
+    def asText(self, prefix='zope_viewlet'):
+        """
+        Return the statistics in the Prometheus text exposition format,
+        with metric names starting with *prefix*.
+        """
+        metrics = (
+            ('renders_total', 'counter',
+             'Estimated number of renderings of the viewlet.', 'renders'),
+            ('render_seconds_mean', 'gauge',
+             'Mean time rendering the viewlet took.', 'meanTime'),
+            ('render_seconds_p95', 'gauge',
+             '95th percentile of the time rendering the viewlet took.',
+             'p95Time'),
+            ('output_bytes_mean', 'gauge',
+             'Mean size of the output of the viewlet.', 'meanBytes'),
+            ('availability_ratio', 'gauge',
+             'Share of updates in which the viewlet was available.',
+             'availability'),
+        )
+        reports = self.report()
+        lines = []
+        for suffix, type_, help, field in metrics:
+            name = '{}_{}'.format(prefix, suffix)
+            lines.append('# HELP {} {}'.format(name, help))
+            lines.append('# TYPE {} {}'.format(name, type_))
+            for report in reports:
+                value = getattr(report, field)
+                if value is None:
+                    continue
+                lines.append('{}{{manager="{}",viewlet="{}"}} {!r}'.format(
+                    name, _escape(report.manager), _escape(report.name),
+                    float(value)))
+        return '\n'.join(lines) + '\n'
+
+    def writeTextFile(self, path, prefix='zope_viewlet'):
+        """
+        Write `asText` to the file *path*, replacing it atomically so that
+        collectors never read a partial file.
+        """
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, temporary = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as file:
+                file.write(self.asText(prefix))
+            os.replace(temporary, path)
+        except BaseException:
+            os.unlink(temporary)
+            raise
+
+    def clear(self):
+        self._shards.clear()
+
+
+def percentile(values, percent):
+    """Return the *percent* percentile of the sorted *values*."""
+    if not values:
+        return None
+    index = min(len(values) - 1, int(len(values) * percent / 100.0))
+    return values[index]
+
+
+def _weightedPercentile(values, percent):
+    """
+    Return the *percent* percentile of the pairs of values and weights
+    *values*.
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    if len(set(weight for _value, weight in values)) == 1:
+        return percentile([value for value, _weight in values], percent)
+    limit = sum(weight for _value, weight in values) * percent / 100.0
+    total = 0
+    for value, weight in values:
+        total += weight
+        if total > limit:
+            return value
+    return values[-1][0]
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n')
@@ -19,10 +19,13 @@ import sys
 import unittest
 
 import zope.component
+import zope.interface
 from zope.component import eventtesting
+from zope.publisher.interfaces.browser import IDefaultBrowserLayer
 from zope.testing import cleanup
 from zope.traversing.testing import setUp as traversingSetUp
 
+import zope.viewlet.interfaces
 from zope.viewlet import manager as managers
 
 
@@ -80,6 +83,3285 @@ class TestViewletManagerBase(unittest.TestCase):
             manager['name']
 
 
+class DummyViewlet:
+    """A minimal viewlet class to be registered through ZCML."""
+
+    def __init__(self, context, request, view, manager):
+        self.context = context
+        self.manager = manager
+
+    def update(self):
+        pass
+
+    def render(self):
+        return 'dummy'
+
+
+class TestPublicRenderFastPath(unittest.TestCase):
+
+    def setUp(self):
+        cleanup.setUp()
+        from zope.configuration import xmlconfig
+        from zope.security.interfaces import IPermission
+        from zope.security.permission import Permission
+        zope.component.provideUtility(
+            Permission('zope.ManageContent'), IPermission,
+            'zope.ManageContent')
+        self.context = xmlconfig.string('''
+        <configure i18n_domain="zope">
+          <include package="zope.viewlet" file="meta.zcml" />
+        </configure>
+        ''')
+
+    def tearDown(self):
+        cleanup.tearDown()
+
+    def _register(self, name, permission):
+        from zope.configuration import xmlconfig
+        xmlconfig.string('''
+        <configure xmlns="http://namespaces.zope.org/browser"
+                   i18n_domain="zope">
+          <viewlet
+              name="%s"
+              class="zope.viewlet.tests.DummyViewlet"
+              permission="%s"
+              />
+        </configure>
+        ''' % (name, permission), context=self.context)
+        from zope.publisher.interfaces.browser import IBrowserView
+        from zope.publisher.interfaces.browser import IDefaultBrowserLayer
+        return zope.component.getGlobalSiteManager().adapters.lookup(
+            (zope.interface.Interface, IDefaultBrowserLayer, IBrowserView,
+             zope.viewlet.interfaces.IViewletManager),
+            zope.viewlet.interfaces.IViewlet, name=name)
+
+    def test_public_viewlets_are_marked(self):
+        factory = self._register('public', 'zope.Public')
+        self.assertTrue(factory.__dict__['__public_render__'])
+        protected = self._register('protected', 'zope.ManageContent')
+        self.assertNotIn('__public_render__', protected.__dict__)
+
+    def test_checkers_are_shared(self):
+        from zope.security.checker import getCheckerForInstancesOf
+        first = self._register('first', 'zope.Public')
+        second = self._register('second', 'zope.Public')
+        self.assertIs(getCheckerForInstancesOf(first),
+                      getCheckerForInstancesOf(second))
+
+    def test_filter_skips_canAccess_for_public_viewlets(self):
+        import zope.security
+        factory = self._register('public', 'zope.Public')
+        checked = []
+        orig_canAccess = zope.security.canAccess
+
+        def canAccess(obj, name):
+            checked.append(obj)
+            return False
+
+        zope.security.canAccess = canAccess
+        self.addCleanup(
+            lambda: setattr(zope.security, 'canAccess', orig_canAccess))
+
+        manager = managers.ViewletManagerBase(None, None, None)
+        viewlet = factory(None, None, None, manager)
+        self.assertEqual([('public', viewlet)],
+                         manager.filter([('public', viewlet)]))
+        self.assertEqual([], checked)
+
+        # Subclasses do not inherit the marker.
+        subclass = type('Subclass', (factory,), {})
+        other = subclass(None, None, None, manager)
+        self.assertEqual([], manager.filter([('other', other)]))
+        self.assertEqual([other], checked)
+
+
+class CacheStorageTests:
+
+    def _makeOne(self, maxBytes=1024):
+        raise NotImplementedError
+
+    def test_get_set(self):
+        storage = self._makeOne()
+        self.assertIsNone(storage.get('key'))
+        storage.set('key', '<p>\u2603</p>')
+        self.assertEqual('<p>\u2603</p>', storage.get('key'))
+        stats = storage.statistics()
+        self.assertEqual(1, stats['hits'])
+        self.assertEqual(1, stats['misses'])
+        self.assertEqual(1, stats['entries'])
+
+    def test_invalidate_and_clear(self):
+        storage = self._makeOne()
+        storage.set('one', 'first')
+        storage.set('two', 'second')
+        storage.invalidate('one')
+        storage.invalidate('unknown')
+        self.assertIsNone(storage.get('one'))
+        self.assertEqual('second', storage.get('two'))
+        storage.clear()
+        self.assertIsNone(storage.get('two'))
+        self.assertEqual(0, storage.statistics()['entries'])
+
+    def test_too_large(self):
+        storage = self._makeOne(maxBytes=1024)
+        storage.set('key', 'x' * 2048)
+        self.assertIsNone(storage.get('key'))
+        # The value stored before is not served instead.
+        storage.set('key', 'small')
+        storage.set('key', 'x' * 2048)
+        self.assertIsNone(storage.get('key'))
+        self.assertEqual(0, storage.statistics()['entries'])
+
+
+class TestLRUCacheStorage(CacheStorageTests, unittest.TestCase):
+
+    def _makeOne(self, maxBytes=1024):
+        from zope.viewlet.cache import LRUCacheStorage
+        return LRUCacheStorage(maxBytes)
+
+    def test_interface(self):
+        from zope.interface.verify import verifyObject
+
+        from zope.viewlet.interfaces import IViewletCacheStorage
+        verifyObject(IViewletCacheStorage, self._makeOne())
+
+    def test_evicts_least_recently_used(self):
+        storage = self._makeOne(maxBytes=10)
+        storage.set('one', 'aaaa')
+        storage.set('two', 'bbbb')
+        storage.get('one')
+        storage.set('three', 'cccc')
+        self.assertEqual('aaaa', storage.get('one'))
+        self.assertIsNone(storage.get('two'))
+        stats = storage.statistics()
+        self.assertEqual(1, stats['evictions'])
+        self.assertEqual(8, stats['size'])
+
+
+class TestCompressedCacheStorage(CacheStorageTests, unittest.TestCase):
+
+    def _makeOne(self, maxBytes=1024, compressor=None):
+        from zope.viewlet.cache import CompressedCacheStorage
+        return CompressedCacheStorage(maxBytes, compressor)
+
+    def _fragment(self, number):
+        return ('<li class="item"><a href="/items/%d">Item %d</a>'
+                '<span class="price">%d.00</span></li>' % (
+                    number, number, number * 7))
+
+    def test_interface(self):
+        from zope.interface.verify import verifyObject
+
+        from zope.viewlet.interfaces import IViewletCacheStorage
+        verifyObject(IViewletCacheStorage, self._makeOne())
+
+    def test_compressed(self):
+        storage = self._makeOne(maxBytes=10000)
+        value = '<ul>%s</ul>' % ''.join(
+            self._fragment(number) for number in range(100))
+        storage.set('key', value)
+        self.assertEqual(value, storage.get('key'))
+        stats = storage.statistics()
+        self.assertLess(stats['size'], 1024)
+        self.assertEqual(len(value), stats['rawSize'])
+        self.assertEqual(len(value) - stats['size'], stats['savedBytes'])
+        self.assertGreater(stats['compressSeconds'], 0)
+        self.assertGreater(stats['decompressSeconds'], 0)
+
+    def test_deduplicated(self):
+        storage = self._makeOne()
+        storage.set('one', 'same')
+        storage.set('two', 'same')
+        storage.set('two', 'same')
+        storage.set('three', 'other')
+        stats = storage.statistics()
+        self.assertEqual(3, stats['entries'])
+        self.assertEqual(2, stats['fragments'])
+        self.assertEqual(1, stats['deduplicated'])
+        self.assertEqual(13, stats['rawSize'])
+
+        storage.invalidate('one')
+        self.assertEqual('same', storage.get('two'))
+        storage.set('two', 'changed')
+        self.assertEqual(2, storage.statistics()['fragments'])
+        storage.invalidate('three')
+        storage.invalidate('two')
+        stats = storage.statistics()
+        self.assertEqual((0, 0, 0),
+                         (stats['fragments'], stats['size'],
+                          stats['rawSize']))
+
+    def test_evicts_least_recently_used(self):
+        from zope.viewlet.cache import FragmentCompressor
+        storage = self._makeOne(maxBytes=30,
+                                compressor=FragmentCompressor(level=0))
+        # Without compression, zlib adds 11 bytes to each value.
+        storage.set('one', 'aaaa')
+        storage.set('two', 'bbbb')
+        storage.get('one')
+        storage.set('three', 'cccc')
+        self.assertEqual('aaaa', storage.get('one'))
+        self.assertIsNone(storage.get('two'))
+        stats = storage.statistics()
+        self.assertEqual(1, stats['evictions'])
+        self.assertEqual(30, stats['size'])
+
+    def test_compressed_too_large(self):
+        from zope.viewlet.cache import FragmentCompressor
+        storage = self._makeOne(maxBytes=20,
+                                compressor=FragmentCompressor(level=0))
+        storage.set('key', 'aaaa')
+        # Fits uncompressed, but not with the 11 bytes zlib adds.
+        storage.set('key', 'x' * 15)
+        self.assertIsNone(storage.get('key'))
+        stats = storage.statistics()
+        self.assertEqual((0, 0, 0),
+                         (stats['entries'], stats['size'], stats['rawSize']))
+
+    def test_fragment_evicted_while_compressing(self):
+        storage = self._makeOne()
+        storage.set('one', 'same')
+        lock = storage._lock
+
+        class Lock:
+            def __enter__(self):
+                # Another thread removed the only value meanwhile.
+                storage._lock = lock
+                storage._remove('one')
+
+            def __exit__(self, *args):
+                pass
+
+        storage._lock = Lock()
+        storage.set('two', 'same')
+        self.assertIsNone(storage.get('one'))
+        self.assertEqual('same', storage.get('two'))
+        self.assertEqual(1, storage.statistics()['fragments'])
+
+    def test_dictionary(self):
+        from zope.viewlet.cache import FragmentCompressor
+        compressor = FragmentCompressor(dictionarySize=1024,
+                                        trainingBytes=2000)
+        storage = self._makeOne(maxBytes=100000, compressor=compressor)
+        for number in range(30):
+            storage.set(str(number), self._fragment(number))
+        self.assertTrue(compressor.trained)
+        for number in range(30, 100):
+            storage.set(str(number), self._fragment(number))
+        # Values compressed before and after training can be read.
+        for number in range(100):
+            self.assertEqual(self._fragment(number), storage.get(str(number)))
+
+        data = self._fragment(100).encode('ascii')
+        index, compressed = compressor.compress(data)
+        self.assertEqual(1, index)
+        plain = FragmentCompressor().compress(data)[1]
+        self.assertLess(len(compressed), len(plain) / 2)
+
+    def test_trainDictionary(self):
+        from zope.viewlet.cache import trainDictionary
+        samples = [b'<p class="x">first</p>', b'<p class="x">again</p>',
+                   b'<p>again</p>']
+        self.assertEqual(b'<p class="x">first</p><p class="x">again</p>',
+                         trainDictionary(samples))
+        self.assertEqual(b'<p class="x">again</p>',
+                         trainDictionary(samples, size=30))
+        self.assertEqual(b'', trainDictionary([]))
+
+
+class TestSharedMemoryCacheStorage(CacheStorageTests, unittest.TestCase):
+
+    def _makeOne(self, maxBytes=1024, slotSize=128):
+        from zope.viewlet.cache import SharedMemoryCacheStorage
+        return SharedMemoryCacheStorage(maxBytes, slotSize=slotSize)
+
+    def test_interface(self):
+        from zope.interface.verify import verifyObject
+
+        from zope.viewlet.interfaces import IViewletCacheStorage
+        verifyObject(IViewletCacheStorage, self._makeOne())
+
+    def test_colliding_keys_evict(self):
+        storage = self._makeOne(maxBytes=200, slotSize=128)
+        self.assertEqual(1, storage.slots)
+        storage.set('one', 'first')
+        storage.set('two', 'second')
+        self.assertIsNone(storage.get('one'))
+        self.assertEqual('second', storage.get('two'))
+        self.assertEqual(1, storage.statistics()['evictions'])
+
+    def test_incomplete_values_are_missing(self):
+        storage = self._makeOne(maxBytes=200, slotSize=128)
+        storage.set('key', 'complete \u2603')
+        start = storage._header.size + storage._slotHeader.size
+        # As if a process was killed while storing a longer value.
+        storage._map[start:start + 12] = b'incomplete \xe2'
+        self.assertIsNone(storage.get('key'))
+        storage._map[start:start + 12] = 'complete \u2603'.encode()
+        self.assertEqual('complete \u2603', storage.get('key'))
+        self.assertEqual(1, storage.statistics()['misses'])
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'requires fork()')
+    def test_shared_with_forked_processes(self):
+        storage = self._makeOne(maxBytes=64 * 1024)
+        pid = os.fork()
+        if pid == 0:  # pragma: no cover
+            storage.set('key', 'from the child')
+            os._exit(0)
+        os.waitpid(pid, 0)
+        self.assertEqual('from the child', storage.get('key'))
+        self.assertEqual(1, storage.statistics()['hits'])
+
+
+class TestFileCacheStorage(TestSharedMemoryCacheStorage):
+
+    def setUp(self):
+        import shutil
+        import tempfile
+        directory = tempfile.mkdtemp()
+        self.path = os.path.join(directory, 'viewlets.cache')
+        self.addCleanup(shutil.rmtree, directory)
+
+    def _makeOne(self, maxBytes=1024, slotSize=128):
+        from zope.viewlet.cache import FileCacheStorage
+        storage = FileCacheStorage(self.path, maxBytes, slotSize=slotSize)
+        self.addCleanup(storage.close)
+        return storage
+
+    def test_survives_reopening(self):
+        storage = self._makeOne()
+        storage.set('key', 'warm')
+        storage.get('key')
+        storage.flush()
+        storage = self._makeOne()
+        self.assertEqual('warm', storage.get('key'))
+        self.assertEqual(2, storage.statistics()['hits'])
+
+    def test_reinitialized_for_other_layout(self):
+        self._makeOne().set('key', 'stale')
+        self.assertIsNone(self._makeOne(slotSize=256).get('key'))
+        with open(self.path, 'r+b') as f:
+            f.write(b'garbage!')
+        self.assertEqual(0, self._makeOne(slotSize=256).statistics()[
+            'entries'])
+
+    def test_replaced_not_resized(self):
+        old = self._makeOne()
+        old.set('key', 'old')
+        new = self._makeOne(maxBytes=512)
+        self.assertIsNone(new.get('key'))
+        new.set('key', 'new')
+        # Processes using the old file are not disturbed.
+        self.assertEqual(len(old._map), os.fstat(old._fd).st_size)
+        self.assertEqual('old', old.get('key'))
+        old.set('other', 'still works')
+        self.assertEqual('still works', old.get('other'))
+        self.assertEqual('new', self._makeOne(maxBytes=512).get('key'))
+
+    def test_replacing_fails(self):
+        from unittest import mock
+        self._makeOne().set('key', 'old')
+        with mock.patch('os.replace', side_effect=OSError('full')):
+            self.assertRaises(OSError, self._makeOne, slotSize=256)
+        # The temporary file is removed and the old one kept.
+        self.assertEqual(
+            ['viewlets.cache', 'viewlets.cache.lock'],
+            sorted(os.listdir(os.path.dirname(self.path))))
+        self.assertEqual('old', self._makeOne().get('key'))
+
+
+class TestKeyValueCacheStorage(CacheStorageTests, unittest.TestCase):
+
+    def _makeOne(self, maxBytes=1024):
+        from zope.viewlet.cache import KeyValueCacheStorage
+        from zope.viewlet.cache import MemoryKeyValueClient
+        return KeyValueCacheStorage(MemoryKeyValueClient(), maxBytes=maxBytes)
+
+    def test_client_sees_hashed_keys_and_bytes(self):
+        from zope.viewlet.cache import KeyValueCacheStorage
+        from zope.viewlet.cache import MemoryKeyValueClient
+        client = MemoryKeyValueClient()
+        storage = KeyValueCacheStorage(client, prefix='site:')
+        storage.set('a key with spaces', 'value')
+        key, = client._storage._data
+        self.assertTrue(key.startswith('site:'))
+        self.assertNotIn(' ', key)
+        self.assertEqual(b'value', client.get(key))
+        with self.assertRaises(TypeError):
+            client.set(key, 'text')
+
+    def test_evictions_reported_by_client(self):
+        from zope.viewlet.cache import KeyValueCacheStorage
+        from zope.viewlet.cache import MemoryKeyValueClient
+        storage = KeyValueCacheStorage(MemoryKeyValueClient(maxBytes=8))
+        storage.set('one', 'aaaa')
+        storage.set('two', 'bbbb')
+        storage.set('three', 'cccc')
+        self.assertEqual(1, storage.statistics()['evictions'])
+
+
+class CountingViewlet:
+    """A cacheable viewlet counting its updates and renderings."""
+
+    updates = renders = 0
+    key = 'key'
+
+    def __init__(self, context, request, view, manager):
+        self.context = context
+
+    def cacheKey(self):
+        return self.key
+
+    def update(self):
+        from zope.viewlet.cache import dependsOn
+        from zope.viewlet.cache import dependsOnIndex
+        CountingViewlet.updates += 1
+        dependsOn(self.context)
+        dependsOnIndex('title')
+
+    def render(self):
+        CountingViewlet.renders += 1
+        return '<p>%s</p>' % self.context
+
+
+class TestTemplateVersion(unittest.TestCase):
+
+    def setUp(self):
+        cleanup.setUp()
+
+    def tearDown(self):
+        cleanup.tearDown()
+
+    def test_template_version(self):
+        import tempfile
+
+        from zope.viewlet.cache import templateVersion
+        with tempfile.NamedTemporaryFile(
+                'w', suffix='.pt', delete=False) as template:
+            template.write('<p>one</p>')
+        self.addCleanup(os.remove, template.name)
+
+        class Template:
+            filename = template.name
+
+        class Viewlet:
+            index = Template()
+
+        version = templateVersion(Viewlet)
+        self.assertEqual(16, len(version))
+        self.assertEqual('', templateVersion(CountingViewlet))
+
+        with open(template.name, 'w') as f:
+            f.write('<p>two</p>')
+        # Templates are only read once per class.
+        self.assertEqual(version, templateVersion(Viewlet))
+        cleanup.cleanUp()
+        self.assertNotEqual(version, templateVersion(Viewlet))
+
+        # Templates that cannot be read have no version.
+        Template.filename = template.name + '.missing'
+        cleanup.cleanUp()
+        self.assertEqual('', templateVersion(Viewlet))
+
+
+class TestViewletManagerCaching(unittest.TestCase):
+
+    def setUp(self):
+        from zope.security.checker import NamesChecker
+        from zope.security.checker import defineChecker
+        cleanup.setUp()
+        CountingViewlet.updates = CountingViewlet.renders = 0
+        defineChecker(CountingViewlet, NamesChecker(('update', 'render')))
+        zope.component.provideAdapter(
+            CountingViewlet, (None, None, None, None),
+            zope.viewlet.interfaces.IViewlet, name='counting')
+
+    def tearDown(self):
+        cleanup.tearDown()
+
+    def _makeManager(self, storage, context='content', template=None):
+        manager = managers.ViewletManagerBase(context, None, None)
+        manager.cacheStorage = storage
+        if template is not None:
+            manager.template = template
+        return manager
+
+    def test_hit_skips_update_and_render(self):
+        from zope.viewlet.cache import LRUCacheStorage
+        storage = LRUCacheStorage()
+        manager = self._makeManager(storage)
+        manager.update()
+        self.assertEqual('<p>content</p>', manager.render())
+        self.assertEqual((1, 1), (CountingViewlet.updates,
+                                  CountingViewlet.renders))
+
+        manager = self._makeManager(storage, context='changed')
+        manager.update()
+        self.assertEqual('<p>content</p>', manager.render())
+        self.assertEqual((1, 1), (CountingViewlet.updates,
+                                  CountingViewlet.renders))
+        self.assertEqual(1, storage.statistics()['hits'])
+
+    def test_uncacheable(self):
+        from zope.viewlet.cache import LRUCacheStorage
+        CountingViewlet.key = None
+        self.addCleanup(setattr, CountingViewlet, 'key', 'key')
+        storage = LRUCacheStorage()
+        for context in ('first', 'second'):
+            manager = self._makeManager(storage, context=context)
+            manager.update()
+            self.assertEqual('<p>%s</p>' % context, manager.render())
+        self.assertEqual(0, storage.statistics()['entries'])
+
+    def test_template_gets_rendered_viewlets(self):
+        from zope.viewlet.cache import LRUCacheStorage
+        storage = LRUCacheStorage()
+
+        def template(viewlets):
+            return ''.join(
+                viewlet.render() + viewlet() for viewlet in viewlets)
+
+        for _ in range(2):
+            manager = self._makeManager(storage, template=template)
+            manager.update()
+            self.assertEqual('<p>content</p><p>content</p>',
+                             manager.render())
+            viewlet, = manager.viewlets
+            self.assertIsInstance(viewlet, CountingViewlet)
+        self.assertEqual(1, CountingViewlet.renders)
+
+
+class Content:
+
+    def __init__(self, title):
+        self.title = title
+
+    def __str__(self):
+        return self.title
+
+
+class TestDependencyInvalidation(unittest.TestCase):
+
+    def setUp(self):
+        TestViewletManagerCaching.setUp(self)
+        from zope.viewlet.cache import LRUCacheStorage
+        self.storage = LRUCacheStorage()
+        self.content = Content('content')
+
+    def tearDown(self):
+        cleanup.tearDown()
+
+    def _render(self):
+        manager = managers.ViewletManagerBase(self.content, None, None)
+        manager.cacheStorage = self.storage
+        manager.update()
+        return manager.render()
+
+    def test_modified_dependency(self):
+        from zope.lifecycleevent import Attributes
+        from zope.lifecycleevent import ObjectModifiedEvent
+        from zope.lifecycleevent.interfaces import IObjectModifiedEvent
+
+        from zope.viewlet.cache import invalidateModified
+        self.assertEqual('<p>content</p>', self._render())
+        self.content.title = 'changed'
+
+        invalidateModified(ObjectModifiedEvent(
+            Content('other'), Attributes(IObjectModifiedEvent, 'body')))
+        self.assertEqual('<p>content</p>', self._render())
+        self.assertEqual(1, CountingViewlet.updates)
+
+        invalidateModified(ObjectModifiedEvent(self.content))
+        self.assertEqual('<p>changed</p>', self._render())
+        self.assertEqual(2, CountingViewlet.updates)
+
+    def test_modified_index(self):
+        from zope.lifecycleevent import Attributes
+        from zope.lifecycleevent import ObjectModifiedEvent
+        from zope.lifecycleevent.interfaces import IObjectModifiedEvent
+
+        from zope.viewlet.cache import invalidateModified
+        self._render()
+        invalidateModified(ObjectModifiedEvent(
+            Content('other'), Attributes(IObjectModifiedEvent, 'title')))
+        self._render()
+        self.assertEqual(2, CountingViewlet.updates)
+
+    def test_invalidateIndex(self):
+        from zope.viewlet.cache import invalidateIndex
+        self._render()
+        self.assertEqual(0, invalidateIndex('body'))
+        self.assertEqual(1, invalidateIndex('title'))
+        self.assertEqual(0, invalidateIndex('title'))
+        self._render()
+        self.assertEqual(2, CountingViewlet.updates)
+
+    def test_modified_without_indexes(self):
+        from zope.lifecycleevent import ObjectModifiedEvent
+
+        from zope.viewlet import cache
+        self.addCleanup(setattr, cache, 'invalidateIndexesOnModified', True)
+        cache.invalidateIndexesOnModified = False
+        self._render()
+        cache.invalidateModified(ObjectModifiedEvent(Content('other')))
+        self._render()
+        self.assertEqual(1, CountingViewlet.updates)
+
+    def test_evicted_entries_are_forgotten(self):
+        from zope.viewlet.cache import dependencies
+        self.storage.maxBytes = len('<p>content</p>')
+        self._render()
+        self.assertEqual(1, len(dependencies._entries))
+        self.storage.set('other', '<p>other</p>')
+        self.assertEqual({}, dependencies._entries)
+        self.assertEqual({}, dependencies._objects)
+        self.assertEqual({}, dependencies._indexes)
+
+    def test_entries_are_bounded(self):
+        from zope.viewlet.cache import DependencyIndex
+        from zope.viewlet.cache import DependencyRecorder
+        from zope.viewlet.cache import dependsOnIndex
+        index = DependencyIndex(maxEntries=1)
+        for key in ('first', 'second'):
+            self.storage.set(key, key)
+            with DependencyRecorder() as recorder:
+                dependsOnIndex('title')
+            index.register(self.storage, key, recorder)
+        self.assertIsNone(self.storage.get('first'))
+        self.assertEqual('second', self.storage.get('second'))
+        self.assertEqual(1, index.invalidateIndex('title'))
+        self.assertEqual({}, index._entries)
+
+    def test_storages_are_referenced_weakly(self):
+        import gc
+
+        from zope.viewlet.cache import dependencies
+        self._render()
+        del self.storage
+        gc.collect()
+        self.assertEqual(0, dependencies.invalidateObject(self.content))
+
+    def test_object_keys(self):
+        import gc
+
+        from zope.viewlet.cache import _objectKey
+        content = Content('content')
+        key = _objectKey(content)
+        self.assertEqual(key, _objectKey(content))
+        del content
+        gc.collect()
+        # A new object may get the id of the collected one.
+        self.assertNotEqual(key, _objectKey(Content('content')))
+        self.assertEqual(_objectKey('navigation'), _objectKey('navigation'))
+        self.assertRaises(TypeError, _objectKey, [])
+        self.assertNotEqual(key[1], 'navigation')
+
+        # Persistent objects loaded by different connections are the same.
+        first, second = Content('first'), Content('second')
+        first._p_oid = second._p_oid = b'\0' * 8
+        self.assertEqual(('oid', b'\0' * 8), _objectKey(first))
+        self.assertEqual(_objectKey(first), _objectKey(second))
+
+    def test_moved(self):
+        from zope.lifecycleevent import ObjectRemovedEvent
+
+        from zope.viewlet.cache import invalidateMoved
+        self._render()
+        invalidateMoved(
+            ObjectRemovedEvent(self.content, Content('folder'), 'content'))
+        self._render()
+        self.assertEqual(2, CountingViewlet.updates)
+
+    def test_dependencies_are_only_recorded_for_cached_output(self):
+        from zope.viewlet.cache import dependencies
+        from zope.viewlet.cache import dependsOn
+        dependsOn(self.content)
+        self.assertEqual({}, dependencies._objects)
+
+    def test_subscribers_registered_by_zcml(self):
+        import zope.lifecycleevent
+        from zope.configuration import xmlconfig
+        xmlconfig.string('''
+        <configure xmlns="http://namespaces.zope.org/zope">
+          <include package="zope.component" file="meta.zcml" />
+          <include package="zope.viewlet" />
+        </configure>
+        ''')
+        self._render()
+        zope.lifecycleevent.modified(self.content)
+        self._render()
+        self.assertEqual(2, CountingViewlet.updates)
+
+
+class ExpensiveViewlet:
+    """A viewlet whose availability is expensive to compute."""
+
+    evaluations = 0
+    key = 'expensive'
+
+    def __init__(self, context, request, view, manager):
+        pass
+
+    def availabilityKey(self):
+        return self.key
+
+    @property
+    def available(self):
+        ExpensiveViewlet.evaluations += 1
+        return True
+
+    def update(self):
+        pass
+
+    def render(self):
+        return 'expensive'
+
+
+class TestConditionalAvailabilityCache(unittest.TestCase):
+
+    def setUp(self):
+        from zope.security.checker import NamesChecker
+        from zope.security.checker import defineChecker
+        cleanup.setUp()
+        ExpensiveViewlet.evaluations = 0
+        defineChecker(ExpensiveViewlet, NamesChecker(('update', 'render')))
+        zope.component.provideAdapter(
+            ExpensiveViewlet, (None, None, None, None),
+            zope.viewlet.interfaces.IViewlet, name='expensive')
+
+    def tearDown(self):
+        cleanup.tearDown()
+
+    def _render(self, request, timeout=None):
+        manager = managers.ConditionalViewletManager(None, request, None)
+        manager.availabilityTimeout = timeout
+        manager.update()
+        return manager.render()
+
+    def test_once_per_request(self):
+        from zope.publisher.browser import TestRequest
+        request = TestRequest()
+        self.assertEqual('expensive', self._render(request))
+        self.assertEqual('expensive', self._render(request))
+        self.assertEqual(1, ExpensiveViewlet.evaluations)
+        self._render(TestRequest())
+        self.assertEqual(2, ExpensiveViewlet.evaluations)
+
+    def test_without_key(self):
+        from zope.publisher.browser import TestRequest
+        ExpensiveViewlet.key = None
+        self.addCleanup(setattr, ExpensiveViewlet, 'key', 'expensive')
+        request = TestRequest()
+        self._render(request)
+        self._render(request)
+        self.assertEqual(2, ExpensiveViewlet.evaluations)
+
+    def test_timeout(self):
+        from zope.publisher.browser import TestRequest
+        self._render(TestRequest(), timeout=60)
+        self._render(TestRequest(), timeout=60)
+        self.assertEqual(1, ExpensiveViewlet.evaluations)
+
+        managers.availabilityCache.clear()
+        self._render(TestRequest(), timeout=0)
+        self._render(TestRequest(), timeout=0)
+        self.assertEqual(3, ExpensiveViewlet.evaluations)
+
+    def test_key_per_class(self):
+        from zope.publisher.browser import TestRequest
+
+        class Hidden(ExpensiveViewlet):
+            available = False
+
+            def render(self):
+                return 'hidden'
+
+        from zope.security.checker import NamesChecker
+        from zope.security.checker import defineChecker
+        defineChecker(Hidden, NamesChecker(('update', 'render')))
+        zope.component.provideAdapter(
+            Hidden, (None, None, None, None),
+            zope.viewlet.interfaces.IViewlet, name='a')
+        for timeout in (None, 60):
+            self.assertEqual('expensive',
+                             self._render(TestRequest(), timeout=timeout))
+
+    def test_security_is_checked_for_every_manager(self):
+        import zope.security
+        from zope.publisher.browser import TestRequest
+        orig_canAccess = zope.security.canAccess
+        zope.security.canAccess = lambda obj, name: False
+        self.addCleanup(
+            setattr, zope.security, 'canAccess', orig_canAccess)
+        self.assertEqual('', self._render(TestRequest(), timeout=60))
+        self.assertEqual(0, ExpensiveViewlet.evaluations)
+
+    def test_key_only_computed_for_renderable_viewlets(self):
+        from unittest import mock
+
+        from zope.publisher.browser import TestRequest
+        with mock.patch('zope.security.canAccess', return_value=False), \
+                mock.patch.object(ExpensiveViewlet, 'availabilityKey',
+                                  autospec=True) as availabilityKey:
+            self.assertEqual('', self._render(TestRequest()))
+        availabilityKey.assert_not_called()
+
+    def test_without_available(self):
+        from zope.publisher.browser import TestRequest
+        from zope.security.checker import NamesChecker
+        from zope.security.checker import defineChecker
+
+        class Viewlet(ExpensiveViewlet):
+            available = property(lambda self: self.missing)
+
+        defineChecker(Viewlet, NamesChecker(('update', 'render')))
+        zope.component.provideAdapter(
+            Viewlet, (None, None, None, None),
+            zope.viewlet.interfaces.IViewlet, name='expensive')
+        for key in ('expensive', None):
+            Viewlet.key = key
+            self.assertEqual('expensive', self._render(TestRequest()))
+
+    def test_render_not_checked(self):
+        from zope.publisher.browser import TestRequest
+        from zope.security.checker import NamesChecker
+        from zope.security.checker import defineChecker
+
+        class Viewlet(ExpensiveViewlet):
+            pass
+
+        # Viewlets whose checker does not know render are available.
+        defineChecker(Viewlet, NamesChecker(('update',)))
+        zope.component.provideAdapter(
+            Viewlet, (None, None, None, None),
+            zope.viewlet.interfaces.IViewlet, name='expensive')
+        self.assertEqual('expensive', self._render(TestRequest()))
+        self.assertEqual(0, ExpensiveViewlet.evaluations)
+        self.assertTrue(managers.isAvailable(Viewlet(None, None, None, None)))
+
+    def test_without_annotations(self):
+        self.assertEqual('expensive', self._render(None))
+        self.assertEqual('expensive', self._render(None))
+        self.assertEqual(2, ExpensiveViewlet.evaluations)
+
+    def test_expired_entries_purged(self):
+        cache = managers.AvailabilityCache()
+        cache.maxEntries = 1
+        self.assertTrue(cache.get('expired', 0, lambda: True))
+        self.assertFalse(cache.get('current', 60, lambda: False))
+        self.assertFalse(cache.get('current', 60, lambda: True))
+        self.assertEqual(['current'], list(cache._data))
+
+
+class NamedViewlet:
+    """A viewlet rendering the name it was registered with."""
+
+    def __init__(self, context, request, view, manager):
+        self.updated = False
+
+    def update(self):
+        self.updated = True
+
+    def render(self):
+        return '<%s>' % self.name
+
+
+def registerNamedViewlets(*names, **kw):
+    from zope.security.checker import NamesChecker
+    from zope.security.checker import defineChecker
+    required = kw.pop('required', (None, None, None, None))
+    base = kw.pop('base', NamedViewlet)
+    for name in names:
+        attributes = dict(kw, name=name)
+        factory = type('NamedViewlet_' + name, (base,), attributes)
+        defineChecker(factory, NamesChecker(('update', 'render')))
+        zope.component.provideAdapter(
+            factory, required, zope.viewlet.interfaces.IViewlet, name=name)
+
+
+class TestPartialUpdate(unittest.TestCase):
+
+    def setUp(self):
+        cleanup.setUp()
+        registerNamedViewlets('a', 'b', 'c')
+
+    def tearDown(self):
+        cleanup.tearDown()
+
+    def test_update_names(self):
+        manager = managers.ViewletManagerBase(None, None, None)
+        manager.update(names=['c', 'a', 'unknown'])
+        self.assertEqual(['a', 'c'], [v.name for v in manager.viewlets])
+        self.assertTrue(all(v.updated for v in manager.viewlets))
+        self.assertEqual('<a>\n<c>', manager.render())
+
+    def test_update_names_filters(self):
+        import zope.security
+        orig_canAccess = zope.security.canAccess
+        zope.security.canAccess = lambda obj, name: obj.name != 'b'
+        self.addCleanup(setattr, zope.security, 'canAccess', orig_canAccess)
+        manager = managers.ViewletManagerBase(None, None, None)
+        manager.update(names=['a', 'b'])
+        self.assertEqual(['a'], [v.name for v in manager.viewlets])
+
+    def test_render_names(self):
+        manager = managers.WeightOrderedViewletManager(None, None, None)
+        manager.update()
+        self.assertEqual('<a>\n<b>\n<c>', manager.render())
+        self.assertEqual('<a>\n<c>', manager.render(names=('c', 'a')))
+        manager.template = lambda viewlets: [v.name for v in viewlets]
+        self.assertEqual(['b'], manager.render(names=['b']))
+
+
+class TestViewletLookups(unittest.TestCase):
+
+    def setUp(self):
+        cleanup.setUp()
+        registerNamedViewlets('a', 'b')
+
+    def tearDown(self):
+        cleanup.tearDown()
+
+    def _countQueries(self):
+        orig_query = zope.component.queryMultiAdapter
+        calls = []
+
+        def query(*args, **kw):
+            calls.append(kw['name'])
+            return orig_query(*args, **kw)
+
+        zope.component.queryMultiAdapter = query
+        self.addCleanup(
+            setattr, zope.component, 'queryMultiAdapter', orig_query)
+        return calls
+
+    def test_lookups_are_remembered(self):
+        import zope.security
+        from zope.interface.interfaces import ComponentLookupError
+        from zope.security.interfaces import Unauthorized
+        orig_canAccess = zope.security.canAccess
+        zope.security.canAccess = lambda obj, name: obj.name != 'b'
+        self.addCleanup(setattr, zope.security, 'canAccess', orig_canAccess)
+        calls = self._countQueries()
+        manager = managers.ViewletManagerBase(None, None, None)
+        self.assertIs(manager['a'], manager.get('a'))
+        self.assertIn('a', manager)
+        self.assertIsNone(manager.get('b'))
+        self.assertNotIn('b', manager)
+        self.assertRaises(Unauthorized, manager.__getitem__, 'b')
+        self.assertEqual('default', manager.get('unknown', 'default'))
+        self.assertRaises(ComponentLookupError, manager.__getitem__,
+                          'unknown')
+        self.assertEqual(['a', 'b', 'unknown'], calls)
+
+    def test_subclass_lookups(self):
+        import zope.security
+        orig_canAccess = zope.security.canAccess
+        zope.security.canAccess = lambda obj, name: obj.name != 'b'
+        self.addCleanup(setattr, zope.security, 'canAccess', orig_canAccess)
+        items = []
+
+        class Manager(managers.ViewletManagerBase):
+            def __getitem__(self, name):
+                items.append(name)
+                return super().__getitem__(name)
+
+        # get and __contains__ use the lookup of the subclass, which
+        # remembers the viewlets like the base class does.
+        calls = self._countQueries()
+        manager = Manager(None, None, None)
+        self.assertIs(manager.get('a'), manager.get('a'))
+        self.assertIn('a', manager)
+        self.assertIsNone(manager.get('b'))
+        self.assertNotIn('b', manager)
+        self.assertEqual('default', manager.get('c', 'default'))
+        self.assertNotIn('c', manager)
+        self.assertEqual(['a', 'a', 'a', 'b', 'b', 'c', 'c'], items)
+        self.assertEqual(['a', 'b', 'c'], calls)
+        self.assertEqual({'a', 'b', 'c'}, set(manager._lookups))
+
+        # Misses are remembered until the registry changes.
+        self.assertNotIn('c', Manager(None, None, None))
+        self.assertEqual(['a', 'b', 'c'], calls)
+        adapters = zope.component.getSiteManager().adapters
+        generation = adapters._generation
+        registerNamedViewlets('c')
+        self.assertNotEqual(generation, adapters._generation)
+        self.assertIn('c', Manager(None, None, None))
+        self.assertEqual(['a', 'b', 'c', 'c'], calls)
+
+    def test_active_viewlets_are_returned(self):
+        manager = managers.ViewletManagerBase(None, None, None)
+        manager.update()
+        self.assertIs(manager.viewlets[0], manager['a'])
+        self.assertTrue(manager['b'].updated)
+
+    def test_misses_are_remembered_across_requests(self):
+        calls = self._countQueries()
+        for _ in range(2):
+            manager = managers.ViewletManagerBase(None, None, None)
+            self.assertNotIn('c', manager)
+        self.assertEqual(['c'], calls)
+
+        # Registering a viewlet invalidates the remembered misses.
+        registerNamedViewlets('c')
+        manager = managers.ViewletManagerBase(None, None, None)
+        self.assertIn('c', manager)
+        self.assertEqual(['c', 'c'], calls)
+
+    def test_factories_returning_none_are_not_remembered(self):
+        zope.component.provideAdapter(
+            lambda *args: None, (None, None, None, None),
+            zope.viewlet.interfaces.IViewlet, name='none')
+        calls = self._countQueries()
+        for _ in range(2):
+            manager = managers.ViewletManagerBase(None, None, None)
+            self.assertNotIn('none', manager)
+        self.assertEqual(['none', 'none'], calls)
+
+
+class IRow(zope.interface.Interface):
+    pass
+
+
+class TestRenderRows(unittest.TestCase):
+
+    def setUp(self):
+        cleanup.setUp()
+        registerNamedViewlets('a', 'b')
+        registerNamedViewlets('row', required=(IRow, None, None, None))
+
+    def tearDown(self):
+        cleanup.tearDown()
+
+    def _rows(self):
+        rows = [Content(str(index)) for index in range(4)]
+        zope.interface.alsoProvides(rows[1], IRow)
+        return rows
+
+    def test_renderRows(self):
+        adapters = zope.component.getSiteManager().adapters
+        orig_lookupAll = adapters.lookupAll
+        lookups = []
+
+        def lookupAll(*args):
+            lookups.append(args)
+            return orig_lookupAll(*args)
+
+        adapters.lookupAll = lookupAll
+        self.addCleanup(delattr, adapters, 'lookupAll')
+        outputs = managers.WeightOrderedViewletManager.renderRows(
+            self._rows(), None, None)
+        self.assertEqual(['<a>\n<b>', '<a>\n<b>\n<row>', '<a>\n<b>',
+                          '<a>\n<b>'], outputs)
+        self.assertEqual(2, len(lookups))
+
+    def test_sharedSecurity(self):
+        import zope.security
+        orig_canAccess = zope.security.canAccess
+        checked = []
+
+        def canAccess(obj, name):
+            checked.append(obj.name)
+            return obj.name != 'b'
+
+        zope.security.canAccess = canAccess
+        self.addCleanup(setattr, zope.security, 'canAccess', orig_canAccess)
+        outputs = managers.ConditionalViewletManager.renderRows(
+            self._rows(), None, None, sharedSecurity=True)
+        self.assertEqual(['<a>', '<a>\n<row>', '<a>', '<a>'], outputs)
+        self.assertEqual(['a', 'b', 'row'], sorted(checked))
+
+        del checked[:]
+        managers.ViewletManagerBase.renderRows(self._rows(), None, None)
+        self.assertEqual(9, len(checked))
+
+
+class FileResource:
+    """A resource published from the file at its ``path``."""
+
+    path = None
+
+    def __init__(self, request):
+        self.request = request
+
+    def __call__(self):
+        return '/@@/' + os.path.basename(self.path)
+
+
+class ResourceViewletTests:
+
+    def setUp(self):
+        import shutil
+        import tempfile
+        doctestSetUp(self)
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def tearDown(self):
+        doctestTearDown(self)
+
+    def _provideResource(self, name, data):
+        path = os.path.join(self.directory, name)
+        with open(path, 'w') as file:
+            file.write(data)
+        zope.component.provideAdapter(
+            type('FileResource', (FileResource,), {'path': path}),
+            (IDefaultBrowserLayer,), zope.interface.Interface, name=name)
+
+    def _render(self, factory):
+        from zope.publisher.browser import BrowserView
+        from zope.publisher.browser import TestRequest
+        request = TestRequest()
+        view = BrowserView(None, request)
+        return factory(None, request, view, None).render().strip()
+
+
+class TestVersionedResources(ResourceViewletTests, unittest.TestCase):
+
+    def test_versioned_urls(self):
+        import hashlib
+
+        from zope.viewlet import viewlet
+        version = hashlib.blake2b(b'alert(1);', digest_size=8).hexdigest()
+        self._provideResource('site.js', 'alert(1);')
+        self._provideResource('site.css', 'body {}')
+        self.assertEqual(
+            '<script type="text/javascript" src="/@@/site.js"></script>',
+            self._render(viewlet.JavaScriptViewlet('site.js')))
+        self.assertEqual(
+            '<script type="text/javascript"'
+            ' src="/@@/site.js?v=%s"></script>' % version,
+            self._render(viewlet.JavaScriptViewlet('site.js',
+                                                   versioned=True)))
+        self.assertIn(
+            'href="/@@/site.css?v=',
+            self._render(viewlet.CSSViewlet('site.css', versioned=True)))
+        self.assertEqual(2, self._render(viewlet.JavaScriptBundleViewlet(
+            ('site.js', 'site.js'), versioned=True)).count('?v=' + version))
+        self.assertIn('?v=', self._render(viewlet.CSSBundleViewlet(
+            [{'path': 'site.css'}], versioned=True)))
+
+    def test_versions_are_read_once(self):
+        from zope.viewlet import resource
+        from zope.viewlet import viewlet
+        self._provideResource('site.js', 'alert(1);')
+        factory = viewlet.JavaScriptViewlet('site.js', versioned=True)
+        first = self._render(factory)
+        with open(os.path.join(self.directory, 'site.js'), 'w') as file:
+            file.write('alert(2);')
+        self.assertEqual(first, self._render(factory))
+        resource._versions.clear()
+        self.assertNotEqual(first, self._render(factory))
+
+    def test_resources_without_files(self):
+        from zope.viewlet import resource
+        self.assertEqual('/@@/r.js?query=1', resource.versionedURL(
+            lambda: '/@@/r.js?query=1'))
+        res = FileResource(None)
+        res.path = os.path.join(self.directory, 'missing.js')
+        self.assertEqual('/@@/missing.js', resource.versionedURL(res))
+
+
+class TestInlineResources(ResourceViewletTests, unittest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self._provideResource('small.js', 'alert(1);\n')
+        self._provideResource('large.js', 'alert(2);\n' * 100)
+        self._provideResource('small.css', '/* Small */\n  body {\n'
+                                           '    margin: 0;\n  }\n')
+
+    def test_inline(self):
+        from zope.viewlet import viewlet
+        self.assertEqual(
+            '<script type="text/javascript">alert(1);\n</script>',
+            self._render(viewlet.JavaScriptViewlet(
+                'small.js', inlineThreshold=100)))
+        self.assertEqual(
+            '<script type="text/javascript" src="/@@/large.js"></script>',
+            self._render(viewlet.JavaScriptViewlet(
+                'large.js', inlineThreshold=100)))
+
+    def test_inline_css(self):
+        from zope.viewlet import resource
+        from zope.viewlet import viewlet
+        self.assertEqual(
+            '<style type="text/css" media="print">body {\nmargin: 0;\n}'
+            '</style>',
+            self._render(viewlet.CSSViewlet(
+                'small.css', media='print', inlineThreshold=100,
+                minify=resource.minifyCSS)))
+        self.assertIn('<link', self._render(viewlet.CSSViewlet(
+            'small.css', rel='alternate stylesheet', inlineThreshold=100)))
+
+    def test_inline_bundles(self):
+        from zope.viewlet import viewlet
+        output = self._render(viewlet.JavaScriptBundleViewlet(
+            ('large.js', 'small.js'), versioned=True, inlineThreshold=100))
+        self.assertLess(output.index('src="/@@/large.js?v='),
+                        output.index('>alert(1);'))
+        output = self._render(viewlet.CSSBundleViewlet(
+            [{'path': 'small.css', 'media': 'screen'},
+             {'path': 'small.css', 'rel': 'icon'}], inlineThreshold=100))
+        self.assertIn('<style type="text/css" media="screen">/* Small',
+                      output)
+        self.assertIn('rel="icon" href="/@@/small.css"', output)
+
+    def test_unsafe_contents_are_not_inlined(self):
+        from zope.viewlet import viewlet
+        self._provideResource('unsafe.js', 'document.write("</SCRIPT>");')
+        self.assertIn('src="/@@/unsafe.js"', self._render(
+            viewlet.JavaScriptViewlet('unsafe.js', inlineThreshold=100)))
+
+    def test_relative_urls_are_not_inlined(self):
+        from zope.viewlet import viewlet
+        for name, data in [('image.css', 'a { background: url(a.png) }'),
+                           ('quoted.css', 'a { background: url( "a.png") }'),
+                           ('import.css', '@import "base.css";'),
+                           ('parent.css', '@import url(../base.css);')]:
+            self._provideResource(name, data)
+            self.assertIn('<link', self._render(viewlet.CSSViewlet(
+                name, inlineThreshold=100)))
+            self.assertIn('<link', self._render(viewlet.CSSBundleViewlet(
+                [{'path': name}], inlineThreshold=100)))
+        self._provideResource(
+            'absolute.css', 'a { background: url("/@@/a.png") }\n'
+            'b { background: url(data:image/png;base64,AAAA) }\n'
+            'c { filter: url(#blur) }\n@import "https://cdn/base.css";')
+        self.assertIn('<style', self._render(viewlet.CSSViewlet(
+            'absolute.css', inlineThreshold=200)))
+
+    def test_contents_are_read_once(self):
+        from zope.viewlet import viewlet
+        factory = viewlet.JavaScriptViewlet('small.js', inlineThreshold=100)
+        first = self._render(factory)
+        self._provideResource('small.js', 'alert(3);\n')
+        self.assertEqual(first, self._render(factory))
+
+
+class TestScriptLoading(ResourceViewletTests, unittest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self._provideResource('a.js', 'a();')
+        self._provideResource('b.js', 'b();')
+
+    def test_loading(self):
+        from zope.viewlet import viewlet
+        self.assertEqual(
+            '<script type="text/javascript" src="/@@/a.js"'
+            ' defer="defer"></script>',
+            self._render(viewlet.JavaScriptViewlet('a.js', loading='defer')))
+        self.assertEqual(
+            '<script type="text/javascript" src="/@@/a.js"'
+            ' async="async"></script>',
+            self._render(viewlet.JavaScriptViewlet('a.js', loading='async')))
+        self.assertEqual(
+            '<script type="module" src="/@@/a.js"></script>',
+            self._render(viewlet.JavaScriptViewlet('a.js',
+                                                   loading='module')))
+        self.assertRaises(ValueError, viewlet.JavaScriptViewlet, 'a.js',
+                          loading='lazy')
+
+    def test_inline_blocking_scripts_only(self):
+        from zope.viewlet import viewlet
+        self.assertEqual(
+            '<script type="text/javascript">a();</script>',
+            self._render(viewlet.JavaScriptViewlet(
+                'a.js', inlineThreshold=100)))
+        for loading in ('defer', 'async', 'module'):
+            self.assertIn('src="/@@/a.js"', self._render(
+                viewlet.JavaScriptViewlet(
+                    'a.js', loading=loading, inlineThreshold=100)))
+
+    def test_relative_imports_are_not_inlined(self):
+        from zope.viewlet import viewlet
+        self._provideResource('lazy.js', 'import( "./chart.js");')
+        self._provideResource('cdn.js', 'import("https://cdn/chart.js");')
+        self.assertIn('src="/@@/lazy.js"', self._render(
+            viewlet.JavaScriptViewlet('lazy.js', inlineThreshold=100)))
+        self.assertIn('src="/@@/lazy.js"', self._render(
+            viewlet.JavaScriptBundleViewlet(('lazy.js',),
+                                            inlineThreshold=100)))
+        self.assertIn('>import("https://cdn', self._render(
+            viewlet.JavaScriptViewlet('cdn.js', inlineThreshold=100)))
+
+    def test_bundles_keep_their_order(self):
+        from zope.viewlet import viewlet
+        output = self._render(viewlet.JavaScriptBundleViewlet(
+            ('a.js', 'b.js'), loading='async', inlineThreshold=100))
+        self.assertEqual(2, output.count('defer="defer"'))
+        self.assertNotIn('async', output)
+        self.assertLess(output.index('a.js'), output.index('b.js'))
+        output = self._render(viewlet.JavaScriptBundleViewlet(
+            ('a.js', 'b.js'), loading='async', ordered=False))
+        self.assertEqual(2, output.count('async="async"'))
+        output = self._render(viewlet.JavaScriptBundleViewlet(
+            ('a.js', 'b.js'), loading='module', inlineThreshold=100))
+        self.assertEqual(2, output.count('<script type="module" src='))
+
+
+class ValidatedViewlet(NamedViewlet):
+
+    token = modified = None
+
+    def validationToken(self):
+        return self.token
+
+    def lastModified(self):
+        return self.modified
+
+
+class TestValidators(unittest.TestCase):
+
+    def setUp(self):
+        cleanup.setUp()
+        registerNamedViewlets('a', base=ValidatedViewlet, token='1',
+                              modified=500)
+        registerNamedViewlets('b', base=ValidatedViewlet, modified=1000)
+
+    def tearDown(self):
+        cleanup.tearDown()
+
+    def test_validator(self):
+        manager = managers.ViewletManagerBase(None, None, None)
+        validator = manager.validator()
+        self.assertEqual(1000, validator.lastModified)
+        self.assertEqual(validator, managers.ViewletManagerBase(
+            None, None, None).validator())
+
+        # The viewlets were not updated, but are used by update().
+        candidates = [viewlet for _name, viewlet in manager._candidates]
+        self.assertFalse(any(viewlet.updated for viewlet in candidates))
+        manager.update()
+        self.assertEqual(candidates, manager.viewlets)
+        self.assertTrue(all(viewlet.updated for viewlet in candidates))
+
+        registerNamedViewlets('a', base=ValidatedViewlet, token='2')
+        self.assertNotEqual(validator, managers.ViewletManagerBase(
+            None, None, None).validator())
+
+    def test_unvalidated_viewlets(self):
+        from zope.viewlet import validators
+        registerNamedViewlets('c')
+        manager = managers.ViewletManagerBase(None, None, None)
+        self.assertIsNone(manager.validator())
+        self.assertIsNone(validators.pageValidator([manager]))
+
+    def test_conditional_requests(self):
+        from zope.publisher.browser import TestRequest
+
+        from zope.viewlet import validators
+        manager = managers.ViewletManagerBase(None, None, None)
+        validator = validators.pageValidator([manager])
+        request = TestRequest()
+        self.assertFalse(validators.notModified(request, validator))
+        validators.setValidatorHeaders(request.response, validator)
+        etag = request.response.getHeader('ETag')
+        self.assertEqual('Thu, 01 Jan 1970 00:16:40 GMT',
+                         request.response.getHeader('Last-Modified'))
+
+        request = TestRequest(HTTP_IF_NONE_MATCH='"other", W/' + etag)
+        self.assertTrue(validators.notModified(request, validator))
+        request = TestRequest(HTTP_IF_NONE_MATCH='"other"',
+                              HTTP_IF_MODIFIED_SINCE='Thu, 01 Jan 1970 '
+                                                     '00:16:40 GMT')
+        self.assertFalse(validators.notModified(request, validator))
+        request = TestRequest(
+            HTTP_IF_MODIFIED_SINCE='Thu, 01 Jan 1970 00:16:40 GMT')
+        self.assertTrue(validators.notModified(request, validator))
+        request = TestRequest(
+            HTTP_IF_MODIFIED_SINCE='Thu, 01 Jan 1970 00:16:39 GMT')
+        self.assertFalse(validators.notModified(request, validator))
+
+    def test_notModified(self):
+        import datetime
+
+        from zope.publisher.browser import TestRequest
+
+        from zope.viewlet import validators
+        modified = datetime.datetime(
+            1970, 1, 1, 0, 16, 40, tzinfo=datetime.timezone.utc)
+        validator = validators.Validator('token', validators._timestamp(
+            modified))
+        self.assertEqual(1000.0, validator.lastModified)
+
+        def notModified(validator=validator, **headers):
+            return validators.notModified(TestRequest(**headers), validator)
+
+        # Weak tags match their strong equivalents.
+        self.assertTrue(notModified(HTTP_IF_NONE_MATCH='W/"token"'))
+        self.assertTrue(notModified(HTTP_IF_NONE_MATCH='"other", *'))
+        self.assertFalse(notModified(HTTP_IF_NONE_MATCH='W/"other"'))
+        self.assertFalse(notModified(HTTP_IF_NONE_MATCH='token'))
+        # If-Modified-Since alone.
+        self.assertTrue(notModified(
+            HTTP_IF_MODIFIED_SINCE='Thu, 01 Jan 1970 00:16:41 GMT'))
+        self.assertTrue(notModified(
+            HTTP_IF_MODIFIED_SINCE='Thu, 01 Jan 1970 00:16:40 -0000'))
+        self.assertFalse(notModified(
+            HTTP_IF_MODIFIED_SINCE='Thu, 01 Jan 1970 00:16:39 -0000'))
+        for malformed in ('yesterday', '', 'Thu, 99 Foo 1970 00:16:40 GMT'):
+            self.assertFalse(notModified(HTTP_IF_MODIFIED_SINCE=malformed),
+                             malformed)
+        # Without a known modification time, only tags are compared.
+        unknown = validators.Validator('token', None)
+        self.assertFalse(notModified(
+            unknown, HTTP_IF_MODIFIED_SINCE='Thu, 01 Jan 1970 00:16:41 GMT'))
+        self.assertTrue(notModified(unknown, HTTP_IF_NONE_MATCH='"token"'))
+        self.assertFalse(notModified(None, HTTP_IF_NONE_MATCH='*'))
+
+    def test_headers(self):
+        from zope.publisher.browser import TestRequest
+
+        from zope.viewlet import validators
+        response = TestRequest().response
+        validators.setValidatorHeaders(response, None)
+        self.assertIsNone(response.getHeader('ETag'))
+        validators.setValidatorHeaders(
+            response, validators.Validator('token', None))
+        self.assertEqual('"token"', response.getHeader('ETag'))
+        self.assertIsNone(response.getHeader('Last-Modified'))
+
+
+class TestStatistics(unittest.TestCase):
+
+    def setUp(self):
+        cleanup.setUp()
+        registerNamedViewlets('a', 'b')
+
+    def tearDown(self):
+        cleanup.tearDown()
+
+    def _render(self, statistics, times=1):
+        import zope.security
+        orig_canAccess = zope.security.canAccess
+        zope.security.canAccess = lambda obj, name: obj.name != 'b'
+        self.addCleanup(setattr, zope.security, 'canAccess', orig_canAccess)
+        for _ in range(times):
+            manager = managers.ViewletManagerBase(None, None, None)
+            manager.__name__ = 'column'
+            manager.statistics = statistics
+            manager.update()
+            self.assertEqual('<a>', manager.render())
+
+    def test_report(self):
+        from zope.viewlet.stats import ViewletStatistics
+        statistics = ViewletStatistics(sampleRate=1)
+        self._render(statistics, 3)
+        a, b = statistics.report()
+        self.assertEqual(('column', 'a', 3, 3, 3.0, 1.0),
+                         (a.manager, a.name, a.renders, a.samples,
+                          a.meanBytes, a.availability))
+        self.assertIsNotNone(a.p95Time)
+        self.assertEqual(('b', 0, None, 0.0),
+                         (b.name, b.samples, b.meanTime, b.availability))
+
+    def test_measured_when_rendered(self):
+        import zope.security
+
+        from zope.viewlet.stats import ViewletStatistics
+        orig_canAccess = zope.security.canAccess
+        zope.security.canAccess = lambda obj, name: True
+        self.addCleanup(setattr, zope.security, 'canAccess', orig_canAccess)
+        statistics = ViewletStatistics(sampleRate=1)
+        manager = managers.ViewletManagerBase(None, None, None)
+        manager.__name__ = 'column'
+        manager.statistics = statistics
+        # Only renders the first viewlet, twice.
+        manager.template = lambda viewlets: \
+            viewlets[0].render() + viewlets[0]()
+        manager.update()
+        self.assertEqual('<a><a>', manager.render())
+        a, b = statistics.report()
+        self.assertEqual((1, 1.0), (a.samples, a.availability))
+        self.assertEqual((0, 1.0), (b.samples, b.availability))
+
+    def test_sampling(self):
+        from zope.viewlet.stats import ViewletStatistics
+        statistics = ViewletStatistics(sampleRate=0)
+        self._render(statistics, 3)
+        self.assertEqual([], statistics.report())
+
+    def test_reservoir(self):
+        from zope.viewlet.stats import ViewletStatistics
+        statistics = ViewletStatistics(sampleRate=1, reservoirSize=10)
+        for index in range(100):
+            statistics.addRendering('m', 'v', index / 100.0, 10)
+        report, = statistics.report()
+        self.assertEqual(100, report.samples)
+        self.assertAlmostEqual(0.495, report.meanTime)
+        self.assertEqual(10, len(
+            statistics._shards.get().aggregates['m', 'v'].times))
+
+    def test_percentiles(self):
+        from zope.viewlet.stats import _weightedPercentile
+        from zope.viewlet.stats import percentile
+        self.assertIsNone(percentile([], 95))
+        self.assertIsNone(_weightedPercentile([], 95))
+        self.assertEqual(3, percentile([1, 2, 3, 4], 50))
+        self.assertEqual(4, percentile([1, 2, 3, 4], 100))
+        # Equal weights do not change the percentiles.
+        self.assertEqual(3, _weightedPercentile(
+            [(4, 5), (2, 5), (1, 5), (3, 5)], 50))
+        values = [(3, 8), (1, 1), (2, 1)]
+        self.assertEqual(1, _weightedPercentile(values, 0))
+        self.assertEqual(2, _weightedPercentile(values, 10))
+        self.assertEqual(3, _weightedPercentile(values, 20))
+        self.assertEqual(3, _weightedPercentile(values, 95))
+        self.assertEqual(3, _weightedPercentile(values, 100))
+
+    def test_weighted_p95(self):
+        import threading
+
+        from zope.viewlet.stats import ViewletStatistics
+        statistics = ViewletStatistics(sampleRate=1, reservoirSize=10)
+
+        def fast():
+            # Only 10 of the 100 times are kept, each weighing 10.
+            for _ in range(100):
+                statistics.addRendering('m', 'v', 0.1, 10)
+
+        thread = threading.Thread(target=fast)
+        thread.start()
+        thread.join()
+        for _ in range(2):
+            statistics.addRendering('m', 'v', 1.0, 10)
+        report, = statistics.report()
+        self.assertEqual(102, report.samples)
+        # Unweighted, 2 of 12 kept times would be above the 95th
+        # percentile.
+        self.assertEqual(0.1, report.p95Time)
+        for _ in range(8):
+            statistics.addRendering('m', 'v', 1.0, 10)
+        report, = statistics.report()
+        self.assertEqual(1.0, report.p95Time)
+
+    def test_clear(self):
+        from zope.viewlet.stats import ThreadShards
+        from zope.viewlet.stats import ViewletStatistics
+        statistics = ViewletStatistics(sampleRate=1)
+        statistics.addRendering('m', 'v', 0.1, 10)
+        statistics.clear()
+        self.assertEqual([], statistics.report())
+
+        def factory():
+            # Cleared while the shard of this thread is created.
+            shards.clear()
+            return []
+
+        shards = ThreadShards(factory)
+        self.assertEqual([], shards.get())
+        self.assertEqual([], shards.all())
+
+    def test_text_file_not_written(self):
+        import shutil
+        import tempfile
+
+        from zope.viewlet.stats import ViewletStatistics
+        statistics = ViewletStatistics(sampleRate=1)
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'viewlets.prom')
+        os.mkdir(path)
+        self.assertRaises(OSError, statistics.writeTextFile, path)
+        self.assertEqual(['viewlets.prom'], os.listdir(directory))
+
+    def test_text_file(self):
+        import shutil
+        import tempfile
+
+        from zope.viewlet.stats import ViewletStatistics
+        statistics = ViewletStatistics(sampleRate=0.5)
+        statistics.addRendering('m"1', 'v', 0.25, 10)
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'viewlets.prom')
+        statistics.writeTextFile(path)
+        with open(path) as file:
+            text = file.read()
+        self.assertEqual(['viewlets.prom'], os.listdir(directory))
+        self.assertIn('# TYPE zope_viewlet_renders_total counter\n'
+                      'zope_viewlet_renders_total{manager="m\\"1",'
+                      'viewlet="v"} 2.0\n', text)
+        self.assertIn('zope_viewlet_render_seconds_p95{manager="m\\"1",'
+                      'viewlet="v"} 0.25\n', text)
+        self.assertNotIn('availability_ratio{', text)
+
+
+class SharedViewlet(NamedViewlet):
+    """A cacheable viewlet using the memo of the request."""
+
+    def __init__(self, context, request, view, manager):
+        super().__init__(context, request, view, manager)
+        self.request = request
+
+    def cacheKey(self):
+        return self.name
+
+    def update(self):
+        from zope.viewlet.memo import MemoKey
+        from zope.viewlet.memo import memoFor
+        super().update()
+        self.value = memoFor(self.request).get(
+            MemoKey('value'), lambda: 'value')
+
+    def render(self):
+        return '<%s %s>' % (self.name, self.value)
+
+
+class TestThreadSafety(unittest.TestCase):
+
+    threads = 16
+    iterations = 50
+
+    def setUp(self):
+        cleanup.setUp()
+        registerNamedViewlets('a', 'b', 'c')
+        registerNamedViewlets('d', 'e', base=SharedViewlet)
+        from zope.contentprovider.interfaces import IBeforeUpdateEvent
+        zope.component.provideHandler(
+            lambda viewlet, event: None, (None, IBeforeUpdateEvent))
+        self.addCleanup(sys.setswitchinterval, sys.getswitchinterval())
+        sys.setswitchinterval(1e-6)
+
+    def tearDown(self):
+        cleanup.tearDown()
+
+    def test_update_and_render_from_many_threads(self):
+        import concurrent.futures
+        import threading
+
+        import zope.component.event  # noqa: F401 dispatch to handlers
+        from zope.publisher.browser import TestRequest
+
+        from zope.viewlet.cache import LRUCacheStorage
+        from zope.viewlet.stats import ViewletStatistics
+
+        class Manager(managers.ConditionalViewletManager):
+            cacheStorage = LRUCacheStorage()
+            statistics = ViewletStatistics(sampleRate=1)
+
+        barrier = threading.Barrier(self.threads + 1)
+        done = threading.Event()
+
+        def render():
+            barrier.wait()
+            outputs = set()
+            for _ in range(self.iterations):
+                manager = Manager(None, TestRequest(), None)
+                manager.__name__ = 'column'
+                manager.update()
+                self.assertNotIn('missing', manager)
+                self.assertIs(manager['a'], manager.viewlets[0])
+                outputs.add(manager.render())
+            return outputs
+
+        def register():
+            # Changes the registry, so that the shared caches are
+            # replaced while they are used.
+            barrier.wait()
+            while not done.is_set():
+                zope.component.provideAdapter(
+                    NamedViewlet, (IRow, None, None, None),
+                    zope.viewlet.interfaces.IViewlet, name='row')
+
+        with concurrent.futures.ThreadPoolExecutor(self.threads + 1) as pool:
+            registering = pool.submit(register)
+            futures = [pool.submit(render) for _ in range(self.threads)]
+            outputs = set()
+            try:
+                for future in futures:
+                    outputs.update(future.result())
+            finally:
+                done.set()
+            registering.result()
+
+        self.assertEqual(
+            {'<a>\n<b>\n<c>\n<d value>\n<e value>'}, outputs)
+        reports = {report.name: report
+                   for report in Manager.statistics.report()}
+        total = self.threads * self.iterations
+        self.assertEqual(total, reports['a'].samples)
+        self.assertEqual(1.0, reports['e'].availability)
+        # Rendered at most once per thread, then cached.
+        self.assertLessEqual(reports['d'].samples, self.threads)
+
+    def test_registry_caches_are_kept_per_registry(self):
+        from zope.interface.adapter import AdapterRegistry
+        cache = managers.LookupCache()
+        first, second = AdapterRegistry(), AdapterRegistry()
+        data = cache._data(first)
+        self.assertIsNot(data, cache._data(second))
+        self.assertIs(data, cache._data(first))
+        first.register([None], IRow, '', NamedViewlet)
+        self.assertIsNot(data, cache._data(first))
+
+
+class ISkin(IDefaultBrowserLayer):
+    """A layer used by the audit tests."""
+
+
+class IColumn(zope.viewlet.interfaces.IViewletManager):
+    """A viewlet manager interface used by the audit tests."""
+
+
+AUDIT_ZCML = '''
+<configure xmlns="http://namespaces.zope.org/zope"
+           xmlns:browser="http://namespaces.zope.org/browser"
+           i18n_domain="zope">
+  <include package="zope.component" file="meta.zcml" />
+  <include package="zope.security" file="meta.zcml" />
+  <include package="zope.viewlet" file="meta.zcml" />
+  <permission id="zope.View" title="View" />
+  <browser:viewletManager
+      name="column"
+      provides="zope.viewlet.tests.IColumn"
+      permission="zope.Public"
+      />
+  <browser:viewlet
+      name="one"
+      manager="zope.viewlet.tests.IColumn"
+      class="zope.viewlet.tests.DummyViewlet"
+      permission="zope.Public"
+      />
+  <browser:viewlet
+      name="two"
+      manager="zope.viewlet.tests.IColumn"
+      class="zope.viewlet.tests.DummyViewlet"
+      permission="zope.View"
+      />
+  <browser:viewlet
+      name="three"
+      layer="zope.viewlet.tests.ISkin"
+      manager="zope.viewlet.tests.IColumn"
+      class="zope.viewlet.tests.DummyViewlet"
+      permission="zope.Public"
+      />
+</configure>
+'''
+
+
+class TestAudit(unittest.TestCase):
+
+    def setUp(self):
+        cleanup.setUp()
+
+    def tearDown(self):
+        cleanup.tearDown()
+
+    def test_audit(self):
+        from zope.configuration import xmlconfig
+
+        from zope.viewlet.audit import audit
+        xmlconfig.string(AUDIT_ZCML)
+        default, skin = audit(threshold=2)
+        self.assertEqual('column', default.name)
+        self.assertEqual('zope.viewlet.tests.IColumn', default.provides)
+        self.assertEqual(
+            'zope.publisher.interfaces.browser.IDefaultBrowserLayer',
+            default.layer)
+        self.assertEqual(2, default.viewlets)
+        self.assertEqual({'zope.Public': 1, 'zope.View': 1},
+                         default.permissions)
+        self.assertFalse(default.expensive)
+        self.assertEqual('zope.viewlet.tests.ISkin', skin.layer)
+        self.assertEqual(3, skin.viewlets)
+        self.assertEqual({'zope.Public': 2, 'zope.View': 1},
+                         skin.permissions)
+        self.assertEqual(0, skin.templates)
+        self.assertTrue(skin.expensive)
+
+    def _registry(self):
+        from zope.interface.registry import Components
+        from zope.publisher.browser import BrowserView
+        registry = Components('audit')
+        registry.registerAdapter(
+            managers.ViewletManager('column', IColumn),
+            (None, IDefaultBrowserLayer, BrowserView), IColumn)
+        return registry
+
+    def _registerViewlet(self, registry, required=None,
+                         provided=zope.viewlet.interfaces.IViewlet,
+                         factory=DummyViewlet):
+        from zope.publisher.browser import BrowserView
+        if required is None:
+            required = (None, IDefaultBrowserLayer, BrowserView, IColumn)
+        registry.registerAdapter(factory, required, provided, 'one')
+
+    def test_unnamed_registrations(self):
+        from zope.viewlet.audit import audit
+        registry = self._registry()
+        self._registerViewlet(registry)
+        report, = audit(registry)
+        self.assertEqual('', report.name)
+        self.assertEqual('zope.publisher.browser.BrowserView', report.view)
+        self.assertEqual(1, report.viewlets)
+
+    def test_registrations_that_are_not_three_way(self):
+        from zope.viewlet.audit import audit
+        registry = self._registry()
+        registry.registerAdapter(
+            managers.ViewletManager('row', IColumn),
+            (None, IDefaultBrowserLayer), IColumn, 'row')
+        self._registerViewlet(registry, (None, IDefaultBrowserLayer))
+        report, = audit(registry)
+        self.assertEqual(0, report.viewlets)
+
+    def test_providing_no_manager(self):
+        from zope.contentprovider.interfaces import IContentProvider
+
+        from zope.viewlet.audit import audit
+        registry = self._registry()
+        registry.registerAdapter(
+            managers.ViewletManager('provider', IColumn),
+            (None, IDefaultBrowserLayer, None), IContentProvider,
+            'provider')
+        self._registerViewlet(registry, provided=IContentProvider)
+        report, = audit(registry)
+        self.assertEqual(0, report.viewlets)
+
+    def test_viewlets_of_other_managers(self):
+        from zope.viewlet.audit import audit
+        IOther = zope.interface.interface.InterfaceClass(
+            'IOther', (zope.viewlet.interfaces.IViewletManager,),
+            __module__=__name__)
+        registry = self._registry()
+        self._registerViewlet(registry, (None, ISkin, None, IOther))
+        report, = audit(registry)
+        self.assertEqual(0, report.viewlets)
+
+    def test_permissions_and_templates(self):
+        from zope.viewlet.audit import audit
+
+        class Template:
+            filename = 'viewlet.pt'
+
+        registry = self._registry()
+        self._registerViewlet(registry, factory=type(
+            'Unprotected', (DummyViewlet,), {'index': Template()}))
+        report, = audit(registry)
+        self.assertEqual({None: 1}, report.permissions)
+        self.assertEqual(1, report.templates)
+
+    def test_names(self):
+        from zope.viewlet.audit import _name
+        from zope.viewlet.audit import _spec
+        self.assertEqual('*', _name(None))
+        self.assertEqual('zope.viewlet.tests.Content', _name(Content))
+        self.assertIsNone(_spec(None))
+        self.assertIs(zope.interface.implementedBy(Content), _spec(Content))
+        self.assertIs(IColumn, _spec(IColumn))
+
+    def test_main(self):
+        import contextlib
+        import io
+        import json
+        import tempfile
+
+        from zope.viewlet.audit import main
+        with tempfile.NamedTemporaryFile(
+                'w', suffix='.zcml', delete=False) as zcml:
+            zcml.write(AUDIT_ZCML)
+        self.addCleanup(os.remove, zcml.name)
+
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            self.assertEqual(1, main([zcml.name, '--threshold', '2']))
+        first, second = out.getvalue().splitlines()
+        self.assertTrue(first.startswith('column (zope.viewlet.tests'))
+        self.assertIn('2 viewlets, 0 templates', first)
+        self.assertTrue(second.startswith('!! column'))
+
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            self.assertEqual(0, main([zcml.name, '--json']))
+        self.assertEqual(2, len(json.loads(out.getvalue())))
+
+
+class IPage(zope.interface.Interface):
+    """A content interface used by the precomputation tests."""
+
+
+class ITagged(zope.interface.Interface):
+    """Another content interface used by the precomputation tests."""
+
+
+PRECOMPUTE_ZCML = AUDIT_ZCML.replace('</configure>', '''
+  <browser:viewlet
+      name="one"
+      layer="zope.viewlet.tests.ISkin"
+      manager="zope.viewlet.tests.IColumn"
+      class="zope.viewlet.tests.NamedViewlet"
+      permission="zope.Public"
+      />
+  <browser:viewlet
+      name="page"
+      for="zope.viewlet.tests.IPage"
+      manager="zope.viewlet.tests.IColumn"
+      class="zope.viewlet.tests.NamedViewlet"
+      permission="zope.Public"
+      />
+  <browser:viewlet
+      name="page"
+      for="zope.viewlet.tests.ITagged"
+      manager="zope.viewlet.tests.IColumn"
+      class="zope.viewlet.tests.DummyViewlet"
+      permission="zope.Public"
+      />
+  <browser:precomputeViewlets />
+</configure>
+''')
+
+
+class TestPrecomputedViewlets(unittest.TestCase):
+
+    def setUp(self):
+        from zope.configuration import xmlconfig
+        from zope.security.management import endInteraction
+        from zope.security.management import newInteraction
+        cleanup.setUp()
+        xmlconfig.string(PRECOMPUTE_ZCML)
+        newInteraction()
+        self.addCleanup(endInteraction)
+
+    def tearDown(self):
+        cleanup.tearDown()
+
+    def _makeManager(self, context=None, skin=False, provides=()):
+        from zope.publisher.browser import BrowserView
+        from zope.publisher.browser import TestRequest
+        request = TestRequest()
+        if skin:
+            zope.interface.alsoProvides(request, ISkin)
+        if provides:
+            context = Content('content')
+            zope.interface.alsoProvides(context, *provides)
+        view = BrowserView(context, request)
+        return zope.component.getMultiAdapter(
+            (context, request, view), IColumn, name='column')
+
+    def _names(self, precomputed):
+        return [name for name, _factory in precomputed.factories]
+
+    def _viewlets(self, manager):
+        manager.update()
+        return [(manager._names[id(viewlet)], type(viewlet).__bases__[0])
+                for viewlet in manager.viewlets]
+
+    def test_precomputed(self):
+        from zope.viewlet import precompute
+        manager = self._makeManager()
+        precomputed = precompute.lookup(manager)
+        self.assertEqual(['one', 'two'], self._names(precomputed))
+        one, two = [factory for _name, factory in precomputed.factories]
+        self.assertEqual(frozenset([one]), precomputed.public)
+
+        self.assertEqual(['one', 'three', 'two'], self._names(
+            precompute.lookup(self._makeManager(skin=True))))
+        self.assertEqual(['one', 'page', 'two'], self._names(
+            precompute.lookup(self._makeManager(provides=[IPage]))))
+
+    def test_computed_when_looked_up(self):
+        from zope.viewlet import precompute
+        entry, = precompute.viewletIndex._managers.values()
+        self.assertEqual({}, entry.results)
+        precomputed = precompute.lookup(self._makeManager())
+        self.assertEqual([precomputed], list(entry.results.values()))
+        self.assertIs(precomputed, precompute.lookup(self._makeManager()))
+
+    def test_same_viewlets(self):
+        from zope.viewlet import precompute
+        for kw in ({}, {'skin': True}, {'provides': [IPage]},
+                   {'provides': [ITagged]}, {'provides': [IPage, ITagged]},
+                   {'skin': True, 'provides': [ITagged, IPage]}):
+            index = precompute.viewletIndex
+            precomputed = self._viewlets(self._makeManager(**kw))
+            precompute.clearIndex()
+            self.assertEqual(self._viewlets(self._makeManager(**kw)),
+                             precomputed)
+            precompute.viewletIndex = index
+
+        manager = self._makeManager(skin=True)
+        self.assertEqual(NamedViewlet, self._viewlets(manager)[0][1])
+        self.assertIn(type(manager.viewlets[0]), manager._public)
+
+    def test_ambiguous(self):
+        from zope.viewlet import precompute
+
+        # The registration found depends on the order of the interfaces.
+        self.assertIsNone(precompute.lookup(
+            self._makeManager(provides=[IPage, ITagged])))
+        self.assertEqual(['one', 'page', 'two'], [
+            name for name, _class in
+            self._viewlets(self._makeManager(provides=[IPage, ITagged]))])
+
+    def test_registry_changed(self):
+        from zope.viewlet import precompute
+        registerNamedViewlets('four', required=(None, None, None, IColumn))
+        manager = self._makeManager()
+        self.assertIsNone(precompute.lookup(manager))
+        self.assertEqual(['four', 'one', 'two'],
+                         [name for name, _class in self._viewlets(manager)])
+
+        precompute.buildIndex()
+        self.assertEqual(['four', 'one', 'two'], self._names(
+            precompute.lookup(self._makeManager())))
+
+    def test_provided_by_manager(self):
+        from zope.viewlet import precompute
+        manager = self._makeManager()
+        zope.interface.alsoProvides(manager, ITagged)
+        self.assertIsNone(precompute.lookup(manager))
+
+    def test_protected(self):
+        from unittest import mock
+        manager = self._makeManager()
+        with mock.patch('zope.security.canAccess',
+                        return_value=False) as canAccess:
+            manager.update()
+        self.assertEqual(['one'], [manager._names[id(viewlet)]
+                                   for viewlet in manager.viewlets])
+        (viewlet, name), = [call[0] for call in canAccess.call_args_list]
+        self.assertEqual('render', name)
+        self.assertNotIn(type(viewlet), manager._public)
+
+    def test_weighted_by_instances(self):
+        from zope.publisher.browser import BrowserView
+        from zope.publisher.browser import TestRequest
+
+        from zope.viewlet import precompute
+
+        class Manager(managers.WeightOrderedViewletManager):
+            pass
+
+        zope.component.provideAdapter(
+            Manager, (None, None, None),
+            zope.viewlet.interfaces.IViewletManager, name='weighted')
+        # Other adapters are not indexed.
+        zope.component.provideAdapter(Content, (None,), IPage)
+        required = (None, None, None, zope.interface.implementedBy(Manager))
+        registerNamedViewlets('heavy', required=required,
+                              weight=property(lambda self: 2))
+        registerNamedViewlets('light', required=required,
+                              weight=property(lambda self: 1))
+        precompute.buildIndex()
+
+        request = TestRequest()
+        view = BrowserView(Content('content'), request)
+        manager = Manager(view.context, request, view)
+        self.assertEqual(['heavy', 'light'],
+                         self._names(precompute.lookup(manager)))
+        manager.update()
+        self.assertEqual(['light', 'heavy'],
+                         [viewlet.name for viewlet in manager.viewlets])
+        self.assertIsNone(precompute.lookup(
+            managers.ViewletManagerBase(view.context, request, view)))
+
+    def test_helpers(self):
+        from zope.viewlet.precompute import _dominates
+        from zope.viewlet.precompute import _isPublic
+        registration, = [
+            registration for registration in
+            zope.component.getSiteManager().registeredAdapters()
+            if registration.name == 'page' and
+            registration.required[0] is IPage]
+        self.assertIsNone(_dominates(registration, registration))
+
+        class Protected(NamedViewlet):
+            __Security_checker__ = object()
+
+        self.assertFalse(_isPublic(Protected))
+        self.assertFalse(_isPublic(NamedViewlet.__init__))
+
+
+class TestReplay(unittest.TestCase):
+
+    def setUp(self):
+        cleanup.setUp()
+        from zope.configuration import xmlconfig
+        xmlconfig.string(AUDIT_ZCML)
+
+    def tearDown(self):
+        cleanup.tearDown()
+
+    def _record(self, layer, enabled=True):
+        import logging
+
+        import zope.security.management
+        from zope.publisher.browser import BrowserView
+        from zope.publisher.browser import TestRequest
+
+        from zope.viewlet import recording
+        self.addCleanup(setattr, recording, 'enabled', False)
+        recording.enabled = enabled
+        request = TestRequest()
+        zope.interface.alsoProvides(request, layer)
+        view = BrowserView(Content('title'), request)
+        manager = zope.component.getMultiAdapter(
+            (view.context, request, view), IColumn, name='column')
+        zope.security.management.newInteraction(request)
+        self.addCleanup(zope.security.management.endInteraction)
+        with self.assertLogs(recording.logger, logging.DEBUG) as logs:
+            manager.update()
+        zope.security.management.endInteraction()
+        return logs.output
+
+    def test_record(self):
+        from zope.viewlet.replay import readRecords
+        record, = readRecords(self._record(ISkin))
+        self.assertEqual('column', record['manager'])
+        self.assertIn('zope.viewlet.tests.ISkin', record['layer'])
+        self.assertIn('zope.browser.interfaces.IBrowserView',
+                      record['view'])
+        self.assertIsNone(record['principal'])
+
+    def test_not_recorded_by_default(self):
+        import logging
+        root = logging.getLogger()
+        self.addCleanup(root.setLevel, root.level)
+        # Not even when everything is logged.
+        root.setLevel(logging.DEBUG)
+        with self.assertRaises(AssertionError):
+            self._record(ISkin, enabled=False)
+
+    def test_replay(self):
+        from zope.viewlet.replay import formatReport
+        from zope.viewlet.replay import readRecords
+        from zope.viewlet.replay import replay
+        records = readRecords(
+            self._record(ISkin) + self._record(IDefaultBrowserLayer)
+            + ['INFO:other:{"manager": "unknown", "context": [], '
+               '"layer": [], "view": [], "principal": null}'])
+        report = replay(records, threads=2, iterations=5, allocations=True)
+        self.assertEqual(10, report.updates)
+        self.assertEqual(1, report.skipped)
+        stats, = report.managers
+        self.assertEqual('column', stats.name)
+        self.assertEqual(10, stats.count)
+        self.assertLessEqual(stats.p50, stats.p90)
+        self.assertLessEqual(stats.p90, stats.p99)
+        self.assertGreater(stats.allocatedBytes, 0)
+        summary, line = formatReport(report)
+        self.assertTrue(summary.startswith('10 updates in'))
+        self.assertTrue(line.startswith('column: 10 updates, mean'))
+        self.assertIn('allocated', line)
+
+    def test_replay_processes(self):
+        from zope.viewlet.replay import readRecords
+        from zope.viewlet.replay import replay
+        records = readRecords(self._record(ISkin) * 4)
+        report = replay(records, processes=2)
+        self.assertEqual(4, report.updates)
+        self.assertIsNone(report.managers[0].allocatedBytes)
+
+    def test_replay_while_tracing(self):
+        import tracemalloc
+
+        from zope.viewlet.replay import readRecords
+        from zope.viewlet.replay import replay
+        records = readRecords(self._record(ISkin))
+        tracemalloc.start()
+        self.addCleanup(tracemalloc.stop)
+        report = replay(records, allocations=True)
+        self.assertIsNotNone(report.managers[0].allocatedBytes)
+        self.assertTrue(tracemalloc.is_tracing())
+
+    def test_main(self):
+        import contextlib
+        import io
+        import json
+        import shutil
+        import tempfile
+
+        from zope.viewlet.replay import main
+        from zope.viewlet.replay import readRecords
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        zcml = os.path.join(directory, 'site.zcml')
+        with open(zcml, 'w') as file:
+            file.write(AUDIT_ZCML)
+        log = os.path.join(directory, 'viewlets.log')
+        with open(log, 'w') as file:
+            file.write('INFO:zope.viewlet.replay:starting\n')
+            for line in self._record(ISkin) * 2:
+                file.write(line + '\n')
+            record, = readRecords(self._record(ISkin))
+            record['principal'] = 'zope.user'
+            file.write(json.dumps(record) + '\n')
+            # Recorded by a version of the site that had this interface.
+            file.write('{"manager": "column", "context": '
+                       '["zope.viewlet.tests.IRemoved"], "layer": [], '
+                       '"view": [], "principal": "zope.user"}\n')
+        empty = os.path.join(directory, 'empty.log')
+        with open(empty, 'w') as file:
+            file.write('INFO:zope.viewlet.replay:starting\n')
+
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            self.assertEqual(0, main([zcml, log, '--iterations', '2']))
+        summary, line = out.getvalue().splitlines()
+        self.assertTrue(summary.startswith('6 updates in'))
+        self.assertTrue(summary.endswith(', 1 records skipped'))
+        self.assertTrue(line.startswith('column: 6 updates, mean'))
+        self.assertNotIn('allocated', line)
+
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            self.assertEqual(1, main([zcml, empty]))
+        self.assertTrue(out.getvalue().startswith('0 updates in'))
+
+    def test_main_arguments(self):
+        import contextlib
+        import io
+
+        from zope.viewlet.replay import main
+        err = io.StringIO()
+        with contextlib.redirect_stderr(err):
+            with self.assertRaises(SystemExit) as exc:
+                main(['site.zcml', 'viewlets.log', '--threads', 'many'])
+        self.assertEqual(2, exc.exception.code)
+        self.assertIn("argument --threads: invalid int value: 'many'",
+                      err.getvalue())
+
+
+class AllocatingViewlet:
+    """A viewlet keeping *size* bytes from its update."""
+
+    size = 0
+
+    def __init__(self, context, request, view, manager):
+        pass
+
+    def update(self):
+        self.data = b'x' * self.size
+
+    def render(self):
+        return str(len(self.data))
+
+
+class TestMemoryProfiling(unittest.TestCase):
+
+    def setUp(self):
+        import zope.component.event  # noqa: F401 dispatch to handlers
+        from zope.contentprovider.interfaces import IBeforeUpdateEvent
+        from zope.security.checker import NamesChecker
+        from zope.security.checker import defineChecker
+        cleanup.setUp()
+        zope.component.provideHandler(
+            lambda event: None, (IBeforeUpdateEvent,))
+        for name, size in (('small', 10), ('large', 100000)):
+            factory = type(name, (AllocatingViewlet,), {'size': size})
+            defineChecker(factory, NamesChecker(('update', 'render')))
+            zope.component.provideAdapter(
+                factory, (None, None, None, None),
+                zope.viewlet.interfaces.IViewlet, name=name)
+
+    def tearDown(self):
+        cleanup.tearDown()
+
+    def _profile(self, template=None):
+        manager = managers.ViewletManagerBase(None, None, None)
+        manager.__name__ = 'column'
+        manager.profileMemory = True
+        if template is not None:
+            manager.template = template
+        manager.update()
+        output = manager.render()
+        return output, manager.memoryReport
+
+    def test_report(self):
+        import tracemalloc
+
+        from zope.viewlet.memory import PHASES
+        output, report = self._profile()
+        self.assertEqual('100000\n10', output)
+        self.assertFalse(tracemalloc.is_tracing())
+        self.assertEqual('column', report.name)
+        self.assertEqual(set(PHASES), set(report.phases))
+        self.assertEqual({'large', 'small'}, set(report.viewlets))
+        self.assertEqual({'instantiate', 'event', 'update', 'render'},
+                         set(report.viewlets['large']))
+        large = report.viewlets['large']['update']
+        self.assertGreaterEqual(large.allocated, 100000)
+        self.assertGreaterEqual(large.peak, large.allocated)
+        self.assertEqual(1, large.calls)
+        self.assertLess(report.viewlets['small']['update'].allocated, 100000)
+        self.assertEqual(2, report.phases['update'].calls)
+        self.assertEqual(['large', 'small'],
+                         [name for name, _ in report.largest()])
+        self.assertEqual(
+            large._asdict(), report.asDict()['viewlets']['large']['update'])
+        self.assertIn('update', repr(report))
+
+    def test_template(self):
+        def template(viewlets):
+            return '|'.join(viewlet.render() for viewlet in viewlets)
+        output, report = self._profile(template)
+        self.assertEqual('100000|10', output)
+        self.assertEqual(3, report.phases['render'].calls)
+
+    def test_off_by_default(self):
+        manager = managers.ViewletManagerBase(None, None, None)
+        manager.update()
+        manager.render()
+        self.assertIsNone(manager.memoryReport)
+
+    def test_concurrent_profilers(self):
+        import tracemalloc
+
+        from zope.viewlet.memory import MemoryProfiler
+        from zope.viewlet.memory import MemoryReport
+        first = MemoryProfiler(MemoryReport())
+        second = MemoryProfiler(MemoryReport())
+        first.__enter__()
+        with second:
+            first.__exit__(None, None, None)
+            # Still tracing for the second profiler.
+            with second.measure('update'):
+                self.assertTrue(tracemalloc.is_tracing())
+        self.assertFalse(tracemalloc.is_tracing())
+
+    def test_tracing_started_elsewhere(self):
+        import tracemalloc
+
+        from zope.viewlet.memory import MemoryProfiler
+        from zope.viewlet.memory import MemoryReport
+        tracemalloc.start()
+        self.addCleanup(tracemalloc.stop)
+        with MemoryProfiler(MemoryReport()):
+            pass
+        self.assertTrue(tracemalloc.is_tracing())
+
+
+class TestBeforeUpdateEvents(unittest.TestCase):
+
+    def setUp(self):
+        import zope.event
+        from zope.component.event import dispatch
+        from zope.component.event import objectEventNotify
+        from zope.security.checker import NamesChecker
+        from zope.security.checker import defineChecker
+        cleanup.setUp()
+        self.addCleanup(setattr, zope.event, 'subscribers',
+                        zope.event.subscribers)
+        zope.event.subscribers = [dispatch]
+        zope.component.provideHandler(objectEventNotify)
+        defineChecker(AllocatingViewlet,
+                      NamesChecker(('update', 'render')))
+        zope.component.provideAdapter(
+            AllocatingViewlet, (None, None, None, None),
+            zope.viewlet.interfaces.IViewlet, name='viewlet')
+        self.events = []
+
+    def tearDown(self):
+        cleanup.tearDown()
+
+    def _update(self, **kw):
+        manager = managers.ViewletManagerBase(None, None, None)
+        manager.__dict__.update(kw)
+        manager.update()
+        return manager
+
+    def test_no_subscribers(self):
+        from zope.contentprovider.interfaces import BeforeUpdateEvent
+        cache = managers.subscriberCache
+        manager = self._update()
+        viewlet, = manager.viewlets
+        self.assertFalse(cache.hasSubscribers(viewlet, BeforeUpdateEvent))
+
+        # Registering a handler invalidates what is remembered.
+        zope.component.provideHandler(
+            lambda viewlet, event: self.events.append(event),
+            (AllocatingViewlet, BeforeUpdateEvent))
+        self.assertTrue(cache.hasSubscribers(viewlet, BeforeUpdateEvent))
+        self.assertFalse(cache.hasSubscribers(manager, BeforeUpdateEvent))
+        viewlet, = self._update().viewlets
+        event, = self.events
+        self.assertIs(viewlet, event.object)
+
+    def test_unknown_subscribers(self):
+        import zope.event
+        from zope.contentprovider.interfaces import BeforeUpdateEvent
+        cache = managers.subscriberCache
+        zope.event.subscribers.append(self.events.append)
+        self.assertTrue(cache.hasSubscribers(None, BeforeUpdateEvent))
+        self._update()
+        self.assertEqual(1, len(self.events))
+        zope.event.subscribers = []
+        self.assertFalse(cache.hasSubscribers(None, BeforeUpdateEvent))
+
+    def test_batch(self):
+        from zope.contentprovider.interfaces import IBeforeUpdateEvent
+
+        from zope.viewlet.interfaces import IBeforeUpdateViewletsEvent
+        zope.component.provideHandler(
+            self.events.append, (IBeforeUpdateEvent,))
+        zope.component.provideHandler(
+            self.events.append, (IBeforeUpdateViewletsEvent,))
+        manager = self._update(batchUpdateEvents=True)
+        event, = self.events
+        self.assertTrue(IBeforeUpdateViewletsEvent.providedBy(event))
+        self.assertIs(manager, event.object)
+        self.assertEqual(manager.viewlets, event.viewlets)
+        self.assertIsNone(event.request)
+
+    def test_batch_without_subscribers(self):
+        from zope.contentprovider.interfaces import IBeforeUpdateEvent
+        zope.component.provideHandler(
+            self.events.append, (IBeforeUpdateEvent,))
+        self._update(batchUpdateEvents=True)
+        self.assertEqual([], self.events)
+
+    def test_batch_profiled(self):
+        from zope.viewlet.interfaces import IBeforeUpdateViewletsEvent
+        zope.component.provideHandler(
+            self.events.append, (IBeforeUpdateViewletsEvent,))
+        manager = self._update(batchUpdateEvents=True, profileMemory=True)
+        event, = self.events
+        self.assertIs(manager, event.object)
+        self.assertEqual(1, manager.memoryReport.phases['event'].calls)
+
+
+class LoggingViewlet(NamedViewlet):
+    """A viewlet logging its updates, with the site and interaction."""
+
+    log = []
+
+    def update(self):
+        from zope.component.hooks import getSite
+        from zope.security.management import queryInteraction
+        self.log.append((self.name, getSite(), queryInteraction()))
+
+
+class TestUpdateDependencies(unittest.TestCase):
+
+    def setUp(self):
+        cleanup.setUp()
+        LoggingViewlet.log = []
+        registerNamedViewlets('b', 'c', base=LoggingViewlet)
+        registerNamedViewlets('a', base=LoggingViewlet,
+                              updateDependencies='d unknown')
+        registerNamedViewlets('d', base=LoggingViewlet,
+                              updateDependencies=['c'])
+
+    def tearDown(self):
+        cleanup.tearDown()
+
+    def _makeManager(self):
+        return managers.ViewletManagerBase(None, None, None)
+
+    def test_update_waves(self):
+        manager = self._makeManager()
+        manager.update()
+        waves = managers.updateWaves(manager.viewlets, manager._names)
+        self.assertEqual([['b', 'c'], ['d'], ['a']],
+                         [[v.name for v in wave] for wave in waves])
+        self.assertEqual([], managers.updateWaves([], {}))
+
+    def test_cycle(self):
+        registerNamedViewlets('c', base=LoggingViewlet,
+                              updateDependencies='a')
+        with self.assertRaises(ValueError) as raised:
+            self._makeManager().update()
+        self.assertEqual(
+            'Cyclic update dependencies between the viewlets a, c, d',
+            str(raised.exception))
+
+    def test_serial(self):
+        manager = self._makeManager()
+        manager.update()
+        self.assertEqual(['b', 'c', 'd', 'a'],
+                         [name for name, _, _ in LoggingViewlet.log])
+        self.assertEqual('<a>\n<b>\n<c>\n<d>', manager.render())
+
+    def test_parallel(self):
+        import concurrent.futures
+
+        import zope.security.management
+        from zope.component.hooks import setSite
+        from zope.publisher.browser import TestRequest
+
+        class Site:
+            def getSiteManager(self):
+                return zope.component.getGlobalSiteManager()
+
+        site = Site()
+        setSite(site)
+        self.addCleanup(setSite, None)
+        request = TestRequest()
+        principal = object()
+        request.setPrincipal(principal)
+        zope.security.management.newInteraction(request)
+        self.addCleanup(zope.security.management.endInteraction)
+        interaction = zope.security.management.getInteraction()
+
+        executor = concurrent.futures.ThreadPoolExecutor(2)
+        self.addCleanup(executor.shutdown)
+        manager = self._makeManager()
+        manager.updateExecutor = executor
+        manager.update()
+        log = LoggingViewlet.log
+        self.assertEqual({'b', 'c'}, {name for name, _, _ in log[:2]})
+        self.assertEqual(['d', 'a'], [name for name, _, _ in log[2:]])
+        self.assertTrue(all(logged is site for _, logged, _ in log))
+        # The workers take part in interactions of their own, with the
+        # same principals.
+        self.assertIs(interaction, log[2][2])
+        for _, _, logged in log[:2]:
+            self.assertIsNot(interaction, logged)
+            participation, = logged.participations
+            self.assertIs(principal, participation.principal)
+            self.assertIs(logged, participation.interaction)
+        self.assertEqual('<a>\n<b>\n<c>\n<d>', manager.render())
+
+        # The workers do not keep the site and interaction.
+        def context():
+            from zope.component.hooks import getSite
+            return (getSite(),
+                    zope.security.management.queryInteraction())
+        self.assertEqual((None, None), executor.submit(context).result())
+
+
+class TestRequestMemo(unittest.TestCase):
+
+    def setUp(self):
+        cleanup.setUp()
+
+    def tearDown(self):
+        cleanup.tearDown()
+
+    def test_shared_by_viewlets(self):
+        from zope.publisher.browser import TestRequest
+
+        from zope.viewlet import memo
+        from zope.viewlet.viewlet import ViewletBase
+        key = memo.MemoKey('groups', frozenset)
+        computed = []
+
+        def groups(principal):
+            computed.append(principal)
+            return frozenset(['editors'])
+
+        request = TestRequest()
+        first = ViewletBase(None, request, None, None)
+        second = ViewletBase(None, request, None, None)
+        self.assertNotIn(key, first.requestMemo)
+        value = first.requestMemo.get(key, groups, 'bob')
+        self.assertIs(value, second.requestMemo.get(key, groups, 'bob'))
+        self.assertIn(key, second.requestMemo)
+        self.assertEqual(['bob'], computed)
+
+        self.assertEqual({'groups': {'hits': 1, 'misses': 1}},
+                         first.requestMemo.statistics.asDict())
+        self.assertEqual(0.5, memo.statistics.hitRate('groups'))
+        ViewletBase(None, TestRequest(), None, None).requestMemo.get(
+            key, groups, 'alice')
+        self.assertEqual(1 / 3, memo.statistics.hitRate())
+        self.assertIsNone(memo.statistics.hitRate('unknown'))
+
+    def test_typed_keys(self):
+        from zope.viewlet.memo import MemoKey
+        from zope.viewlet.memo import memoFor
+        key = MemoKey('breadcrumbs', list)
+        other = MemoKey('breadcrumbs', list)
+        memo = memoFor(None)
+        self.assertIsNot(memo, memoFor(None))
+        with self.assertRaises(TypeError):
+            memo.get(key, tuple)
+        with self.assertRaises(TypeError):
+            memo.set(key, ())
+        memo.set(key, ['home'])
+        self.assertEqual(['home'], memo.get(key, list))
+        self.assertEqual([], memo.get(other, list))
+        self.assertEqual("<MemoKey 'breadcrumbs' of list>", repr(key))
+
+
+SIMPLE_TEMPLATE = """\
+<div class="column">
+  <div class="box" tal:repeat="viewlet options/viewlets"
+       tal:content="structure viewlet/render" />
+</div>
+"""
+
+
+class TestRenderPlans(unittest.TestCase):
+
+    def setUp(self):
+        cleanup.setUp()
+        traversingSetUp()
+        registerNamedViewlets('a', 'b', 'c', 'd')
+
+    def tearDown(self):
+        cleanup.tearDown()
+
+    def _makeManager(self, source, compileTemplate=True):
+        import tempfile
+
+        from zope.publisher.browser import TestRequest
+        with tempfile.NamedTemporaryFile(
+                'w', suffix='.pt', delete=False) as template:
+            template.write(source)
+        self.addCleanup(os.remove, template.name)
+        class_ = managers.ViewletManager(
+            'column', IColumn, template=template.name,
+            compileTemplate=compileTemplate)
+        return class_(None, TestRequest(), None)
+
+    def _render(self, manager, names):
+        manager.update(names=names)
+        return manager.render()
+
+    def test_identical_output(self):
+        for source in (SIMPLE_TEMPLATE,
+                       '<tal:block repeat="v options/viewlets"\n'
+                       '           replace="structure v/render" />',
+                       '<ul><li tal:repeat="v options/viewlets">'
+                       '<tal:r replace="structure v/render"/></li></ul>'):
+            compiled = self._makeManager(source)
+            plain = self._makeManager(source, compileTemplate=False)
+            for names in ([], ['a'], ['a', 'b'], ['a', 'b', 'c', 'd']):
+                self.assertEqual(self._render(plain, names),
+                                 self._render(compiled, names))
+            self.assertIsNotNone(compiled._renderPlan())
+
+    def test_plan(self):
+        manager = self._makeManager(SIMPLE_TEMPLATE)
+        manager.update()
+        manager.render()
+        plan = manager._renderPlan()
+        self.assertEqual('<div class="column">\n  <div class="box">',
+                         plan.prefix)
+        self.assertEqual('</div>\n  <div class="box">', plan.separator)
+        self.assertEqual('</div>\n</div>\n', plan.suffix)
+        self.assertEqual('<div class="column">\n</div>\n', plan.empty)
+        self.assertEqual('text/html', plan.contentType)
+
+        # The plan is used instead of the template from now on.
+        from unittest import mock
+
+        from zope.browserpage import ViewPageTemplateFile
+        with mock.patch.object(ViewPageTemplateFile, '__call__',
+                               side_effect=AssertionError):
+            self.assertIn('<div class="box"><a></div>',
+                          self._render(manager, ['a']))
+
+    def test_content_type(self):
+        manager = self._makeManager(SIMPLE_TEMPLATE)
+        self._render(manager, ['a'])
+        manager = type(manager)(None, type(manager.request)(), None)
+        self._render(manager, ['a'])
+        self.assertEqual('text/html',
+                         manager.request.response.getHeader('Content-Type'))
+
+    def test_not_simple(self):
+        for source in (
+                '<p tal:content="view/title" />' + SIMPLE_TEMPLATE,
+                SIMPLE_TEMPLATE.replace('structure ', ''),
+                SIMPLE_TEMPLATE.replace('viewlet/render', 'other/render'),
+                '<metal:block use-macro="view/macro">'
+                + SIMPLE_TEMPLATE + '</metal:block>',
+                '<p i18n:translate="">Boxes</p>' + SIMPLE_TEMPLATE,
+                '${view/title}' + SIMPLE_TEMPLATE):
+            self.assertIsNone(self._makeManager(source)._renderPlan(),
+                              source)
+
+    def test_namespaces(self):
+        from zope.viewlet.plan import isSimpleTemplate
+        self.assertTrue(isSimpleTemplate(
+            '<div xmlns:tal="http://xml.zope.org/namespaces/tal"'
+            ' xml:lang="en">' + SIMPLE_TEMPLATE + '</div>'))
+        self.assertTrue(isSimpleTemplate(
+            '<tal:block repeat="v options/viewlets"'
+            ' content="structure v/render" />'))
+        # Not parsed by html.parser.
+        self.assertFalse(isSimpleTemplate('<![ x ]]>' + SIMPLE_TEMPLATE))
+
+    def test_output_not_reproduced(self):
+        from zope.viewlet.plan import compilePlan
+
+        def join(viewlets, count=1):
+            return '<div>%s</div>' % ''.join(
+                viewlet.render() * count for viewlet in viewlets)
+
+        self.assertIsNotNone(compilePlan(SIMPLE_TEMPLATE, join))
+
+        def failing(viewlets):
+            raise LookupError('viewlets')
+
+        for render in (
+                failing,
+                lambda viewlets: join(viewlets).encode('utf-8'),
+                # Viewlets rendered twice.
+                lambda viewlets: join(viewlets, 2),
+                # Prefixes depending on the number of viewlets.
+                lambda viewlets: '<p>' * len(viewlets) + join(viewlets),
+                # Only reproduced for up to two viewlets.
+                lambda viewlets: join(viewlets[:2])):
+            self.assertIsNone(compilePlan(SIMPLE_TEMPLATE, render))
+
+    def test_plans_outlive_registry_changes(self):
+        # Plans only hold the static parts of the template, so they stay
+        # valid when viewlets are registered or unregistered.
+        compiled = self._makeManager(SIMPLE_TEMPLATE)
+        plain = self._makeManager(SIMPLE_TEMPLATE, compileTemplate=False)
+        self.assertEqual(self._render(plain, None),
+                         self._render(compiled, None))
+        plan = compiled._renderPlan()
+        registerNamedViewlets('e')
+        zope.component.getSiteManager().unregisterAdapter(
+            required=(None, None, None, None),
+            provided=zope.viewlet.interfaces.IViewlet, name='a')
+        compiled = type(compiled)(None, compiled.request, None)
+        self.assertIs(plan, compiled._renderPlan())
+        self.assertEqual(self._render(plain, ['a', 'b', 'e']),
+                         self._render(compiled, ['a', 'b', 'e']))
+        self.assertNotIn('<a>', self._render(compiled, ['a', 'b', 'e']))
+
+    def test_non_text_output(self):
+        registerNamedViewlets('e', render=lambda self: None)
+        compiled = self._makeManager(SIMPLE_TEMPLATE)
+        plain = self._makeManager(SIMPLE_TEMPLATE, compileTemplate=False)
+        self.assertEqual(self._render(plain, ['a', 'e']),
+                         self._render(compiled, ['a', 'e']))
+
+
+class SitemapViewlet(DummyViewlet):
+    """A viewlet rendered from its inputs, showing its context."""
+
+    updated = []
+
+    def update(self):
+        self.updated.append(self.context.title)
+
+    def render(self):
+        return self.renderInputs(self.prerenderInputs())
+
+    def prerenderInputs(self):
+        return ('sitemap', self.context.title,
+                getattr(self.context, 'version', 1))
+
+    def prerenderStaleKey(self):
+        return self.context.title
+
+    @classmethod
+    def renderInputs(cls, inputs):
+        return '<ul>%s %s</ul>' % inputs[1:]
+
+
+class DeferredExecutor:
+    """Runs the submitted functions immediately or when told to."""
+
+    immediate = True
+
+    def __init__(self):
+        self.calls = []
+
+    def submit(self, function, *args):
+        import concurrent.futures
+        future = concurrent.futures.Future()
+        self.calls.append((future, function, args))
+        if self.immediate:
+            self.run()
+        return future
+
+    def run(self):
+        calls, self.calls = self.calls, []
+        for future, function, args in calls:
+            future.set_result(function(*args))
+
+
+PRERENDER_ZCML = '''
+<configure xmlns="http://namespaces.zope.org/browser">
+  <include package="zope.viewlet" file="meta.zcml" />
+  <viewlet
+      name="sitemap"
+      class="zope.viewlet.tests.%s"
+      permission="zope.Public"
+      prerender="true"
+      />
+</configure>
+'''
+
+
+class TestPrerendering(unittest.TestCase):
+
+    def setUp(self):
+        from zope.configuration import xmlconfig
+        cleanup.setUp()
+        xmlconfig.string(PRERENDER_ZCML % 'SitemapViewlet')
+        SitemapViewlet.updated = []
+
+    def tearDown(self):
+        cleanup.tearDown()
+
+    def _render(self, prerenderer, storage, title='Home', version=1):
+        from zope.publisher.browser import BrowserView
+        from zope.publisher.browser import TestRequest
+        context = Content(title)
+        context.version = version
+        request = TestRequest()
+        manager = managers.ViewletManagerBase(
+            context, request, BrowserView(context, request))
+        manager.cacheStorage = storage
+        manager.prerenderer = prerenderer
+        manager.update()
+        return manager.render()
+
+    def test_directive(self):
+        from zope.configuration import xmlconfig
+        from zope.configuration.exceptions import ConfigurationError
+        with self.assertRaises(ConfigurationError):
+            xmlconfig.string(PRERENDER_ZCML % 'DummyViewlet')
+
+    def test_rendered_in_process_pool(self):
+        import concurrent.futures
+
+        from zope.viewlet.cache import LRUCacheStorage
+        from zope.viewlet.prerender import Prerenderer
+        prerenderer = Prerenderer(concurrent.futures.ProcessPoolExecutor(1))
+        self.addCleanup(prerenderer.shutdown)
+        storage = LRUCacheStorage()
+        self.assertEqual('<ul>Home 1</ul>',
+                         self._render(prerenderer, storage))
+        self.assertEqual(1, storage.statistics()['entries'])
+        self.assertEqual([], SitemapViewlet.updated)
+
+    def test_default_executor(self):
+        import multiprocessing
+
+        from zope.viewlet.prerender import Prerenderer
+        prerenderer = Prerenderer()
+        self.addCleanup(prerenderer.shutdown)
+        expected = 'forkserver'
+        if expected not in multiprocessing.get_all_start_methods():
+            expected = 'spawn'  # pragma: no cover
+        self.assertEqual(
+            expected, prerenderer.executor._mp_context.get_start_method())
+
+    def test_stale_output(self):
+        from zope.viewlet.cache import LRUCacheStorage
+        from zope.viewlet.prerender import Prerenderer
+        executor = DeferredExecutor()
+        prerenderer = Prerenderer(executor)
+        storage = LRUCacheStorage()
+        self.assertEqual('<ul>Home 1</ul>',
+                         self._render(prerenderer, storage))
+        self.assertEqual('<ul>Home 1</ul>',
+                         self._render(prerenderer, storage))
+
+        # While the output for new inputs is rendered, the old one for the
+        # same stale key is used.
+        executor.immediate = False
+        self.assertEqual('<ul>Home 1</ul>',
+                         self._render(prerenderer, storage, version=2))
+        self.assertEqual('<ul>Home 1</ul>',
+                         self._render(prerenderer, storage, version=2))
+        self.assertEqual(1, len(executor.calls))
+        executor.run()
+        self.assertEqual('<ul>Home 2</ul>',
+                         self._render(prerenderer, storage, version=2))
+        self.assertEqual([], SitemapViewlet.updated)
+
+        # The output for other objects is never used.
+        prerenderer.timeout = 0
+        self.assertEqual('<ul>Start 1</ul>',
+                         self._render(prerenderer, storage, 'Start'))
+        self.assertEqual(['Start'], SitemapViewlet.updated)
+
+    def test_without_stale_key(self):
+        from zope.viewlet.cache import LRUCacheStorage
+        from zope.viewlet.prerender import Prerenderer
+        executor = DeferredExecutor()
+        prerenderer = Prerenderer(executor, timeout=0)
+        storage = LRUCacheStorage()
+        self.assertEqual('<ul>Home 1</ul>',
+                         self._render(prerenderer, storage))
+
+        class Viewlet(SitemapViewlet):
+            prerenderStaleKey = None
+
+        viewlet = Viewlet(Content('Home'), None, None, None)
+        viewlet.context.version = 2
+        executor.immediate = False
+        self.assertIsNone(prerenderer.fragment(viewlet, 'sitemap', storage))
+        executor.run()
+        self.assertEqual(2, storage.statistics()['entries'])
+        self.assertEqual(1, len(prerenderer._latest))
+
+    def test_failed(self):
+        import concurrent.futures
+
+        from zope.viewlet.cache import LRUCacheStorage
+        from zope.viewlet.prerender import Prerenderer
+
+        class FailingExecutor:
+            def submit(self, function, *args):
+                future = concurrent.futures.Future()
+                future.set_exception(ValueError('broken'))
+                return future
+
+        storage = LRUCacheStorage()
+        # Rendered in the request instead.
+        self.assertEqual(
+            '<ul>Home 1</ul>',
+            self._render(Prerenderer(FailingExecutor()), storage))
+        self.assertEqual(['Home'], SitemapViewlet.updated)
+        self.assertEqual(0, storage.statistics()['entries'])
+
+    def test_not_prerendered_without_storage(self):
+        from zope.viewlet.prerender import Prerenderer
+        self.assertEqual(
+            '<ul>Home 1</ul>',
+            self._render(Prerenderer(DeferredExecutor()), None))
+        self.assertEqual(['Home'], SitemapViewlet.updated)
+
+    def test_stale_output_evicted(self):
+        from zope.viewlet.cache import LRUCacheStorage
+        from zope.viewlet.prerender import Prerenderer
+        executor = DeferredExecutor()
+        prerenderer = Prerenderer(executor, timeout=0)
+        prerenderer.maxStale = 1
+        storage = LRUCacheStorage()
+        self._render(prerenderer, storage)
+        self._render(prerenderer, storage, 'Start')
+        self.assertEqual(1, len(prerenderer._latest))
+
+        # The last output for the first object is forgotten.
+        executor.immediate = False
+        self.assertEqual('<ul>Home 2</ul>',
+                         self._render(prerenderer, storage, version=2))
+        self.assertEqual(['Home'], SitemapViewlet.updated)
+
+    def test_stale_output_no_longer_stored(self):
+        from zope.viewlet.cache import LRUCacheStorage
+        from zope.viewlet.prerender import Prerenderer
+        executor = DeferredExecutor()
+        prerenderer = Prerenderer(executor, timeout=0)
+        storage = LRUCacheStorage()
+        self._render(prerenderer, storage)
+        storage.clear()
+        executor.immediate = False
+        self.assertEqual('<ul>Home 2</ul>',
+                         self._render(prerenderer, storage, version=2))
+        self.assertEqual(['Home'], SitemapViewlet.updated)
+
+    def test_cancelled(self):
+        from zope.viewlet.cache import LRUCacheStorage
+        from zope.viewlet.prerender import Prerenderer
+        executor = DeferredExecutor()
+        executor.immediate = False
+        prerenderer = Prerenderer(executor, timeout=0)
+        storage = LRUCacheStorage()
+        self._render(prerenderer, storage)
+        (future, function, args), = executor.calls
+        self.assertTrue(future.cancel())
+        self.assertEqual({}, prerenderer._pending)
+        self.assertEqual({}, prerenderer._latest)
+        self.assertEqual(0, storage.statistics()['entries'])
+
+    def test_stored_while_pending(self):
+        from zope.viewlet.cache import LRUCacheStorage
+        from zope.viewlet.prerender import Prerenderer
+        pending = []
+
+        class Storage(LRUCacheStorage):
+            def set(self, key, value):
+                pending.append(key in prerenderer._pending)
+                super().set(key, value)
+
+        prerenderer = Prerenderer(DeferredExecutor())
+        self._render(prerenderer, Storage())
+        self.assertEqual([True], pending)
+        self.assertEqual({}, prerenderer._pending)
+
+    def test_importable_class(self):
+        from zope.viewlet.prerender import _importableClass
+
+        # Generated classes are rendered as the class they were generated
+        # from, even if they have its name.
+        generated = type('SitemapViewlet', (SitemapViewlet,), {})
+        self.assertIs(SitemapViewlet, _importableClass(generated))
+
+        class Viewlet:
+            renderInputs = None
+
+        with self.assertRaises(TypeError):
+            _importableClass(Viewlet)
+
+    def test_spawn_executor(self):
+        import multiprocessing
+        from unittest import mock
+
+        from zope.viewlet.prerender import Prerenderer
+        prerenderer = Prerenderer()
+        self.addCleanup(prerenderer.shutdown)
+        with mock.patch.object(multiprocessing, 'get_all_start_methods',
+                               return_value=['fork', 'spawn']):
+            executor = prerenderer.executor
+        self.assertEqual('spawn', executor._mp_context.get_start_method())
+
+    def test_executor_created_once(self):
+        from zope.viewlet.prerender import Prerenderer
+        prerenderer = Prerenderer()
+        executor = DeferredExecutor()
+
+        class Lock:
+            def __enter__(self):
+                # Another thread created the executor meanwhile.
+                prerenderer._executor = executor
+
+            def __exit__(self, *args):
+                pass
+
+        prerenderer._lock = Lock()
+        self.assertIs(executor, prerenderer.executor)
+
+    def test_shutdown_without_executor(self):
+        from zope.viewlet.prerender import Prerenderer
+        prerenderer = Prerenderer()
+        prerenderer.shutdown()
+        self.assertIsNone(prerenderer._executor)
+
+
+class TestPriorityRendering(unittest.TestCase):
+
+    def setUp(self):
+        cleanup.setUp()
+        traversingSetUp()
+        LoggingViewlet.log = []
+        registerNamedViewlets('a', base=LoggingViewlet, weight=1)
+        registerNamedViewlets('b', base=LoggingViewlet, weight=2,
+                              updateDependencies='d')
+        registerNamedViewlets('c', base=LoggingViewlet, weight=3,
+                              priority='1', updateDependencies='b')
+        registerNamedViewlets('d', base=LoggingViewlet, weight=4)
+        registerNamedViewlets('e', base=LoggingViewlet, weight=5,
+                              updateDependencies='a c')
+
+    def tearDown(self):
+        cleanup.tearDown()
+
+    def _makeManager(self, template=None, updateExecutor=None):
+        from zope.publisher.browser import TestRequest
+        kw = {'compileTemplate': True}
+        if template is not None:
+            import tempfile
+            with tempfile.NamedTemporaryFile(
+                    'w', suffix='.pt', delete=False) as file:
+                file.write(template)
+            self.addCleanup(os.remove, file.name)
+            kw['template'] = file.name
+        class_ = managers.ViewletManager(
+            'column', IColumn, bases=(managers.PriorityViewletManager,),
+            **kw)
+        manager = class_(None, TestRequest(), None)
+        manager.updateExecutor = updateExecutor
+        return manager
+
+    def _updated(self):
+        return [name for name, _, _ in LoggingViewlet.log]
+
+    def test_getPriority(self):
+        self.assertEqual(0, managers.getPriority(object()))
+        self.assertEqual(2, managers.getPriority(
+            type('Viewlet', (), {'priority': '2'})))
+
+    def test_without_executor(self):
+        manager = self._makeManager()
+        manager.update()
+        # The important viewlet and what it depends on.
+        self.assertEqual(['d', 'b', 'c'], self._updated())
+        chunks = manager.iterRender()
+        self.assertEqual('<a>', next(chunks))
+        self.assertEqual(['d', 'b', 'c', 'a', 'e'], self._updated())
+        self.assertEqual(['\n<b>', '\n<c>', '\n<d>', '\n<e>'],
+                         list(chunks))
+
+    def test_render_waits_for_updates(self):
+        manager = self._makeManager()
+        manager.update()
+        self.assertEqual('<a>\n<b>\n<c>\n<d>\n<e>', manager.render())
+        self.assertEqual(['d', 'b', 'c', 'a', 'e'], self._updated())
+
+    def test_executor(self):
+        executor = DeferredExecutor()
+        executor.immediate = False
+        manager = self._makeManager(updateExecutor=executor)
+        manager.update()
+        self.assertEqual(['d', 'b', 'c'], self._updated())
+        # The other viewlets are updated in the background.
+        self.assertEqual(1, len(executor.calls))
+        executor.run()
+        self.assertEqual(['d', 'b', 'c', 'a'], self._updated())
+        executor.run()
+        self.assertEqual(['d', 'b', 'c', 'a', 'e'], self._updated())
+        self.assertEqual([], executor.calls)
+        self.assertEqual('<a>\n<b>\n<c>\n<d>\n<e>', manager.render())
+
+    def test_executor_errors(self):
+        import concurrent.futures
+
+        class Failing(LoggingViewlet):
+            def update(self):
+                raise ValueError(self.name)
+
+        registerNamedViewlets('a', base=Failing, weight=1)
+        executor = concurrent.futures.ThreadPoolExecutor(2)
+        self.addCleanup(executor.shutdown)
+        manager = self._makeManager(updateExecutor=executor)
+        manager.update()
+        with self.assertRaises(ValueError):
+            manager.render()
+        # The viewlets depending on the failed ones are not updated.
+        self.assertNotIn('e', self._updated())
+
+    def test_executor_refusing_updates(self):
+        import concurrent.futures
+
+        class ShutDownExecutor:
+            # Runs the first update and refuses the others.
+            submitted = 0
+
+            def submit(self, function, *args):
+                if self.submitted:
+                    raise RuntimeError('shut down')
+                self.submitted += 1
+                future = concurrent.futures.Future()
+                future.set_result(function(*args))
+                return future
+
+        updated = []
+        waves = [['a'], ['b', 'c'], ['d']]
+        futures = managers._startWaves(
+            lambda viewlet, key: updated.append(key), waves,
+            {id(name): name for wave in waves for name in wave},
+            ShutDownExecutor())
+        self.assertEqual(['a'], updated)
+        self.assertIsNone(futures[id(waves[0][0])].result(0))
+        for name in waves[1] + waves[2]:
+            self.assertRaises(RuntimeError, futures[id(name)].result, 0)
+
+    def _runWaves(self, outcomes):
+        # Runs the updates of two waves of viewlets on an executor, with
+        # the outcomes of the executor futures of some of them.
+        executor = DeferredExecutor()
+        executor.immediate = False
+        updated = []
+        waves = [['a', 'b'], ['c']]
+        futures = managers._startWaves(
+            lambda viewlet, key: updated.append(key), waves,
+            {id(name): name for wave in waves for name in wave}, executor)
+        while executor.calls:
+            calls, executor.calls = executor.calls, []
+            for future, function, args in calls:
+                outcome = outcomes.get(args[1])
+                if outcome is None:
+                    future.set_result(function(*args))
+                elif outcome == 'cancel':
+                    self.assertTrue(future.cancel())
+                else:
+                    future.set_exception(outcome)
+        return updated, {name: futures[id(name)]
+                         for wave in waves for name in wave}
+
+    def test_deferred_updates(self):
+        updated, futures = self._runWaves({})
+        self.assertEqual(['a', 'b', 'c'], updated)
+        self.assertIsNone(futures['c'].result(0))
+
+    def test_deferred_update_fails(self):
+        updated, futures = self._runWaves({'a': ValueError('a')})
+        self.assertEqual(['b'], updated)
+        self.assertRaises(ValueError, futures['a'].result, 0)
+        self.assertIsNone(futures['b'].result(0))
+        # The later waves are not run.
+        self.assertRaises(ValueError, futures['c'].result, 0)
+
+    def test_deferred_update_cancelled(self):
+        from concurrent.futures import CancelledError
+        updated, futures = self._runWaves({'a': 'cancel'})
+        self.assertEqual(['b'], updated)
+        self.assertRaises(CancelledError, futures['a'].result, 0)
+        self.assertIsNone(futures['b'].result(0))
+        self.assertRaises(CancelledError, futures['c'].result, 0)
+
+    def test_important_dependencies(self):
+        registerNamedViewlets('f', base=LoggingViewlet, weight=6,
+                              priority=1, updateDependencies='c unknown')
+        manager = self._makeManager()
+        manager.update()
+        self.assertEqual({'b', 'c', 'd', 'f'}, set(self._updated()))
+        # Viewlets updated by update are not waited for.
+        manager._awaitUpdate(manager['c'])
+        self.assertEqual(4, len(self._updated()))
+
+    def test_content_type(self):
+        from zope.publisher.browser import TestRequest
+        first = self._makeManager(template=SIMPLE_TEMPLATE)
+        first.update()
+        list(first.iterRender())
+        # Set from the compiled template like the template sets it.
+        manager = type(first)(None, TestRequest(), None)
+        manager.update()
+        self.assertIsNone(manager.request.response.getHeader('Content-Type'))
+        self.assertEqual(''.join(first.iterRender()),
+                         ''.join(manager.iterRender()))
+        self.assertEqual('text/html',
+                         manager.request.response.getHeader('Content-Type'))
+
+    def test_cached_fragments(self):
+        from zope.viewlet.cache import LRUCacheStorage
+        storage = LRUCacheStorage()
+        registerNamedViewlets('a', base=LoggingViewlet, weight=1,
+                              cacheKey=lambda self: 'key')
+        outputs = []
+        for _ in range(2):
+            manager = self._makeManager()
+            manager.cacheStorage = storage
+            manager.update()
+            outputs.append(list(manager.iterRender()))
+        self.assertEqual(outputs[0], outputs[1])
+        self.assertEqual(1, self._updated().count('a'))
+
+    def test_instance_template(self):
+        manager = self._makeManager(template=SIMPLE_TEMPLATE)
+        manager.template = lambda viewlets: 'template'
+        manager.update()
+        self.assertEqual(['template'], list(manager.iterRender()))
+
+    def test_threads(self):
+        import concurrent.futures
+        executor = concurrent.futures.ThreadPoolExecutor(2)
+        self.addCleanup(executor.shutdown)
+        manager = self._makeManager(
+            template=SIMPLE_TEMPLATE, updateExecutor=executor)
+        manager.update()
+        chunks = list(manager.iterRender())
+        self.assertEqual(['d', 'b', 'c'], self._updated()[:3])
+        self.assertEqual(['a', 'e'], self._updated()[3:])
+        self.assertEqual(manager.render(), ''.join(chunks))
+        self.assertEqual(6, len(chunks))
+
+    def test_template_not_compiled(self):
+        manager = self._makeManager(
+            template='<p tal:repeat="v options/viewlets"'
+                     ' tal:content="structure v/render"'
+                     ' tal:attributes="class v/name" />')
+        manager.update()
+        self.assertEqual(['<p class="a"><a></p><p class="b"><b></p>'
+                          '<p class="c"><c></p><p class="d"><d></p>'
+                          '<p class="e"><e></p>'],
+                         list(manager.iterRender()))
+
+    def test_no_viewlets(self):
+        manager = self._makeManager(template=SIMPLE_TEMPLATE)
+        manager.update(names=())
+        self.assertEqual([], list(manager.iterRender()))
+        self.assertEqual('', manager.render())
+
+
 def doctestSetUp(test):
     cleanup.setUp()
     eventtesting.setUp()
@@ -0,0 +1,150 @@
+##############################################################################
+#
+# Copyright (c) 2026 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""HTTP validators aggregated from viewlets.
+
+Viewlets providing :class:`~zope.viewlet.interfaces.IValidatedViewlet`
+report a version token or the time their output last changed without
+being updated. The
+`~zope.viewlet.manager.ViewletManagerBase.validator` of a viewlet
+manager combines those of its viewlets into a `Validator`, and
+`pageValidator` combines those of the managers of a page. A page can thus
+answer a conditional request before updating anything::
+
+  validator = pageValidator([header, columns, footer])
+  if notModified(self.request, validator):
+      self.request.response.setStatus(304)
+      return ''
+  setValidatorHeaders(self.request.response, validator)
+
+If any viewlet does not report a validator, the output cannot be
+validated and the combined validator is ``None``.
+"""
+__docformat__ = 'restructuredtext'
+
+import collections
+import datetime
+import email.utils
+import hashlib
+
+
+#: What the output of a viewlet, viewlet manager or page depends on.
+#: *token* is a string that changes whenever the output changes, and
+#: *lastModified* the time in seconds since the epoch at which the output
+#: last changed, or ``None`` if that is not known.
+Validator = collections.namedtuple('Validator', 'token lastModified')
+
+
+def _timestamp(value):
+    if value is None:
+        return None
+    if isinstance(value, datetime.datetime):
+        return value.timestamp()
+    return float(value)
+
+
+def viewletValidator(viewlet):
+    """
+    Return the `Validator` of *viewlet*, or ``None`` if it reports neither
+    a ``validationToken()`` nor a ``lastModified()``.
+    """
+    token = lastModified = None
+    method = getattr(viewlet, 'validationToken', None)
+    if method is not None:
+        token = method()
+    method = getattr(viewlet, 'lastModified', None)
+    if method is not None:
+        lastModified = _timestamp(method())
+    if token is None:
+        if lastModified is None:
+            return None
+        token = repr(lastModified)
+    return Validator(token, lastModified)
+
+
+def combine(validators):
+    """
+    Return the `Validator` combining the named *validators*, a sequence of
+    pairs of names and validators, or ``None`` if one of them is
+    ``None``.
+
+    The combined token changes whenever a name or a token does, the last
+    modification time is the latest one if all are known.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    lastModified = []
+    for name, validator in validators:
+        if validator is None:
+            return None
+        digest.update('{}\0{}\0'.format(name, validator.token).encode(
+            'utf-8'))
+        lastModified.append(validator.lastModified)
+    if None in lastModified or not lastModified:
+        latest = None
+    else:
+        latest = max(lastModified)
+    return Validator(digest.hexdigest(), latest)
+
+
+def pageValidator(managers):
+    """
+    Return the `Validator` of a page showing the viewlet *managers*, or
+    ``None`` if one of them cannot be validated.
+    """
+    return combine(
+        (getattr(manager, '__name__', None) or type(manager).__name__,
+         manager.validator())
+        for manager in managers)
+
+
+def etag(validator):
+    """Return the value of the ``ETag`` header for *validator*."""
+    return '"%s"' % validator.token
+
+
+def notModified(request, validator):
+    """
+    Return whether the client sending *request* already has the output
+    validated by *validator*, according to the ``If-None-Match`` or (only
+    if that is missing) ``If-Modified-Since`` request headers.
+    """
+    if validator is None:
+        return False
+    ifNoneMatch = request.getHeader('If-None-Match')
+    if ifNoneMatch is not None:
+        tags = [tag.strip() for tag in ifNoneMatch.split(',')]
+        return '*' in tags or etag(validator) in [
+            tag[2:] if tag.startswith('W/') else tag for tag in tags]
+    ifModifiedSince = request.getHeader('If-Modified-Since')
+    if ifModifiedSince is None or validator.lastModified is None:
+        return False
+    try:
+        since = email.utils.parsedate_to_datetime(ifModifiedSince)
+    except (TypeError, ValueError):
+        return False
+    if since.tzinfo is None:
+        since = since.replace(tzinfo=datetime.timezone.utc)
+    return int(validator.lastModified) <= since.timestamp()
+
+
+def setValidatorHeaders(response, validator):
+    """
+    Set the ``ETag`` and (if known) ``Last-Modified`` headers of
+    *response* for *validator*, if it is not ``None``.
+    """
+    if validator is None:
+        return
+    response.setHeader('ETag', etag(validator))
+    if validator.lastModified is not None:
+        response.setHeader('Last-Modified', email.utils.formatdate(
+            validator.lastModified, usegmt=True))
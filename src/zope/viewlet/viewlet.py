@@ -26,6 +26,8 @@ from zope.publisher.browser import BrowserView
 from zope.traversing import api
 
 from zope.viewlet import interfaces
+from zope.viewlet import memo
+from zope.viewlet import resource as resources
 
 
 @zope.interface.implementer(interfaces.IViewlet)
@@ -39,6 +41,14 @@ class ViewletBase(BrowserView):
         self.request = request
         self.manager = manager
 
+    @property
+    def requestMemo(self):
+        """
+        The :class:`~zope.viewlet.memo.RequestMemo` shared by all viewlets
+        of the request.
+        """
+        return memo.memoFor(self.request)
+
     def update(self):
         pass
 
@@ -98,6 +108,29 @@ def SimpleViewletClass(template, offering=None, bases=(), attributes=None,
     return class_
 
 
+#: The ways scripts can be loaded: blocking, deferred, asynchronously and
+#: as (deferred) JavaScript modules.
+LOADING = (None, 'defer', 'async', 'module')
+
+
+def _checkLoading(loading):
+    if loading not in LOADING:
+        raise ValueError('Unknown script loading %r' % (loading,))
+
+
+def _scriptAttributes(loading):
+    return {'type': 'module' if loading == 'module' else 'text/javascript',
+            'defer': 'defer' if loading == 'defer' else None,
+            'async': 'async' if loading == 'async' else None}
+
+
+def _inlineAttributes(inlineThreshold, minify):
+    attributes = {'_inlineThreshold': inlineThreshold}
+    if minify is not None:
+        attributes['_minify'] = staticmethod(minify)
+    return attributes
+
+
 class ResourceViewletBase:
     """A simple viewlet for inserting references to resources.
 
@@ -105,6 +138,19 @@ class ResourceViewletBase:
     """
     _path = None
 
+    #: If true, the URL includes the version of the resource file (see
+    #: :mod:`zope.viewlet.resource`).
+    _versioned = False
+
+    #: If not ``None``, resource files smaller than this number of bytes
+    #: are inserted into the page, after being passed through `_minify`
+    #: if that is not ``None``.
+    _inlineThreshold = None
+    _minify = None
+
+    #: The element inlined resources are inserted in.
+    _inlineTag = 'script'
+
     def getURL(self):
         """
         Retrieve the resource for our path using the
@@ -120,20 +166,71 @@ class ResourceViewletBase:
         """
         resource = api.traverse(self.context, '++resource++' + self._path,
                                 request=self.request)
+        if self._versioned:
+            return resources.versionedURL(resource)
         return resource()
 
+    def getInlineText(self):
+        """
+        Return the contents of the resource file if they are to be
+        inserted into the page instead of a link, otherwise ``None``.
+        """
+        if self._inlineThreshold is None:
+            return None
+        resource = api.traverse(self.context, '++resource++' + self._path,
+                                request=self.request)
+        return resources.inlineText(resource, self._inlineThreshold,
+                                    self._minify, self._inlineTag)
+
     def render(self, *args, **kw):
         return self.index(*args, **kw)
 
 
-def JavaScriptViewlet(path):
-    """Create a viewlet that can simply insert a javascript link."""
+class JavaScriptResourceViewletBase(ResourceViewletBase):
+
+    #: How the script is loaded, one of `LOADING`.
+    _loading = None
+
+    def getScriptAttributes(self):
+        """
+        Return a dictionary of the ``type``, ``defer`` and ``async``
+        attributes of the script element (``None`` for attributes to
+        leave out).
+        """
+        return _scriptAttributes(self._loading)
+
+    def getInlineText(self):
+        """
+        Like `ResourceViewletBase.getInlineText`, but deferred and
+        asynchronous scripts are never inlined, as inline scripts would
+        run before them, and neither are modules, whose relative imports
+        would be resolved against the URL of the page.
+        """
+        if self._loading in ('defer', 'async', 'module'):
+            return None
+        return super().getInlineText()
+
+
+def JavaScriptViewlet(path, versioned=False, inlineThreshold=None,
+                      minify=None, loading=None):
+    """
+    Create a viewlet that can simply insert a javascript link.
+
+    If *versioned* is true, the link includes the version of the resource
+    file. If the file is smaller than *inlineThreshold* bytes, the script
+    is inserted into the page instead, passed through *minify* if given.
+    *loading* is one of `LOADING`.
+    """
+    _checkLoading(loading)
     src = os.path.join(os.path.dirname(__file__), 'javascript_viewlet.pt')
 
     klass = type('JavaScriptViewlet',
-                 (ResourceViewletBase, ViewletBase),
-                 {'index': ViewPageTemplateFile(src),
-                  '_path': path})
+                 (JavaScriptResourceViewletBase, ViewletBase),
+                 dict(_inlineAttributes(inlineThreshold, minify),
+                      index=ViewPageTemplateFile(src),
+                      _path=path,
+                      _versioned=versioned,
+                      _loading=loading))
 
     return klass
 
@@ -142,6 +239,7 @@ class CSSResourceViewletBase(ResourceViewletBase):
 
     _media = 'all'
     _rel = 'stylesheet'
+    _inlineTag = 'style'
 
     def getMedia(self):
         return self._media
@@ -149,17 +247,34 @@ class CSSResourceViewletBase(ResourceViewletBase):
     def getRel(self):
         return self._rel
 
+    def getInlineText(self):
+        """Like `ResourceViewletBase.getInlineText`, but only for style
+        sheets."""
+        if self._rel != 'stylesheet':
+            return None
+        return super().getInlineText()
+
+
+def CSSViewlet(path, media="all", rel="stylesheet", versioned=False,
+               inlineThreshold=None, minify=None):
+    """
+    Create a viewlet that can simply insert a CSS link.
 
-def CSSViewlet(path, media="all", rel="stylesheet"):
-    """Create a viewlet that can simply insert a CSS link."""
+    If *versioned* is true, the link includes the version of the resource
+    file. If the file is smaller than *inlineThreshold* bytes, the style
+    sheet is inserted into the page instead, passed through *minify* (for
+    example `zope.viewlet.resource.minifyCSS`) if given.
+    """
     src = os.path.join(os.path.dirname(__file__), 'css_viewlet.pt')
 
     klass = type('CSSViewlet',
                  (CSSResourceViewletBase, ViewletBase),
-                 {'index': ViewPageTemplateFile(src),
-                  '_path': path,
-                  '_media': media,
-                  '_rel': rel})
+                 dict(_inlineAttributes(inlineThreshold, minify),
+                      index=ViewPageTemplateFile(src),
+                      _path=path,
+                      _media=media,
+                      _rel=rel,
+                      _versioned=versioned))
 
     return klass
 
@@ -171,6 +286,21 @@ class ResourceBundleViewletBase:
     """
     _paths = None
 
+    #: If true, the resources are replaced by
+    #: `zope.viewlet.resource.VersionedResource` objects.
+    _versioned = False
+
+    #: Like `ResourceViewletBase._inlineThreshold` and
+    #: `ResourceViewletBase._minify`.
+    _inlineThreshold = None
+    _minify = None
+
+    #: How the scripts are loaded, one of `LOADING`. If `_ordered` is
+    #: true, they are deferred instead of loaded asynchronously, so that
+    #: they still run in order.
+    _loading = None
+    _ordered = True
+
     #: A callable (usually a template) that is used to implement
     #: the `render` method.
     index = None
@@ -180,27 +310,68 @@ class ResourceBundleViewletBase:
         Retrieve all the resources in our desired paths using the
         :class:`++resource++ namespace <zope.traversing.namespace.resource>`
         """
-        resources = []
-        append = resources.append
+        result = []
+        append = result.append
         for path in self._paths:
-            append(api.traverse(self.context, '++resource++' + path,
-                                request=self.request))
-        return resources
+            resource = api.traverse(self.context, '++resource++' + path,
+                                    request=self.request)
+            if self._versioned:
+                resource = resources.VersionedResource(resource)
+            append(resource)
+        return result
+
+    def getScripts(self):
+        """
+        Return a list of dictionaries describing the scripts in order:
+        ``url`` is the resource as returned by `getResources`, ``text`` the
+        contents of the resource file if they are to be inserted into the
+        page instead of a link, otherwise ``None``. The other keys are
+        those of `JavaScriptResourceViewletBase.getScriptAttributes`.
+        """
+        loading = self._loading
+        if loading == 'async' and self._ordered:
+            loading = 'defer'
+        attributes = _scriptAttributes(loading)
+        inline = self._inlineThreshold is not None and \
+            loading not in ('defer', 'async', 'module')
+        result = []
+        for resource in self.getResources():
+            text = None
+            if inline:
+                text = resources.inlineText(
+                    getattr(resource, 'resource', resource),
+                    self._inlineThreshold, self._minify, 'script')
+            result.append(dict(attributes, url=resource, text=text))
+        return result
 
     def render(self, *args, **kw):
         return self.index(*args, **kw)
 
 
-def JavaScriptBundleViewlet(paths):
-    """Create a viewlet that can simply insert javascript links."""
+def JavaScriptBundleViewlet(paths, versioned=False, inlineThreshold=None,
+                            minify=None, loading=None, ordered=True):
+    """
+    Create a viewlet that can simply insert javascript links.
+
+    If *versioned* is true, the links include the versions of the resource
+    files. Files smaller than *inlineThreshold* bytes are inserted into
+    the page instead, passed through *minify* if given. *loading* is one
+    of `LOADING`; unless *ordered* is false, ``'async'`` scripts are
+    deferred instead, so that they run in the order of *paths*.
+    """
+    _checkLoading(loading)
     src = os.path.join(
         os.path.dirname(__file__),
         'javascript_bundle_viewlet.pt')
 
     klass = type('JavaScriptBundleViewlet',
                  (ResourceBundleViewletBase, ViewletBase),
-                 {'index': ViewPageTemplateFile(src),
-                  '_paths': paths})
+                 dict(_inlineAttributes(inlineThreshold, minify),
+                      index=ViewPageTemplateFile(src),
+                      _paths=paths,
+                      _versioned=versioned,
+                      _loading=loading,
+                      _ordered=ordered))
 
     return klass
 
@@ -221,6 +392,14 @@ class CSSResourceBundleViewletBase:
     """
     _items = None
 
+    #: If true, the URLs include the versions of the resource files.
+    _versioned = False
+
+    #: Like `ResourceViewletBase._inlineThreshold` and
+    #: `ResourceViewletBase._minify`.
+    _inlineThreshold = None
+    _minify = None
+
     def getResources(self):
         """
         Retrieve all the resources for our desired items' paths using
@@ -231,36 +410,55 @@ class CSSResourceBundleViewletBase:
         The dictionaries are like those passed to the constructor with
         the defaults filled in, except that ``path`` has been replaced
         with ``url``.  The ``url`` object is as described for
-        `ResourceViewletBase.getURL`.
+        `ResourceViewletBase.getURL` (or a
+        `zope.viewlet.resource.VersionedResource`). ``text`` is the
+        contents of style sheets to be inserted into the page instead of
+        a link, otherwise ``None``.
         """
-        resources = []
-        append = resources.append
+        result = []
+        append = result.append
         for item in self._items:
             info = {}
             info['url'] = api.traverse(self.context,
                                        '++resource++' + item.get('path'),
                                        request=self.request)
+            info['text'] = None
+            if self._inlineThreshold is not None and \
+                    item.get('rel', 'stylesheet') == 'stylesheet':
+                info['text'] = resources.inlineText(
+                    info['url'], self._inlineThreshold, self._minify,
+                    'style')
+            if self._versioned:
+                info['url'] = resources.VersionedResource(info['url'])
             info['media'] = item.get('media', 'all')
             info['rel'] = item.get('rel', 'stylesheet')
             append(info)
-        return resources
+        return result
 
     def render(self, *args, **kw):
         return self.index(*args, **kw)
 
 
-def CSSBundleViewlet(items):
+def CSSBundleViewlet(items, versioned=False, inlineThreshold=None,
+                     minify=None):
     """
     Create a viewlet that can simply insert css links.
 
     :param items: A sequence of dictionaries as described in
                   `CSSResourceBundleViewletBase`.
+    :param bool versioned: Whether the links include the versions of the
+                  resource files.
+    :param int inlineThreshold: If given, style sheets whose files are
+                  smaller than this number of bytes are inserted into the
+                  page instead, passed through *minify* if given.
     """
     src = os.path.join(os.path.dirname(__file__), 'css_bundle_viewlet.pt')
 
     klass = type('CSSBundleViewlet',
                  (CSSResourceBundleViewletBase, ViewletBase),
-                 {'index': ViewPageTemplateFile(src),
-                  '_items': items})
+                 dict(_inlineAttributes(inlineThreshold, minify),
+                      index=ViewPageTemplateFile(src),
+                      _items=items,
+                      _versioned=versioned))
 
     return klass